@@ -2,12 +2,14 @@ import pandas as pd
 import os
 from grape import Graph
 from kg_analysis.kg_analysis import get_edge_type_to_node_types_mapping, independent_edge_evaluation,add_predictions_to_kg
+from kg_creation.assemble_kg.final_graph_creation import find_graph_store, load_graph_store, graph_store_to_grape
 
 examine_core_proteins_only = True
 root_directory = '/caseolap_lift_shared_folder'
 core_proteins_file = os.path.join(root_directory,'output/core_proteins.txt')
 node_path = os.path.join(root_directory,'result/graph_data/merged_node_list.tsv')
 edge_path = os.path.join(root_directory,'result/graph_data/merged_edge_list.tsv')
+store_path = find_graph_store(os.path.join(root_directory,'result/graph_data'))
 output_folder = os.path.join(root_directory,'result/kg_analysis')
 eval_output = os.path.join(output_folder,'eval_results.csv')
 predictions_output = os.path.join(output_folder,'predictions.csv')
@@ -18,19 +20,22 @@ if not os.path.exists(output_folder):
 
 core_proteins = [l.strip("\n") for l in open(core_proteins_file,'r').readlines()]
 
-g = Graph.from_csv(
-  directed=False,
-  node_path=node_path,
-  edge_path=edge_path,
-  verbose=True,
-  nodes_column='node',
-  node_list_node_types_column='node_type',
-  default_node_type='None',
-  sources_column='head',
-  destinations_column='tail',
-  edge_list_edge_types_column='relation',
-  name="Mito KG"
-)
+if store_path is not None:
+  g = graph_store_to_grape(load_graph_store(store_path), directed=False, name="Mito KG", weighted=False)
+else:
+  g = Graph.from_csv(
+    directed=False,
+    node_path=node_path,
+    edge_path=edge_path,
+    verbose=True,
+    nodes_column='node',
+    node_list_node_types_column='node_type',
+    default_node_type='None',
+    sources_column='head',
+    destinations_column='tail',
+    edge_list_edge_types_column='relation',
+    name="Mito KG"
+  )
 g = g.remove_disconnected_nodes()
 
 # how many of each edge type?
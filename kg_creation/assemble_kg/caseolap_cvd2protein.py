@@ -1,57 +1,110 @@
 import pandas as pd
+import numpy as np
 import os
 
 from tqdm import tqdm
 from scipy.stats import zscore
 
 
-def caseolap2triples(caseolap_csv_file: os.path, SCALING = "raw") -> pd.DataFrame:
+#scaling names (including the ones used by caseolapLIFT_kg) -> scaling mode
+SCALING_MODES = {"raw": "raw",
+                 "z_score": "z_score", "z-score": "z_score",
+                 "scaled_z_score": "scaled_z_score", "z-score+1": "scaled_z_score"}
+
+
+def caseolap_df2triples(caseolap_df: pd.DataFrame) -> pd.DataFrame:
     """
-    creates triples out of caseolap dataframe
+    reshapes a caseolap score table (entity column + one column per cvd)
+    into triples in one pass, one row per (protein, cvd), in the table's
+    row order
 
     ARGS:
-        caseolap_csv: csv file to build caseolap triples
-        SCALING: choose one of the following ["raw", "z_score", "scaled_z_score"]
-    
+        caseolap_df: caseolap scores, proteins x cvds
+
     RETURNS:
-        caseolap kg with triples
+        caseolap triples (unscaled weights, zeros included)
     """
-    
-    caseolap_df = pd.read_csv(caseolap_csv_file)
-    caseolap_df = caseolap_df
     cvd_type = caseolap_df.columns.to_list()
     cvd_type.remove("entity")
-    caseolap_df = caseolap_df.to_dict("records")
-    caseolap_kg = pd.DataFrame()
-
-    #iterate throught the rows and create a mini dataframe for each protein
-    #after, attach that mini dataframe to the caseolap dataframe
-    #so it doesnt crash lol using batches
-    for row in caseolap_df:
-
-        #assemble kg
-        holder_df = pd.DataFrame()
-        holder_df["head"] = [i for i in cvd_type]
-        holder_df["relation"] = ["CaseOLAP_score" for i in cvd_type]
-        holder_df["tail"] = [row["entity"] for i in cvd_type]
-        holder_df["weight"] = [row[i] for i in cvd_type]
-
-        #update master kg
-        caseolap_kg = pd.concat([caseolap_kg, holder_df])
-
-    if SCALING == "z_score":
-        caseolap_kg["weight"] = zscore(caseolap_kg["weight"])
-
-    elif SCALING == "scaled_z_score":
-        caseolap_kg["weight"] = zscore(caseolap_kg["weight"]) + 1
+    weights = caseolap_df[cvd_type].to_numpy(dtype=np.float64)
 
-    else:
-        pass
-
-    caseolap_kg = caseolap_kg[caseolap_kg["weight"] != 0]
-    return caseolap_kg
+    #row-major: every cvd of the first protein, then the next protein...
+    return pd.DataFrame({"head": np.tile(np.array(cvd_type, dtype=object), len(caseolap_df)),
+                         "relation": "CaseOLAP_score",
+                         "tail": np.repeat(caseolap_df["entity"].to_numpy(dtype=object), len(cvd_type)),
+                         "weight": weights.ravel()})
 
 
+def caseolap_weight_stats(caseolap_csv_file: os.path, chunksize: int):
+    """
+    mean and standard deviation (as zscore) of all caseolap scores,
+    reading the table in chunks
 
+    RETURNS:
+        mean, standard deviation
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    for caseolap_df in pd.read_csv(caseolap_csv_file, chunksize = chunksize):
+        weights = caseolap_df2triples(caseolap_df)["weight"].to_numpy()
+        if len(weights) == 0:
+            continue
+
+        #combine the chunk's mean and sum of squares with the previous ones
+        chunk_mean = weights.mean()
+        chunk_m2 = ((weights - chunk_mean) ** 2).sum()
+        delta = chunk_mean - mean
+        total = count + len(weights)
+        mean += delta * len(weights) / total
+        m2 += chunk_m2 + delta ** 2 * count * len(weights) / total
+        count = total
+    return mean, np.sqrt(m2 / count) if count > 0 else np.nan
+
+
+def caseolap2triples(caseolap_csv_file: os.path, SCALING = "raw", out_file = None,
+                     chunksize = 100000) -> pd.DataFrame:
+    """
+    creates triples out of caseolap dataframe
 
+    ARGS:
+        caseolap_csv: csv file to build caseolap triples
+        SCALING: choose one of the following ["raw", "z_score", "scaled_z_score"]
+                 ("z-score" and "z-score+1" also work)
+        out_file: if given, the triples are written to this tsv file chunk
+                  by chunk instead of being kept in memory
+        chunksize: number of proteins per chunk when writing to out_file
 
+    RETURNS:
+        caseolap kg with triples (or out_file, if given)
+    """
+    SCALING = SCALING_MODES.get(SCALING, "raw")
+
+    if out_file is None:
+        caseolap_kg = caseolap_df2triples(pd.read_csv(caseolap_csv_file))
+
+        if SCALING == "z_score":
+            caseolap_kg["weight"] = zscore(caseolap_kg["weight"])
+
+        elif SCALING == "scaled_z_score":
+            caseolap_kg["weight"] = zscore(caseolap_kg["weight"]) + 1
+
+        caseolap_kg = caseolap_kg[caseolap_kg["weight"] != 0]
+        return caseolap_kg
+
+    #z-scores need the mean and std of all the scores first
+    mean, std = 0.0, 1.0
+    if SCALING != "raw":
+        mean, std = caseolap_weight_stats(caseolap_csv_file, chunksize)
+    shift = 1 if SCALING == "scaled_z_score" else 0
+
+    #write the triples of each chunk of proteins
+    header = True
+    for caseolap_df in pd.read_csv(caseolap_csv_file, chunksize = chunksize):
+        caseolap_kg = caseolap_df2triples(caseolap_df)
+        if SCALING != "raw":
+            with np.errstate(divide = "ignore", invalid = "ignore"):
+                caseolap_kg["weight"] = (caseolap_kg["weight"] - mean) / std + shift
+        caseolap_kg = caseolap_kg[caseolap_kg["weight"] != 0]
+        caseolap_kg.to_csv(out_file, sep = "\t", index = False, header = header,
+                           mode = "w" if header else "a")
+        header = False
+    return out_file
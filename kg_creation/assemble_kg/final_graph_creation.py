@@ -1,63 +1,218 @@
 import pandas as pd
 import numpy as np
 import os
+import shutil
+
+CVD_TYPES = ["IHD", "CM", "ARR", "VD", "CHD", "CCD", "VOO", "OTH"]
+
+#graph store file (npz) or directory (parquet) in the graph data directory
+GRAPH_STORE_PATHS = {"npz": "kg_store.npz", "parquet": "kg_store"}
+
+
+def typed_nodes(nodes, node_type, other_node_type = None) -> pd.DataFrame:
+    """
+    node list of the unique nodes (in order of appearance), all of one node
+    type, or CVD for the cvd categories if other_node_type is given
+    """
+    all_nodes = pd.unique(np.concatenate([np.asarray(n, dtype=object) for n in nodes]))
+    if other_node_type is None:
+        node_types = np.full(len(all_nodes), node_type, dtype=object)
+    else:
+        node_types = np.where(np.isin(all_nodes, CVD_TYPES), node_type, other_node_type)
+    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
+    return node_list
+
 def mesh_nodes(mesh_kg: pd.DataFrame) -> pd.DataFrame:
     """
     node list for mesh
     [head, relation, tail]
     """
-    all_nodes = list(set(mesh_kg["head"].to_list() + mesh_kg["tail"].to_list()))
-    cvd_types = ["IHD", "CM", "ARR", "VD", "CHD", "CCD", "VOO", "OTH"]
-    node_types = ["CVD" if i in cvd_types else "MeSH_Tree_Disease" for i in all_nodes]
-    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
-    return node_list
+    return typed_nodes([mesh_kg["head"], mesh_kg["tail"]], "CVD", "MeSH_Tree_Disease")
 
 def caseolap_nodes(caseolap_kg: pd.DataFrame) -> pd.DataFrame:
-    all_nodes = list(set(caseolap_kg["head"].to_list() + caseolap_kg["tail"].to_list()))
-    cvd_types = ["IHD", "CM", "ARR", "VD", "CHD", "CCD", "VOO", "OTH"]
-    node_types = ["CVD" if i in cvd_types else "Protein" for i in all_nodes]
-    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
-    return node_list
+    return typed_nodes([caseolap_kg["head"], caseolap_kg["tail"]], "CVD", "Protein")
+
 
-    
 def reactome_nodes(reactome_kg: pd.DataFrame) -> pd.DataFrame:
     if reactome_kg is None:
         return
-    protein_nodes = list(set(reactome_kg["head"]))
-    protein_type = ["Protein" for i in protein_nodes]
-
-    pathway_nodes = list(set(reactome_kg["tail"]))
-    pathway_type = ["Reactome_Pathway" for i in pathway_nodes]
-
-    all_nodes = protein_nodes + pathway_nodes
-    node_types = protein_type + pathway_type
-    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
+    protein_nodes = typed_nodes([reactome_kg["head"]], "Protein")
+    pathway_nodes = typed_nodes([reactome_kg["tail"]], "Reactome_Pathway")
+    node_list = pd.concat([protein_nodes, pathway_nodes], ignore_index = True)
     return node_list
 
 
 def ppi_nodes(ppi_kg: pd.DataFrame) -> pd.DataFrame:
     if ppi_kg is None:
         return
-    all_nodes = list(set(ppi_kg["head"].to_list() + ppi_kg["tail"].to_list()))
-    node_types = ["Protein" for i in all_nodes]
-    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
-    return node_list
+    return typed_nodes([ppi_kg["head"], ppi_kg["tail"]], "Protein")
 
 def tf_nodes(tf_kg: pd.DataFrame) -> pd.DataFrame:
     if tf_kg is None:
         return
-    all_nodes = list(set(tf_kg["head"].to_list() + tf_kg["tail"].to_list()))
-    node_types = ["Protein" for i in all_nodes]
-    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
-    return node_list
+    return typed_nodes([tf_kg["head"], tf_kg["tail"]], "Protein")
 
 def reactome_hierarchy_nodes(reactome_hierarchy_kg: pd.DataFrame) -> pd.DataFrame:
     if reactome_hierarchy_kg is None:
         return
-    all_nodes = list(set(reactome_hierarchy_kg["head"].to_list() + reactome_hierarchy_kg["tail"].to_list()))
-    node_types = ["Reactome_Pathway" for i in all_nodes]
-    node_list = pd.DataFrame({"node": all_nodes, "node_type": node_types})
-    return node_list
+    return typed_nodes([reactome_hierarchy_kg["head"], reactome_hierarchy_kg["tail"]], "Reactome_Pathway")
+
+
+
+def encode_graph(merged_edges: pd.DataFrame, node_list: pd.DataFrame) -> dict:
+    """
+    dictionary-encodes the graph: node names, node types and edge types
+    become vocabularies, the edges become integer arrays
+
+    ARGS:
+        merged_edges: edge list [head, relation, tail, weight]
+        node_list: node list [node, node_type], one row per node
+
+    RETURNS:
+        graph store (dict):
+            nodes, node_type_names, edge_type_names: vocabularies (str)
+            node_types: node type of each node (int32)
+            src, dst, edge_types: head, tail and relation of each edge (int32)
+            weights: weight of each edge (float32)
+    """
+    nodes = node_list["node"].astype(str).to_numpy()
+    node_types, node_type_names = pd.factorize(node_list["node_type"].astype(str))
+
+    #edge nodes -> node numbers (nodes missing from the node list are added, type "None")
+    heads = merged_edges["head"].astype(str).to_numpy()
+    tails = merged_edges["tail"].astype(str).to_numpy()
+    node_index = pd.Index(nodes)
+    missing = pd.unique(np.concatenate([heads[node_index.get_indexer(heads) < 0],
+                                        tails[node_index.get_indexer(tails) < 0]]))
+    if len(missing) > 0:
+        nodes = np.concatenate([nodes, missing])
+        node_type_names = node_type_names.append(pd.Index(["None"])).unique()
+        node_types = np.concatenate([node_types, np.full(len(missing), node_type_names.get_loc("None"))])
+        node_index = pd.Index(nodes)
+
+    edge_types, edge_type_names = pd.factorize(merged_edges["relation"].astype(str))
+    return {"nodes": nodes.astype(str),
+            "node_type_names": np.asarray(node_type_names, dtype=str),
+            "node_types": node_types.astype(np.int32),
+            "edge_type_names": np.asarray(edge_type_names, dtype=str),
+            "src": node_index.get_indexer(heads).astype(np.int32),
+            "dst": node_index.get_indexer(tails).astype(np.int32),
+            "edge_types": edge_types.astype(np.int32),
+            "weights": merged_edges["weight"].to_numpy(dtype=np.float32)}
+
+
+def save_graph_store(store: dict, path: str, store_format = "npz"):
+    """
+    saves the graph store as one .npz file (store_format = "npz") or as a
+    directory with kg_nodes.parquet and kg_edges.parquet (store_format =
+    "parquet", node types and edge types as dictionary-encoded columns;
+    needs pyarrow)
+    """
+    if store_format == "npz":
+        with open(path + ".tmp", "wb") as fout:
+            np.savez_compressed(fout, **store)
+        os.replace(path + ".tmp", path)
+        return
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nodes_df = pd.DataFrame({"node": store["nodes"],
+                             "node_type": pd.Categorical.from_codes(store["node_types"],
+                                                                    store["node_type_names"])})
+    edges_df = pd.DataFrame({"src": store["src"], "dst": store["dst"],
+                             "relation": pd.Categorical.from_codes(store["edge_types"],
+                                                                   store["edge_type_names"]),
+                             "weight": store["weights"]})
+    nodes_df.to_parquet(os.path.join(path, "kg_nodes.parquet"), index = False)
+    edges_df.to_parquet(os.path.join(path, "kg_edges.parquet"), index = False)
+
+
+def load_graph_store(path: str) -> dict:
+    """
+    loads a graph store saved by save_graph_store (.npz file or parquet
+    directory)
+    """
+    if not os.path.isdir(path):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    nodes_df = pd.read_parquet(os.path.join(path, "kg_nodes.parquet"))
+    edges_df = pd.read_parquet(os.path.join(path, "kg_edges.parquet"))
+    node_types = nodes_df["node_type"].astype("category")
+    edge_types = edges_df["relation"].astype("category")
+    return {"nodes": nodes_df["node"].to_numpy().astype(str),
+            "node_type_names": np.asarray(node_types.cat.categories, dtype=str),
+            "node_types": node_types.cat.codes.to_numpy().astype(np.int32),
+            "edge_type_names": np.asarray(edge_types.cat.categories, dtype=str),
+            "src": edges_df["src"].to_numpy(dtype=np.int32),
+            "dst": edges_df["dst"].to_numpy(dtype=np.int32),
+            "edge_types": edge_types.cat.codes.to_numpy().astype(np.int32),
+            "weights": edges_df["weight"].to_numpy(dtype=np.float32)}
+
+
+def find_graph_store(graph_directory: str):
+    """
+    path of the graph store saved by graph_create in the graph data
+    directory (npz or parquet), or None if there is none or the merged tsv
+    files are newer than it (then the tsv files are the current graph)
+    """
+    edge_path = os.path.join(graph_directory, "merged_edge_list.tsv")
+    for store_format in GRAPH_STORE_PATHS:
+        store_path = os.path.join(graph_directory, GRAPH_STORE_PATHS[store_format])
+        store_file = os.path.join(store_path, "kg_edges.parquet") if store_format == "parquet" else store_path
+        if not os.path.exists(store_file):
+            continue
+        if os.path.exists(edge_path) and os.path.getmtime(edge_path) > os.path.getmtime(store_file):
+            return None
+        return store_path
+    return None
+
+
+def graph_store_to_csr(store: dict, directed = False, edge_type = None):
+    """
+    weighted adjacency matrix (scipy sparse CSR, nodes x nodes) of the
+    graph store; repeated edges are summed
+
+    ARGS:
+        directed: if False, each edge is added in both directions
+        edge_type: only the edges of this relation (e.g., "CaseOLAP_score")
+    """
+    from scipy import sparse
+    src, dst, weights = store["src"], store["dst"], store["weights"]
+    if edge_type is not None:
+        keep = store["edge_types"] == list(store["edge_type_names"]).index(edge_type)
+        src, dst, weights = src[keep], dst[keep], weights[keep]
+    if not directed:
+        loops = src == dst
+        src, dst = np.concatenate([src, dst[~loops]]), np.concatenate([dst, src[~loops]])
+        weights = np.concatenate([weights, weights[~loops]])
+    num_nodes = len(store["nodes"])
+    return sparse.csr_matrix((weights, (src, dst)), shape = (num_nodes, num_nodes))
+
+
+def graph_store_to_grape(store: dict, directed = False, name = "Graph", weighted = True):
+    """
+    GRAPE graph of the graph store, decoding the vocabularies with array
+    lookups instead of parsing the tsv files
+    """
+    from grape import Graph
+    nodes_df = pd.DataFrame({"node": store["nodes"],
+                             "node_type": store["node_type_names"][store["node_types"]]})
+    edges_df = pd.DataFrame({"head": store["nodes"][store["src"]],
+                             "tail": store["nodes"][store["dst"]],
+                             "relation": store["edge_type_names"][store["edge_types"]]})
+    if weighted:
+        edges_df["weight"] = store["weights"]
+    return Graph.from_pd(directed = directed,
+                         edges_df = edges_df,
+                         nodes_df = nodes_df,
+                         node_name_column = "node",
+                         node_type_column = "node_type",
+                         edge_src_column = "head",
+                         edge_dst_column = "tail",
+                         edge_weight_column = "weight" if weighted else None,
+                         edge_type_column = "relation",
+                         name = name)
 
 
 
@@ -65,16 +220,23 @@ def graph_create(mesh_kg: pd.DataFrame, caseolap_kg: pd.DataFrame, \
                  reactome_kg: pd.DataFrame, \
                  ppi_kg: pd.DataFrame, tf_kg: pd.DataFrame, \
                  reactome_hierarchy_kg: pd.DataFrame, \
-                 output_directory='../output/graph_data') -> pd.DataFrame:
+                 output_directory='../output/graph_data', \
+                 store_format = "npz", write_tsv = True) -> pd.DataFrame:
     """
     given the edge list of all compiled datasets, generate merged edge list and merged node list
+
+    ARGS:
+        store_format: also save the dictionary-encoded graph store, "npz"
+                      (kg_store.npz) or "parquet" (kg_store/), None to skip
+        write_tsv: whether to write merged_edge_list.tsv and merged_node_list.tsv
     """
     #filter out the stuff
     df_list = [mesh_kg, caseolap_kg, reactome_kg, ppi_kg, tf_kg, reactome_hierarchy_kg]
     df_list = [i for i in df_list if i is not None]
 
     merged_edges = pd.concat(df_list)
-    merged_edges.to_csv(os.path.join(output_directory,"merged_edge_list.tsv"), sep = "\t", index = False)
+    if write_tsv:
+        merged_edges.to_csv(os.path.join(output_directory,"merged_edge_list.tsv"), sep = "\t", index = False)
 
     node_list = pd.concat([mesh_nodes(mesh_kg), caseolap_nodes(caseolap_kg), \
                           reactome_nodes(reactome_kg), \
@@ -83,4 +245,16 @@ def graph_create(mesh_kg: pd.DataFrame, caseolap_kg: pd.DataFrame, \
                           reactome_hierarchy_nodes(reactome_hierarchy_kg)])
 
     node_list = node_list.drop_duplicates(subset = ["node"])
-    node_list.to_csv(os.path.join(output_directory,"merged_node_list.tsv"), sep = "\t", index = False)
\ No newline at end of file
+    if write_tsv:
+        node_list.to_csv(os.path.join(output_directory,"merged_node_list.tsv"), sep = "\t", index = False)
+
+    #integer-encoded graph, stores of the other (or no) format are removed
+    for other_format, other_path in GRAPH_STORE_PATHS.items():
+        other_path = os.path.join(output_directory, other_path)
+        if other_format != store_format and os.path.isdir(other_path):
+            shutil.rmtree(other_path)
+        elif other_format != store_format and os.path.exists(other_path):
+            os.remove(other_path)
+    if store_format is not None:
+        store_path = os.path.join(output_directory, GRAPH_STORE_PATHS[store_format])
+        save_graph_store(encode_graph(merged_edges, node_list), store_path, store_format)
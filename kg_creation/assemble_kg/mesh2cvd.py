@@ -1,5 +1,6 @@
 #data handling
 import pandas as pd
+import numpy as np
 import json
 
 from tqdm import tqdm
@@ -14,40 +15,30 @@ def parse_mesh_tree(mesh_tree_file):
     return mesh_term_to_code
     
 def mesh2triples(mesh_tree_to_id_file, mesh_tree_file, disease_to_mesh, include_MeSH: bool):
-    # reformat data into the following
-    data = {h:[] for h in ['head','relation','tail','edge_type','weight']}
-
     # load the files
     mesh_tree_to_id_df = pd.read_csv(mesh_tree_to_id_file)
     mesh_tree_df = pd.read_csv(mesh_tree_file)
 
     #head and tail for the first df
-    head_mesh_tree_df = [str(i) for i in mesh_tree_df['Disease (MeSH Tree)'].to_list()]
-    tail_mesh_tree_df = [str(i) for i in mesh_tree_df['Disease (MeSH Tree).1'].to_list()]
-    relation_mesh_tree_df = ['MeSH_hierarchy' for i in tail_mesh_tree_df]
+    mesh_tree_kg = pd.DataFrame({"head" : mesh_tree_df['Disease (MeSH Tree)'].astype(str),
+                                 "relation" : "MeSH_hierarchy",
+                                 "tail" : mesh_tree_df['Disease (MeSH Tree).1'].astype(str)})
 
     #head and tail for the second df
-    head_mesh_tree_to_id_df = [str(i) for i in mesh_tree_to_id_df['Disease (MeSH Tree)'].to_list()]
-    tail_mesh_tree_to_id_df = [str(i) for i in mesh_tree_to_id_df['Disease (MeSH)'].to_list()]
-    relation_mesh_tree_to_id_df = ['MeSH_is' for i in tail_mesh_tree_to_id_df]
-
-    head_cvd_mesh = []
-    tail_cvd_mesh = []
-    #iterate over dict
-    for cvd, mesh_terms in disease_to_mesh.items():
-        for m in mesh_terms:
-            mesh = "MeSH_Tree_Disease:" + str(m)
-            head_cvd_mesh.append(cvd)
-            tail_cvd_mesh.append(mesh)
-    relation_cvd_mesh = ["MeSH_CVD" for i in head_cvd_mesh]
-
-    #combine final head column
-    head = head_mesh_tree_df + head_mesh_tree_to_id_df + head_cvd_mesh
-    tail = tail_mesh_tree_df + tail_mesh_tree_to_id_df + tail_cvd_mesh
-    relation = relation_mesh_tree_df + relation_mesh_tree_to_id_df + relation_cvd_mesh
-    weight = [1 for i in relation]
-
-    mesh_kg = pd.DataFrame({"head" : head, "relation" : relation, "tail" : tail, "weight" : weight})
+    mesh_tree_to_id_kg = pd.DataFrame({"head" : mesh_tree_to_id_df['Disease (MeSH Tree)'].astype(str),
+                                       "relation" : "MeSH_is",
+                                       "tail" : mesh_tree_to_id_df['Disease (MeSH)'].astype(str)})
+
+    #cvd -> each of its mesh terms
+    num_mesh_terms = [len(mesh_terms) for mesh_terms in disease_to_mesh.values()]
+    mesh_terms = [str(m) for mesh_terms in disease_to_mesh.values() for m in mesh_terms]
+    cvd_mesh_kg = pd.DataFrame({"head" : np.repeat(np.array(list(disease_to_mesh), dtype=object), num_mesh_terms),
+                                "relation" : "MeSH_CVD",
+                                "tail" : ["MeSH_Tree_Disease:" + m for m in mesh_terms]})
+
+    #combine final columns
+    mesh_kg = pd.concat([mesh_tree_kg, mesh_tree_to_id_kg, cvd_mesh_kg], ignore_index = True)
+    mesh_kg["weight"] = 1
 
     #choose whether to include mesh tree or not
     if include_MeSH == False:
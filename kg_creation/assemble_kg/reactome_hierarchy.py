@@ -13,14 +13,12 @@ from tqdm import tqdm
 def reactome2reactome(reactome_hierarchy) -> pd.DataFrame:
     reactome_hierarchy_kg = pd.read_csv(reactome_hierarchy, sep = "\t", header = None, names = ["head", "tail"])
 
-    head = [i for i in reactome_hierarchy_kg["head"] if "R-HSA" in i]
-    tail = [i for i in reactome_hierarchy_kg["tail"] if "R-HSA" in i]
+    #human pathways only
+    human = reactome_hierarchy_kg["head"].str.contains("R-HSA", regex = False, na = False) & \
+            reactome_hierarchy_kg["tail"].str.contains("R-HSA", regex = False, na = False)
 
-
-    reactome_hierarchy_kg = pd.DataFrame()
-
-    reactome_hierarchy_kg["head"] = head
-    reactome_hierarchy_kg["relation"] = "Reactome_Hierarchy"
-    reactome_hierarchy_kg["tail"] = tail
-    reactome_hierarchy_kg["weight"] = 1
-    return reactome_hierarchy_kg
\ No newline at end of file
+    reactome_hierarchy_kg = pd.DataFrame({"head" : reactome_hierarchy_kg["head"][human].to_numpy(),
+                                          "relation" : "Reactome_Hierarchy",
+                                          "tail" : reactome_hierarchy_kg["tail"][human].to_numpy(),
+                                          "weight" : 1})
+    return reactome_hierarchy_kg
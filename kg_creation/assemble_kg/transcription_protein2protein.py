@@ -18,17 +18,10 @@ def transcription_protein2triples(PATH_JSON: str) -> pd.DataFrame:
     with open(PATH_JSON, 'r') as file:
         tf_dict = json.loads(file.read())
 
-    head = []
-    tail = []
-    for key in tf_dict:
-        for element in tf_dict[key]:
-            head.append(key)
-            tail.append(element)
+    #each transcription factor target -> each of its transcription factors
+    num_elements = [len(tf_dict[key]) for key in tf_dict]
+    head = np.repeat(np.array(list(tf_dict), dtype=object), num_elements)
+    tail = [element for key in tf_dict for element in tf_dict[key]]
 
-    #relationship
-    relation = ["transcription_factor" for i in head]
-
-    weight = [1 for i in relation]
-
-    tf_kg = pd.DataFrame({"head" : head, "relation" : relation, "tail" : tail, "weight" : weight})
-    return tf_kg
\ No newline at end of file
+    tf_kg = pd.DataFrame({"head" : head, "relation" : "transcription_factor", "tail" : tail, "weight" : 1})
+    return tf_kg
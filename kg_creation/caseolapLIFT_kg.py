@@ -36,6 +36,7 @@ from kg_creation.assemble_kg.transcription_protein2protein import transcription_
 
 #final graph data
 from kg_creation.assemble_kg.final_graph_creation import graph_create
+from kg_creation.assemble_kg.final_graph_creation import find_graph_store, load_graph_store, graph_store_to_grape
 
 class caseolapLIFT_knowledge_graph:
     def __init__(self, include_STRING: bool, \
@@ -207,6 +208,11 @@ class caseolapLIFT_knowledge_graph:
 
     @staticmethod
     def knowledge_graph():
+        #integer-encoded graph store, if graph_create saved one (npz or parquet)
+        store_path = find_graph_store("./output/graph_data")
+        if store_path is not None:
+            return graph_store_to_grape(load_graph_store(store_path), directed = False)
+
         return Graph.from_csv(node_path ="./output/graph_data/merged_node_list.tsv",
                               node_list_separator = "\t",
                               node_list_header = True,
@@ -7,6 +7,7 @@ import argparse
 import sys
 sys.path.append('..')
 from utils.biomedkg_utils import switch_dictset_to_dictlist
+from text_mining.caseolap._06_textcube import TextCubeBitmaps
 from elasticsearch import Elasticsearch
 from multiprocessing import cpu_count, Process
 
@@ -748,6 +749,10 @@ def update_textcube_files(data_folder='../data/',
     json.dump(new_textcube_pmid2category, open(os.path.join(data_folder, 'textcube_pmid2category.json'), 'w'))
     json.dump(textcube_category2pmid, open(os.path.join(data_folder, 'textcube_category2pmid.json'), 'w'))
 
+    ''' Update textcube bitmaps '''
+    TextCubeBitmaps.from_category2pmids(textcube_category2pmid).save(
+        os.path.join(data_folder, 'textcube_bitmaps.npz'))
+
 
 def get_relevant_all_categorized_pmids(index_name):
     '''
@@ -1,13 +1,306 @@
-import os, sys, re, time, subprocess
+import os, sys, re, time, json, hashlib, ftplib, threading, contextlib
+import urllib.parse, urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 '''
 Download
 '''
-def download_pubmed(data_dir, download_config, ftp_config, logfile):
+class PubMedDownloader(object):
+    '''
+    Downloads the bulk PubMed files (.xml.gz and their .md5) of a remote
+    directory with a bounded number of concurrent transfers. Each file is
+    retried with backoff, partial files (.part) are resumed, and the MD5 is
+    calculated while downloading and checked against the .md5 file.
+    Works with ftp://, http(s)://, file:// URLs and local directories (the
+    latter two are handy stand-ins for testing).
+    '''
+    
+    def __init__(self, logfile, max_transfers=4, retries=5, backoff=2.0, 
+                 timeout=60, chunk_size=1<<20):
+        '''
+        PARAMS:
+        - logfile (file): The place to write the progress of downloading
+        - max_transfers (int): Maximum number of concurrent transfers
+        - retries (int): Attempts per file before it is reported as failed
+        - backoff (float): Seconds to wait after the first failed attempt,
+          doubled after each further failure
+        - timeout (float): Seconds before a stalled connection fails
+        - chunk_size (int): Number of bytes read at a time
+        '''
+        self.logfile = logfile
+        self.max_transfers = max_transfers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        
+        # Progress, shared by the transfer threads
+        self.lock = threading.Lock()
+        self.num_bytes = 0
+        self.num_files_done = 0
+    
+    
+    def print_progress(self, msg):
+        with self.lock:
+            self.logfile.write(msg+'\n')
+            print(msg)
+    
+    
+    '''
+    Remote access
+    '''
+    @contextlib.contextmanager
+    def ftp_connection(self, url):
+        parsed = urllib.parse.urlparse(url)
+        ftp = ftplib.FTP(parsed.hostname, timeout=self.timeout)
+        try:
+            ftp.login()
+            ftp.voidcmd('TYPE I')
+            yield ftp, parsed.path
+        finally:
+            try:
+                ftp.quit()
+            except (OSError, ftplib.Error):
+                ftp.close()
+    
+    
+    def list_remote(self, url):
+        '''
+        FUNCTION:
+        - List the file names in a remote directory
+        
+        PARAMS:
+        - url (str): The remote directory
+        
+        OUTPUT:
+        - names (list): File names in the directory
+        '''
+        scheme = urllib.parse.urlparse(url).scheme
+        if scheme == 'ftp':
+            with self.ftp_connection(url) as (ftp, path):
+                return [name.split('/')[-1] for name in ftp.nlst(path)]
+        elif scheme in ('http', 'https'):
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                html = response.read().decode('utf-8', 'replace')
+            return sorted(set(re.findall(r'href="([^"/?]+)"', html)))
+        else:
+            return os.listdir(self.local_path(url))
+    
+    
+    def local_path(self, url):
+        # file:// URL or local path
+        if url.startswith('file://'):
+            return urllib.parse.unquote(urllib.parse.urlparse(url).path)
+        return url
+    
+    
+    def remote_size(self, url):
+        '''
+        FUNCTION:
+        - Get the size of a remote file, or None if the server doesn't tell
+        
+        PARAMS:
+        - url (str): The remote file
+        '''
+        scheme = urllib.parse.urlparse(url).scheme
+        try:
+            if scheme == 'ftp':
+                with self.ftp_connection(url) as (ftp, path):
+                    return ftp.size(path)
+            elif scheme in ('http', 'https'):
+                request = urllib.request.Request(url, method='HEAD')
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    size = response.headers.get('Content-Length')
+                    return int(size) if size is not None else None
+            else:
+                return os.path.getsize(self.local_path(url))
+        except (OSError, ftplib.Error, ValueError):
+            return None
+    
+    
+    @contextlib.contextmanager
+    def open_remote(self, url, offset=0):
+        '''
+        FUNCTION:
+        - Open a remote file for reading, starting at a byte offset (to 
+          resume a partial download) if the server supports it.
+        
+        PARAMS:
+        - url (str): The remote file
+        - offset (int): Byte offset to start from
+        
+        OUTPUT:
+        - (stream, offset): The stream and the offset it actually starts at
+        '''
+        scheme = urllib.parse.urlparse(url).scheme
+        if scheme == 'ftp':
+            with self.ftp_connection(url) as (ftp, path):
+                conn = ftp.transfercmd('RETR '+path, rest=offset or None)
+                try:
+                    with conn.makefile('rb') as stream:
+                        yield stream, offset
+                finally:
+                    conn.close()
+                ftp.voidresp()
+        elif scheme in ('http', 'https'):
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            request = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                # The server ignored the range, start over
+                if offset and response.status != 206:
+                    offset = 0
+                yield response, offset
+        else:
+            with open(self.local_path(url), 'rb') as stream:
+                stream.seek(offset)
+                yield stream, offset
+    
+    
+    def read_remote(self, url):
+        with self.open_remote(url) as (stream, offset):
+            return stream.read()
+    
+    
+    '''
+    Download
+    '''
+    def download_file(self, url, local_file):
+        '''
+        FUNCTION:
+        - Download one file (with its .md5 file), retrying with backoff. A
+          partial download (local_file.part) is resumed. The file is only
+          renamed to local_file once its MD5 matches the .md5 file.
+        
+        PARAMS:
+        - url (str): The remote file
+        - local_file (str): Where the file will be saved
+        
+        OUTPUT:
+        - status (str): 'downloaded', 'skipped' (already complete) or 'failed'
+        '''
+        part_file = local_file+'.part'
+        name = os.path.basename(local_file)
+        
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(self.backoff * 2**(attempt-1))
+            try:
+                # Get the expected MD5
+                md5_text = self.read_remote(url+'.md5').decode('utf-8', 'replace')
+                expected_md5 = re.search('[0-9a-f]{32}', md5_text)
+                if expected_md5 is None:
+                    raise ValueError('no md5 found in '+name+'.md5')
+                expected_md5 = expected_md5.group(0)
+                
+                # Skip files that were already downloaded
+                remote_size = self.remote_size(url)
+                if os.path.isfile(local_file) and remote_size is not None and \
+                   os.path.getsize(local_file) == remote_size:
+                    with open(local_file+'.md5', 'w') as fout:
+                        fout.write(md5_text)
+                    return 'skipped'
+                
+                # Hash the partial file before resuming it
+                md5 = hashlib.md5()
+                offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+                if offset and remote_size is not None and offset > remote_size:
+                    offset = 0
+                with open(part_file, 'ab') as fout:
+                    fout.truncate(offset)
+                with open(part_file, 'rb') as fin:
+                    for chunk in iter(lambda: fin.read(self.chunk_size), b''):
+                        md5.update(chunk)
+                
+                # Download the rest, hashing as it arrives
+                with self.open_remote(url, offset) as (stream, offset):
+                    if offset == 0:
+                        md5 = hashlib.md5()
+                    with open(part_file, 'r+b') as fout:
+                        fout.truncate(offset)
+                        fout.seek(offset)
+                        for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                            fout.write(chunk)
+                            md5.update(chunk)
+                            with self.lock:
+                                self.num_bytes += len(chunk)
+                
+                # Verify
+                if md5.hexdigest() != expected_md5:
+                    os.remove(part_file)
+                    raise ValueError('md5 check failed for '+name)
+                os.replace(part_file, local_file)
+                with open(local_file+'.md5', 'w') as fout:
+                    fout.write(md5_text)
+                return 'downloaded'
+            
+            except (OSError, EOFError, ftplib.Error, ValueError) as e:
+                self.print_progress('Attempt '+str(attempt+1)+'/'+str(self.retries)+\
+                                    ' failed for '+name+': '+str(e))
+        return 'failed'
+    
+    
+    def download_dir(self, url, local_dir, names=None):
+        '''
+        FUNCTION:
+        - Download all the bulk PubMed files of a remote directory with
+          concurrent transfers, reporting progress and throughput.
+        
+        PARAMS:
+        - url (str): The remote directory
+        - local_dir (str): Where the files will be saved
+        - names (list): Only download these file names (optional)
+        
+        OUTPUT:
+        - report (dict): File names 'downloaded', 'skipped' and 'failed', 
+          plus the number of 'bytes' and 'seconds'
+        '''
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        url = url.rstrip('/')+'/'
+        t1 = time.time()
+        start_bytes = self.num_bytes
+        
+        # Bulk files in the remote directory
+        remote_names = sorted(name for name in self.list_remote(url) 
+                              if re.search(r'\.xml\.gz$', name))
+        wanted = set(remote_names if names is None else names)
+        names = [name for name in remote_names if name in wanted]
+        self.print_progress('Downloading '+str(len(names))+' files from '+url+\
+                            ' ('+str(self.max_transfers)+' concurrent transfers)')
+        
+        # Download with a bounded number of concurrent transfers
+        report = {'downloaded':[], 'skipped':[], 'failed':[]}
+        with ThreadPoolExecutor(max_workers=self.max_transfers) as executor:
+            futures = {executor.submit(self.download_file, url+name, 
+                                       os.path.join(local_dir, name)): name 
+                       for name in names}
+            for file_count, future in enumerate(as_completed(futures), 1):
+                report[future.result()].append(futures[future])
+                
+                # Print progress every 20 files
+                if file_count % 20 == 0 or file_count == len(names):
+                    seconds = time.time() - t1
+                    mb = (self.num_bytes - start_bytes) / 1e6
+                    self.print_progress(str(file_count)+'/'+str(len(names))+' files, '+\
+                                        str(round(mb))+' MB in '+str(round(seconds))+\
+                                        ' seconds ('+str(round(mb/max(seconds,1e-9),2))+' MB/s)')
+        
+        report['bytes'] = self.num_bytes - start_bytes
+        report['seconds'] = round(time.time() - t1, 1)
+        for key in ('downloaded', 'skipped', 'failed'):
+            report[key].sort()
+        return report
+
+
+
+def download_pubmed(data_dir, download_config, ftp_config, logfile, max_transfers=4):
     '''
     FUNCTION:
     - Downloads PubMed's 'baseline' files and 'update' files. Baseline
       files are from all previous years. Update files are from this year.
+    - Files are saved under data_dir like a recursive wget (e.g., 
+      data_dir/ftp.ncbi.nlm.nih.gov/pubmed/baseline/). Re-running resumes
+      partial files and skips complete ones.
       
     PARAMS:
     - data_dir (str): The main directory which will contain folders for both
@@ -16,157 +309,209 @@ def download_pubmed(data_dir, download_config, ftp_config, logfile):
     - download_config (json): Indicates whether to download baseline and/or 
       update. True/False  
     - logfile (file): The place to write the progress of downloading
+    - max_transfers (int): Maximum number of concurrent transfers
+    
+    OUTPUT:
+    - reports (dict): 'baseline'/'update' -> download report
     '''
-     
+    downloader = PubMedDownloader(logfile, max_transfers=max_transfers)
+    reports = dict()
+    
+    for ndir in ('baseline', 'update'):
+        if not download_config[ndir]:
+            continue
         
-    ''' Download Baseline'''
-    if download_config['baseline']:
-
-       # Time before download
-        t1 = time.time()
-
         # Print progress
-        msg = str('Downloading baseline files from '+ ftp_config['baseline'])
+        msg = str('Downloading '+ndir+' files from '+ ftp_config[ndir])
         print(msg +' For details, see the download logfile')
         logfile.write(msg +'\n')
-
-        # Download files
-        return_code = os.system('wget -N -q -r --directory-prefix='+data_dir+\
-                       ' --no-parent '+ftp_config['baseline'])
-
-        # Check for download error
-        if return_code != 0:
-            msg = str('Error (Baseline file download): Return code:'+str(return_code)+\
-                  '\n Link: ' + ftp_config['baseline']+'\n')
-            logfile.write(msg)
-            exit(return_code)
-
+        
+        # Download files (same folders as 'wget -r')
+        parsed = urllib.parse.urlparse(ftp_config[ndir])
+        local_dir = os.path.join(data_dir, parsed.netloc, parsed.path.lstrip('/'))
+        report = downloader.download_dir(ftp_config[ndir], local_dir)
+        reports[ndir] = report
+        
         # Print progress 
-        msg = str('Finished downloading PubMed baseline files. '+\
-                  str(round(time.time() - t1))+' seconds')
+        msg = str('Finished downloading PubMed '+ndir+' files. '+\
+                  str(len(report['downloaded']))+' downloaded, '+\
+                  str(len(report['skipped']))+' already complete, '+\
+                  str(len(report['failed']))+' failed. '+\
+                  str(round(report['seconds']))+' seconds')
         logfile.write(msg +'\n') 
         print(msg)
-
-
-
-    ''' Download updatefiles'''
-    if download_config['update']:
-
-        # Time before download
-        t2 = time.time()        
-
-        # Print progress
-        msg = str('Downloading update files from '+ ftp_config['update'])
-        print(msg + ' For details, see the download logfile')
-        logfile.write(msg+'\n')
-
-        # Download files
-        return_code = os.system(str('wget -N -q -r --directory-prefix='+data_dir+\
-                               ' --no-parent '+ftp_config['update']))
-
-        # Check for download error
-        if return_code != 0:
-            msg = str('Error: Update file download. Return code:'+str(return_code)+\
-                  '\n Link: ' + ftp_config['update']+'\n')
+        
+        # Check for download errors. Re-running resumes the download.
+        if report['failed']:
+            msg = str('Error ('+ndir+' file download): '+str(len(report['failed']))+\
+                  ' files failed: '+' '.join(report['failed'])+\
+                  '\n Link: ' + ftp_config[ndir]+'\n')
             logfile.write(msg)
-            exit(return_code)
-
-        #  Report progress
-        msg = str('Finished downloading PubMed update files.'+\
-              str(round(time.time() - t1))+' seconds')
-        logfile.write(msg+'\n')
-        print(msg)
-       
-
+            print(msg)
+            exit(1)
+    
+    return reports
+    
     
     
     
 '''
 MD5-checksum 
 '''
-def check_all_md5_in_dir(data_dir, logfile, mac, linux):
+def file_md5(file, chunk_size=1<<20):
     '''
     FUNCTION:
-    - Verify the downloaded PubMed article files via md5sum, verifies MD5 hashes.
+    - Calculate the MD5 hash of a file, reading it in chunks so the whole
+      file is never held in memory.
     
     PARAMS:
-    - data_dir (str): The main directory which will contain folders for both
-      the baseline and update files.
-    - logfile (file): The place to write the progress of downloading
-    - mac (bool): Indicate if this is a MacOS
-    - linux (bool): Indicate if this is a LinuxOS
+    - file (str): Path of the file to hash
+    - chunk_size (int): Number of bytes read at a time
+    
+    OUTPUT:
+    - md5 (str): Hex digest of the file's MD5 hash
+    '''
+    md5 = hashlib.md5()
+    with open(file, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def check_all_md5_in_dir(data_dir, logfile, workers=4, report_path=None):
     '''
+    FUNCTION:
+    - Verify the downloaded PubMed article files against their .md5 files.
+      Files are hashed in-process by a pool of threads (hashlib releases
+      the GIL while hashing). A failed file does not stop the others; all
+      results are collected in a report, so only the failed files need to
+      be downloaded again.
     
-    # Current year, last two suffix
-    year = '22'
+    PARAMS:
+    - data_dir (str): The directory with the downloaded .xml.gz files
+    - logfile (file): The place to write the progress of downloading
+    - workers (int): Number of files hashed at a time
+    - report_path (str): Where the report is saved as JSON (optional)
     
-    # Check if the md5sum exists
-    if os.system("which md5sum 1>/dev/null") != 0:
-        print("md5sum not found")           
-        # Continue executing
-        return
+    OUTPUT:
+    - report (dict): 'dir', 'passed' (file names), 'failed' (file name, 
+      reason, expected and calculated MD5) and 'seconds'
+    '''
+    report = {'dir': data_dir, 'passed': [], 'failed': [], 'seconds': 0}
+    
+    # If the main 'data' directory doesn't exist, print that. 
+    if not os.path.isdir(data_dir):
+        msg = str('Directory not found: '+data_dir+' (for md5 check)')
+        logfile.write(msg+'\n')
+        print(msg)
+        return report
     
     # Print progress starting checking md5
     msg = str('==== Start checking md5 in '+data_dir+' ====')
     logfile.write(msg+'\n')
     print(msg)
+    t1 = time.time()
     
-    # If the main 'data' directory exists
-    if os.path.isdir(data_dir):
-        file_count = 0
-
-        # Iterate through each downloaded PubMed file
-        for file in os.listdir(data_dir):
+    # The downloaded zipped files containing PubMed articles (any year)
+    files = sorted(file for file in os.listdir(data_dir) 
+                   if re.search(r'^pubmed\d\dn\d\d\d\d\.xml\.gz$', file))
+    
+    # Hash the files in parallel
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(check_md5, os.path.join(data_dir, file)) for file in files]
+        for file_count, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            if result['status'] == 'passed':
+                report['passed'].append(result['file'])
+            else:
+                report['failed'].append(result)
+                msg = str('md5 check failed for '+result['file']+': '+result['reason'])
+                logfile.write(msg+'\n')
+                print(msg)
             
-            # Check if the downloaded file is a zipped file containing PubMed articles
-            if re.search('^pubmed'+year+'n\d\d\d\d.xml.gz$', file):
-                
-                # If this .xml.gz file and its .md5 file pass the md5 check, proceed
-                check_md5(os.path.join(data_dir, file), mac, linux)
-                
-                # Print progress checking md5
-                file_count += 1
-                if file_count % 100 == 0:
-                    print(str(file_count) +' files checked')
-        
-        # Print final progress of md5 checking
-        msg = str('==== All md5 checks succeeded ('+str(file_count)+' files) ====\n')
-        logfile.write(msg)
-        print(msg)
-        
-        
-    # If the main 'data' directory doesn't exist, print that. 
-    else:
-        print("Directory not found: %s (for md5 check)" % data_dir)
-        logfile.write("==== Succeessful md5 checks (%d files) ====" % file_count+'\n')
+            # Print progress checking md5
+            if file_count % 100 == 0:
+                print(str(file_count) +' files checked')
+    
+    report['passed'].sort()
+    report['failed'].sort(key=lambda result: result['file'])
+    report['seconds'] = round(time.time() - t1, 1)
+    
+    # Save the report
+    if report_path is not None:
+        with open(report_path+'.tmp', 'w') as fout:
+            json.dump(report, fout, indent=2)
+        os.replace(report_path+'.tmp', report_path)
+    
+    # Print final progress of md5 checking
+    msg = str('==== md5 checks: '+str(len(report['passed']))+' passed, '+\
+              str(len(report['failed']))+' failed ('+str(report['seconds'])+' seconds) ====\n')
+    logfile.write(msg)
+    print(msg)
+    return report
         
 
-def check_md5(file, mac, linux):
+def check_md5(file):
     '''
     FUNCTON:
     - Verify one file via md5 
     
     PARAMS:
-    - file (file): Zipped file containing PubMed articles
-    - mac (bool): Indicate if this is a MacOS
-    - linux (bool): Indicate if this is a LinuxOS
-    '''
-    if os.path.isfile(file) and os.path.isfile(file + ".md5"):
-        
-        # Get md5 output from the zipped .xml
-        if linux == True:
-            stdout = subprocess.check_output('md5sum '+file, shell=True).decode('utf-8')
-        elif mac == True:
-            stdout = subprocess.check_output('md5 '+file, shell=True).decode('utf-8')
-        md5_calculated = re.search('[0-9a-f]{32}', stdout).group(0)
-
+    - file (str): Zipped file containing PubMed articles
+    
+    OUTPUT:
+    - result (dict): 'file' (name), 'status' ('passed' or 'failed'),
+      'reason', 'expected' and 'calculated' MD5
+    '''
+    result = {'file': os.path.basename(file), 'status': 'failed', 'reason': '',
+              'expected': None, 'calculated': None}
+    try:
         # Get md5 output from the corresponding .md5 file
-        md5 = re.search('[0-9a-f]{32}', open(file + '.md5', 'r').readline()).group(0)
+        with open(file + '.md5', 'r') as fin:
+            expected = re.search('[0-9a-f]{32}', fin.read())
+        if expected is None:
+            result['reason'] = 'no md5 found in .md5 file'
+            return result
+        result['expected'] = expected.group(0)
+        
+        # Get md5 of the zipped .xml
+        result['calculated'] = file_md5(file)
+    except OSError as e:
+        result['reason'] = str(e)
+        return result
 
-        # Check if the md5 are equal
-        if md5 != md5_calculated:
-            raise Exception('Error: md5 check failed for '+ file)
-            exit(1)
+    # Check if the md5 are equal
+    if result['expected'] != result['calculated']:
+        result['reason'] = 'md5 mismatch'
+    else:
+        result['status'] = 'passed'
+    return result
+
+
+def redownload_failed(report, url, logfile, max_transfers=4):
+    '''
+    FUNCTION:
+    - Download again only the files that failed the md5 check.
+    
+    PARAMS:
+    - report (dict): Report of check_all_md5_in_dir
+    - url (str): The remote directory the files came from
+    - logfile (file): The place to write the progress of downloading
+    - max_transfers (int): Maximum number of concurrent transfers
+    
+    OUTPUT:
+    - download_report (dict): Report of PubMedDownloader.download_dir
+    '''
+    names = [result['file'] for result in report['failed']]
+    
+    # Remove the bad copies, otherwise they would count as complete
+    for name in names:
+        for file in (name, name+'.md5', name+'.part'):
+            if os.path.isfile(os.path.join(report['dir'], file)):
+                os.remove(os.path.join(report['dir'], file))
+    
+    downloader = PubMedDownloader(logfile, max_transfers=max_transfers)
+    return downloader.download_dir(url, report['dir'], names=names)
             
             
             
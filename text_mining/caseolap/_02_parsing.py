@@ -1,21 +1,27 @@
-import re, itertools, json, sys, os, time, datetime, traceback
+import re, itertools, json, sys, os, io, time, datetime, traceback, gzip, shutil, sqlite3
+from multiprocessing import cpu_count, Pool
 from lxml import etree
+from text_mining.caseolap._01_download import file_md5
 
 # Parses the PubMed documents
 class Parser(object):
-    def __init__(self, file, pubmed_output_file, filestat_output_file, parsing_config):
+    def __init__(self, file, pubmed_output_file, filestat_output_file, parsing_config,
+                 deleted_output_file=None, columnar_output=None):
         # Input
         self.file = file
         self.fname = file.split('/')[-1].split('.')[0]
         
         self.pubmed_output_file = pubmed_output_file
         self.filestat_output_file = filestat_output_file
+        self.deleted_output_file = deleted_output_file
+        self.columnar_output = columnar_output
         self.parsing_config = parsing_config
         self.full_text_data = dict() #json.load(open("caseolap/pmid_fulltext_v1.json","r")) 
         
         # Containers
         self.filestat = {}
         self.result = {}
+        self.deleted_pmids = []
     
     
     '''''''''''''''''
@@ -29,9 +35,12 @@ class Parser(object):
           different elements (e.g., author name, PMID)
          
         PARAMS:
-        - element: The element/node in the xml structure
+        - element: The element/node in the xml structure (None if the
+          record doesn't have it, e.g., a book has no Journal)
         - tag: The name of the element's section (e.g., 'LastName')
         '''
+        if element is None:
+            return ''
         e = element.find(tag)
         if e is not None:
             return e.text
@@ -123,16 +132,17 @@ class Parser(object):
           
         
     # Get the publishing date
-    def get_publishing_date(self, journal):
+    def get_publishing_date(self, journal, pre='.//JournalIssue/PubDate/'):
         '''
         FUNCTION:
         - Get the date the article was published
         - Save it to the class object
 
         PARAMS:
-        - journal:
+        - journal: Journal element (or Book element of a book record, with
+          pre='PubDate/'). If None, the date is empty.
+        - pre: Path of the PubDate element in it
         '''
-        pre = './/JournalIssue/PubDate/'
         if self.parsing_config['date']:
             self.result['PubDate'] = dict()
             self.result['PubDate']['Year']   = self.get_text(journal, pre+'Year')
@@ -193,7 +203,23 @@ class Parser(object):
         unique_filepmids = list(set(filepmids))
         file_counts = len(unique_filepmids)
         self.filestat.update({'fname':str(self.fname),
-                              'pmids':file_counts})
+                              'pmids':file_counts,
+                              'deleted':len(self.deleted_pmids)})
+    
+    
+    # Get the PMIDs of deleted citations (update files only)
+    def get_deleted_pmids(self, delete_citation):
+        '''
+        FUNCTION:
+        - Get the PMIDs listed in a DeleteCitation element. These articles
+          were deleted from PubMed after an earlier bulk file included them.
+        - Save them to the class object
+        
+        PARAMS:
+        - delete_citation: DeleteCitation element in the xml structure
+        '''
+        for pmid in delete_citation.findall('PMID'):
+            self.deleted_pmids.append(pmid.text)
     
     
     # Get the full article text (0 or 1 occurence)
@@ -212,11 +238,116 @@ class Parser(object):
             if full_text is not None:
                 self.result["full_text"] = full_text
 
+    '''
+    Read one bulk file of PubMed publications
+    '''
+    def open_bulk_file(self):
+        '''
+        FUNCTION:
+        - Open the bulk file for reading. Zipped files (.xml.gz) are 
+          decompressed on the fly, so they don't need to be extracted first.
+        '''
+        if self.file.endswith('.gz'):
+            return gzip.open(self.file, 'rb')
+        return open(self.file, 'rb')
+    
+    
+    def iter_articles(self, tree_file):
+        '''
+        FUNCTION:
+        - Stream the articles of a bulk file one at a time (iterparse). Each
+          article element is cleared after it is used, along with the 
+          already-parsed articles before it, so memory stays flat 
+          regardless of the file size.
+        
+        PARAMS:
+        - tree_file: Opened bulk file (binary)
+        '''
+        context = etree.iterparse(tree_file, events=('end',), 
+                                  tag=('PubmedArticle', 'BookDocument',
+                                       'DeleteCitation'))
+        for event, article in context:
+            if article.tag == 'DeleteCitation':
+                self.get_deleted_pmids(article)
+            else:
+                yield article
+            
+            # Free the article and the articles parsed before it
+            article.clear(keep_tail=True)
+            while article.getprevious() is not None:
+                del article.getparent()[0]
+        del context
+    
+    
+    def parse_article(self, article):
+        '''
+        FUNCTION:
+        - Get the information from multiple fields of one article (e.g., 
+          PMID, title, abstract, MeSH) and dump it to the PubMed json file.
+        
+        PARAMS:
+        - article: PubmedArticle or BookDocument (of a PubmedBookArticle)
+          element in the xml structure
+        
+        OUTPUT:
+        - pmid: The PubMed ID
+        '''
+        # Get PMID
+        pmid = self.get_pmid(article)
+
+        # Get Title
+        if self.parsing_config['title']:
+            self.get_title(article)
+
+        # Get Abstract    
+        if self.parsing_config['abstract']:    
+            self.get_abstract(article,pmid)
+
+        # Get MeSH    
+        if self.parsing_config['MeSH']:    
+            self.get_MeSH(article,pmid)
+
+        # Get full text (if available)
+        if self.parsing_config['full_text']:    
+            self.get_fulltext()
+
+        # Author List 
+        if self.parsing_config['author']:
+            authors = article.findall('.//Author')
+            self.result['AuthorList'] = self.parse_author(authors)
+
+        # Journal (book records have a Book instead)
+        journal = article.find('.//Journal')
+        if self.parsing_config['journal']:
+            self.result['Journal'] = self.get_text(journal, 'Title')
+
+        # Publishing Date
+        if self.parsing_config['date']:
+            if journal is not None:
+                self.get_publishing_date(journal)
+            else:
+                self.get_publishing_date(article.find('.//Book'), pre='PubDate/')
+
+        # Country Published
+        if self.parsing_config['location']:
+            country = article.find('.//MedlineJournalInfo')
+            self.result['Country'] = self.get_text(country, 'Country')
+
+        # Dump to the PubMed json file 
+        json.dump(self.result, self.pubmed_output_file)
+        self.pubmed_output_file.write('\n')
+        
+        # Add to the columnar (Parquet) output
+        if self.columnar_output is not None:
+            self.columnar_output.write(self.result)
+        return pmid
+    
+    
     '''
     Parse one bulk file of PubMed publications
     '''
     ### Parse pubmed ###
-    def parse_pubmed_file(self, logfile):
+    def parse_pubmed_file(self, logfile, streaming=False):
         '''
         FUNCTION:
         - This parses through articles in a bulk. It gets information from 
@@ -225,87 +356,291 @@ class Parser(object):
         
         PARAMS:
         - logfile: Log file tracking the parsing progress
+        - streaming (bool): Parse one article at a time (iterparse) instead
+          of building the whole file's xml tree first. Keeps memory flat.
         '''
         sys.stdout.flush()
         t1 = time.time()
         
         # Parse the publications' .xml formats
-        tree_file = open(self.file, 'r')
-        tree = etree.parse(tree_file)
+        tree_file = self.open_bulk_file()
         
-        filepmids = []
-        full_text_data = self.full_text_data
-
         # Get all PubMed articles and documents
-        articles = itertools.chain(tree.findall('PubmedArticle'), 
-                                   tree.findall('BookDocument'))
+        if streaming:
+            articles = self.iter_articles(tree_file)
+        else:
+            tree = etree.parse(tree_file)
+            # Articles and book documents, in file order (as when streaming)
+            articles = tree.xpath('PubmedArticle | PubmedBookArticle/BookDocument')
+            for delete_citation in tree.findall('DeleteCitation'):
+                self.get_deleted_pmids(delete_citation)
     
         # Get info on each article
-        for article_count, article in enumerate(articles):                
-            
-            # Get PMID
-            pmid = self.get_pmid(article)
-            filepmids.append(pmid)
-
-            # Get Title
-            if self.parsing_config['title']:
-                self.get_title(article)
-
-            # Get Abstract    
-            if self.parsing_config['abstract']:    
-                self.get_abstract(article,pmid)
-
-            # Get MeSH    
-            if self.parsing_config['MeSH']:    
-                self.get_MeSH(article,pmid)
-
-            # Get full text (if available)
-            if self.parsing_config['full_text']:    
-                self.get_fulltext()
-
-            # Author List 
-            if self.parsing_config['author']:
-                authors = article.findall('.//Author')
-                self.result['AuthorList'] = self.parse_author(authors)
-
-            # Journal
-            if self.parsing_config['journal']:
-                journal = article.find('.//Journal')
-                self.result['Journal'] = self.get_text(journal, 'Title')
-
-            # Publishing Date
-            if self.parsing_config['date']:
-                self.get_publishing_date(journal)
-
-            # Country Published
-            if self.parsing_config['location']:
-                country = article.find('.//MedlineJournalInfo')
-                self.result['Country'] = self.get_text(country, 'Country')
-
-            # Dump to the PubMed json file 
-            json.dump(self.result, self.pubmed_output_file)
-            self.pubmed_output_file.write('\n')
-
+        filepmids = []
+        article_count = 0
+        for article in articles:                
+            filepmids.append(self.parse_article(article))
+            article_count += 1
                 
         self.get_filestat(filepmids)  
         
+        # Dump the deleted PMIDs, one per line
+        if self.deleted_output_file is not None:
+            for pmid in self.deleted_pmids:
+                self.deleted_output_file.write(pmid+'\n')
+        
         # Dump to the PubMed stat json file 
         json.dump(self.filestat, self.filestat_output_file)
         self.filestat_output_file.write('\n')
         t2 = time.time()
         
-        msg = 'Parsing finished. '+str(article_count)+' articles parsed.'\
+        msg = 'Parsing finished. '+str(article_count)+' articles parsed, '\
+              +str(len(self.deleted_pmids))+' deleted citations. '\
               +'Total time: ' + str(t2 - t1)
         print(msg)
         logfile.write(msg + '\n')
         tree_file.close()                          
 
     
+'''
+Columnar (Parquet) output of the parsed PubMed documents
+'''
+# Parsed JSON field -> Parquet column
+PARQUET_FIELDS = {'PMID':'pmid', 'ArticleTitle':'title', 'Abstract':'abstract',
+                  'full_text':'full_text', 'Year':'year', 'PubDate':'pub_date',
+                  'MeshHeadingList':'mesh', 'Journal':'journal', 
+                  'Country':'country', 'AuthorList':'authors'}
+AUTHOR_NAME_PARTS = ['LastName', 'ForeName', 'Initials', 'Suffix', 'CollectiveName']
+
+
+def get_year(pub_date):
+    '''
+    FUNCTION:
+    - Get the publication year from a parsed publishing date. Falls back to
+      the first word of the MedlineDate (e.g., '1998 Dec-1999 Jan').
+    
+    PARAMS:
+    - pub_date (dict): Parsed publishing date ('Year', 'MedlineDate', ...)
+    
+    OUTPUT:
+    - year (int): The year, or -1 if there is none
+    '''
+    try:
+        return int(pub_date['Year'])
+    except:
+        try:
+            return int(pub_date['MedlineDate'].split(' ')[0])
+        except:
+            return -1
+
+
+class ColumnarWriter(object):
+    '''
+    Writes parsed articles to a Parquet file, one column per field, so
+    later steps can read only the columns they need. Requires pyarrow.
+    '''
+    
+    def __init__(self, path, batch_size=10000):
+        '''
+        PARAMS:
+        - path (str): Output Parquet file. Written to a temp file which is
+          renamed when the writer is closed.
+        - batch_size (int): Number of articles per Parquet row group
+        '''
+        try:
+            import pyarrow as pa, pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is needed for the columnar (Parquet) output. '
+                              'Install it with: pip install pyarrow')
+        self.pa = pa
+        author = pa.struct([(part, pa.string()) for part in AUTHOR_NAME_PARTS])
+        self.schema = pa.schema([('pmid', pa.string()), ('title', pa.string()),
+                                 ('abstract', pa.string()), ('full_text', pa.string()),
+                                 ('year', pa.int32()), ('pub_date', pa.string()),
+                                 ('mesh', pa.list_(pa.string())), ('journal', pa.string()),
+                                 ('country', pa.string()), ('authors', pa.list_(author))])
+        self.path = path
+        self.batch_size = batch_size
+        self.columns = {name: [] for name in self.schema.names}
+        self.writer = pq.ParquetWriter(path+'.tmp', self.schema)
+    
+    
+    def write(self, result):
+        '''
+        FUNCTION:
+        - Add one parsed article (Parser.result) to the output
+        
+        PARAMS:
+        - result (dict): Parsed article fields (e.g., 'PMID', 'Abstract')
+        '''
+        pub_date = result.get('PubDate', {})
+        self.columns['pmid'].append(result.get('PMID', '-1'))
+        self.columns['title'].append(result.get('ArticleTitle'))
+        self.columns['abstract'].append(result.get('Abstract', ''))
+        self.columns['full_text'].append(result.get('full_text', ''))
+        self.columns['year'].append(get_year(pub_date))
+        self.columns['pub_date'].append(json.dumps(pub_date))
+        self.columns['mesh'].append(list(result.get('MeshHeadingList', [])))
+        self.columns['journal'].append(result.get('Journal'))
+        self.columns['country'].append(result.get('Country'))
+        self.columns['authors'].append(list(result.get('AuthorList', [])))
+        if len(self.columns['pmid']) >= self.batch_size:
+            self.flush()
+    
+    
+    def flush(self):
+        '''
+        FUNCTION:
+        - Write the buffered articles as one row group
+        '''
+        if len(self.columns['pmid']) > 0:
+            table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+            self.writer.write_table(table)
+            self.columns = {name: [] for name in self.schema.names}
+    
+    
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.path+'.tmp', self.path)
+
+
+
+# Start of a parsed JSON line (json.dump of Parser.result), to read the PMID
+JSON_PMID_PREFIX = re.compile(r'^\{"PMID": "(\d+)"')
+
+
+def iter_parsed_records(parsed_path, fields, part=0, num_parts=1, pmids=None, years=None):
+    '''
+    FUNCTION:
+    - Iterate the parsed PubMed documents, reading only the requested 
+      fields. parsed_path is either the JSON file (one document per line)
+      or a directory of Parquet files (one per bulk file), from which only
+      the needed columns are read.
+    - The documents can be split into num_parts parts (e.g., one per 
+      process), only iterating part number 'part': every num_parts-th line
+      of the JSON file, or every num_parts-th Parquet file.
+    - The documents can be filtered by PMID and year before the other 
+      fields are read: JSON lines of other PMIDs are skipped before being 
+      loaded, and from Parquet the PMID and year columns are read first,
+      converting the other columns for the kept rows only.
+    
+    PARAMS:
+    - parsed_path (str): pubmed.json or the Parquet directory
+    - fields (list): Parsed JSON field names (e.g., ['PMID','MeshHeadingList']).
+      'Year' is derived from the publishing date.
+    - part (int): Which part to iterate (0 to num_parts-1)
+    - num_parts (int): Number of parts
+    - pmids (container of str PMIDs, e.g., PMIDBitmap): Only these documents
+    - years (tuple of int): Only documents from years[0] to years[1]
+    
+    OUTPUT:
+    - record (dict): Field -> value, for each document
+    '''
+    # JSON lines
+    if not os.path.isdir(parsed_path):
+        with open(parsed_path) as fin:
+            for document in itertools.islice(fin, part, None, num_parts):
+                
+                # Skip other PMIDs before loading the document
+                if pmids is not None:
+                    match = JSON_PMID_PREFIX.match(document)
+                    if match is not None and match.group(1) not in pmids:
+                        continue
+                
+                record = json.loads(document.strip())
+                if pmids is not None and record.get('PMID', '-1') not in pmids:
+                    continue
+                if 'Year' in fields or years is not None:
+                    record['Year'] = get_year(record.get('PubDate', {}))
+                if years is not None and not years[0] <= record['Year'] <= years[1]:
+                    continue
+                yield record
+        return
+    
+    # Parquet, only the needed columns
+    import pyarrow.parquet as pq
+    columns = [PARQUET_FIELDS[field] for field in fields]
+    files = sorted(file for file in os.listdir(parsed_path) if file.endswith('.parquet'))
+    for file in files[part::num_parts]:
+        parquet_file = pq.ParquetFile(os.path.join(parsed_path, file))
+        
+        # No filter: stream the batches
+        if pmids is None and years is None:
+            for batch in parquet_file.iter_batches(columns=columns):
+                values = [batch.column(column).to_pylist() for column in columns]
+                for row in zip(*values):
+                    record = dict(zip(fields, row))
+                    if 'PubDate' in record:
+                        record['PubDate'] = json.loads(record['PubDate'])
+                    yield record
+            continue
+        
+        # Filter: select the rows of each row group from the PMID and year columns
+        for row_group in range(parquet_file.num_row_groups):
+            keys = parquet_file.read_row_group(row_group, columns=['pmid', 'year'])
+            keep = [(pmids is None or pmid in pmids) and \
+                    (years is None or (year is not None and years[0] <= year <= years[1]))
+                    for pmid, year in zip(keys.column('pmid').to_pylist(),
+                                          keys.column('year').to_pylist())]
+            if not any(keep):
+                continue
+            table = parquet_file.read_row_group(row_group, columns=columns).filter(keep)
+            values = [table.column(column).to_pylist() for column in columns]
+            for row in zip(*values):
+                record = dict(zip(fields, row))
+                if 'PubDate' in record:
+                    record['PubDate'] = json.loads(record['PubDate'])
+                yield record
+
+
+
+
+'''
+Find the bulk files to parse
+'''
+def list_bulk_files(source_dir, streaming=False):
+    '''
+    FUNCTION:
+    - List the bulk PubMed files (e.g., pubmed23n0001.xml) in a directory,
+      sorted by file name. When streaming, zipped files (.xml.gz) are 
+      listed too; if a file exists both zipped and extracted, the extracted
+      one is used.
+    
+    PARAMS:
+    - source_dir (str): Where all the bulk PubMed articles were downloaded to
+    - streaming (bool): Whether zipped files can be parsed directly
+    
+    OUTPUT:
+    - bulk_files (list): File names of the bulk files to parse
+    '''
+    # Get current year so you can download the files from the latest year
+    currentDateTime = datetime.datetime.now()
+    date = currentDateTime.date()
+    year = date.strftime("%Y")
+    YEAR_LAST_TWO = year[-2:]    
+    
+    # NOTE: Check that the year and file name is correct here. 
+    # Sometimes they change both. Check the ftp baseline server
+    extension = r'\.xml(\.gz)?$' if streaming else r'\.xml$'
+    pattern = re.compile(r'^pubmed'+YEAR_LAST_TWO+r'n\d\d\d\d'+extension)
+    
+    # File name without extensions -> file name
+    fname2file = dict()
+    for file in sorted(os.listdir(source_dir)):
+        if pattern.search(file) is not None:
+            fname = file.split('.')[0]
+            if fname not in fname2file or file.endswith('.xml'):
+                fname2file[fname] = file
+            
+    return [fname2file[fname] for fname in sorted(fname2file)]
+
+
 '''
 Parse all bulks, main parsing function
 '''
 def parse_dir(source_dir, pubmed_output_file, filestat_output_file, 
-              ndir, parsing_config, logfile):
+              ndir, parsing_config, logfile, streaming=False):
     '''
     FUNCTION:
     - This iterates through the directory containing the downloaded text. It then calls
@@ -319,21 +654,19 @@ def parse_dir(source_dir, pubmed_output_file, filestat_output_file,
     - filestat_output_file (text wrapper): Where article stats are stored
     - ndir (str): 'baseline' or 'updatefiles', name of directory
     - logfile (text wrapper): Log file of the parsing progress
+    - streaming (bool): Stream each file's articles (iterparse) and read 
+      the zipped .xml.gz files directly, without extracting them first
     '''
     
     ''' Pre-parsing '''
-    # Get current year so you can download the files from the latest year
-    currentDateTime = datetime.datetime.now()
-    date = currentDateTime.date()
-    year = date.strftime("%Y")
-    YEAR_LAST_TWO = year[-2:]    
+    # Check the directory exists
+    if not os.path.isdir(source_dir):
+        print('Directory not found during parsing: '+source_dir)
+        return
         
-    # Finds total .xml files in the directory. The xml files will be parsed.
-    total_files = 0 
-    for filename in os.listdir(source_dir):
-        file = os.path.join(source_dir, filename)
-        if os.path.isfile(file) and file.endswith('.xml'):
-            total_files += 1
+    # Finds the bulk files in the directory. These files will be parsed.
+    bulk_files = list_bulk_files(source_dir, streaming)
+    total_files = len(bulk_files)
  
     # Print progress: starting
     msg = 'Parsing '+ndir+' containing '+str(total_files)+' bulk files\n'
@@ -342,26 +675,560 @@ def parse_dir(source_dir, pubmed_output_file, filestat_output_file,
     
     
     ''' Parsing '''
-    # Iterate through files
-    if os.path.isdir(source_dir):
-        file_count = 0
+    # For each file in the baseline or update file directory
+    for file_count, file in enumerate(bulk_files, 1):
+
+        # Parse
+        PRS = Parser(os.path.join(source_dir, file), pubmed_output_file,
+                     filestat_output_file, parsing_config)
+        PRS.parse_pubmed_file(logfile, streaming=streaming) 
+        
+        # Print progress
+        msg='Parsing '+str(file_count)+'/'+str(total_files)+' from '\
+            + ndir + ':' + file
+        logfile.write(msg + "\n")
+        print(msg)
 
-        # For each file in the baseline or update file directory
-        for file in os.listdir(source_dir):
+
+
+
+'''
+Parse all bulks in parallel, one output shard per bulk file
+'''
+def parse_bulk_file_to_shard(task):
+    '''
+    FUNCTION:
+    - Parse one bulk file into its own shard files (parsed articles and 
+      file stats), so parallel workers never share an output file. This 
+      is the function run by each worker of parse_dirs_parallel.
+    
+    PARAMS:
+    - task (tuple): (source_file, shard_dir, parsing_config, streaming, columnar)
+      where columnar (bool) indicates to also write a Parquet shard
+    
+    OUTPUT:
+    - shard (dict): The bulk file name, its source path, size, mtime and MD5,
+      its shard paths, and the parsing log messages
+    '''
+    source_file, shard_dir, parsing_config, streaming, columnar = task
+    fname = source_file.split('/')[-1].split('.')[0]
+    stat = os.stat(source_file)
+    md5 = file_md5(source_file)
+    pubmed_shard = os.path.join(shard_dir, fname+'.json')
+    filestat_shard = os.path.join(shard_dir, fname+'_filestat.json')
+    deleted_shard = os.path.join(shard_dir, fname+'_deleted.txt')
+    parquet_shard = os.path.join(shard_dir, fname+'.parquet') if columnar else None
+    
+    # Parse to temp files, renamed when finished so no half-written 
+    # shard is ever left under the final name
+    log = io.StringIO()
+    columnar_out = ColumnarWriter(parquet_shard) if columnar else None
+    with open(pubmed_shard+'.tmp', 'w') as pubmed_out, \
+         open(filestat_shard+'.tmp', 'w') as filestat_out, \
+         open(deleted_shard+'.tmp', 'w') as deleted_out:
+        PRS = Parser(source_file, pubmed_out, filestat_out, parsing_config,
+                     deleted_output_file=deleted_out, columnar_output=columnar_out)
+        PRS.parse_pubmed_file(log, streaming=streaming)
+    if columnar_out is not None:
+        columnar_out.close()
+    os.replace(pubmed_shard+'.tmp', pubmed_shard)
+    os.replace(filestat_shard+'.tmp', filestat_shard)
+    os.replace(deleted_shard+'.tmp', deleted_shard)
+    
+    return {'fname':fname, 'source':source_file, 'size':stat.st_size,
+            'mtime':stat.st_mtime, 'md5':md5, 'pubmed_shard':pubmed_shard,
+            'filestat_shard':filestat_shard, 'deleted_shard':deleted_shard,
+            'parquet_shard':parquet_shard, 'log':log.getvalue()}
+
+
+
+class ParseManifest(object):
+    '''
+    Records, for each parsed bulk file, its size, mtime, MD5 and where its
+    output shards are. A bulk file whose content is unchanged since it was
+    parsed (with the same parsing config) doesn't need to be parsed again.
+    The manifest is saved after every shard, so a crashed run can resume.
+    '''
+    
+    def __init__(self, manifest_path, parsing_config, columnar=False):
+        '''
+        PARAMS:
+        - manifest_path (str): Where the manifest (JSON) is stored
+        - parsing_config (dict): A dictionary indicating which fields to parse.
+          Shards parsed with a different config are not reused.
+        - columnar (bool): Whether shards also need their Parquet file
+        '''
+        self.manifest_path = manifest_path
+        self.parsing_config = parsing_config
+        self.shard_keys = ['pubmed_shard', 'filestat_shard', 'deleted_shard']
+        if columnar:
+            self.shard_keys.append('parquet_shard')
+        self.files = dict()   # fname -> shard dictionary (without the log)
+        
+        if os.path.isfile(manifest_path):
+            manifest = json.load(open(manifest_path))
+            if manifest.get('parsing_config') == parsing_config:
+                self.files = manifest['files']
+    
+    
+    def get_current_shard(self, source_file):
+        '''
+        FUNCTION:
+        - Get the recorded shard of a bulk file if it can be reused: the 
+          shard files exist and the bulk file is unchanged. The size and
+          mtime are checked first; the MD5 is only recalculated when the 
+          size is the same but the mtime changed (e.g., re-downloaded).
+        
+        PARAMS:
+        - source_file (str): Path of the bulk file
+        
+        OUTPUT:
+        - shard (dict): The recorded shard, or None if the file must be parsed
+        '''
+        fname = source_file.split('/')[-1].split('.')[0]
+        shard = self.files.get(fname)
+        if shard is None or shard['source'] != source_file:
+            return None
+        for shard_key in self.shard_keys:
+            if not os.path.isfile(shard.get(shard_key) or ''):
+                return None
+        
+        # Compare the bulk file with the recorded one
+        stat = os.stat(source_file)
+        if stat.st_size != shard['size']:
+            return None
+        if stat.st_mtime != shard['mtime']:
+            if file_md5(source_file) != shard['md5']:
+                return None
+            shard['mtime'] = stat.st_mtime
+        return shard
+    
+    
+    def record(self, shard):
+        '''
+        FUNCTION:
+        - Record a newly parsed shard and save the manifest.
+        
+        PARAMS:
+        - shard (dict): Shard dictionary from parse_bulk_file_to_shard
+        '''
+        self.files[shard['fname']] = {k:v for k,v in shard.items() if k != 'log'}
+        self.save()
+    
+    
+    def save(self, fnames=None):
+        '''
+        FUNCTION:
+        - Save the manifest (written to a temp file, then renamed).
+        
+        PARAMS:
+        - fnames (iterable): If given, only keep these bulk files' entries
+          (i.e., forget bulk files that are no longer downloaded)
+        '''
+        if fnames is not None:
+            fnames = set(fnames)
+            self.files = {k:v for k,v in self.files.items() if k in fnames}
+        
+        with open(self.manifest_path+'.tmp', 'w') as fout:
+            json.dump({'parsing_config':self.parsing_config, 
+                       'files':self.files}, fout)
+        os.replace(self.manifest_path+'.tmp', self.manifest_path)
+
+
+
+class PMIDStore(object):
+    '''
+    PMID-keyed store (SQLite) of the parsed articles. The shards are applied
+    in bulk file order (baseline, then updatefiles): a revised article
+    replaces its earlier version (last writer wins) and deleted citations
+    are removed. The export then has each PMID exactly once.
+    The store is kept between runs. The applied shards are recorded (bulk
+    file number, name and MD5), so a run only applies the new bulk files;
+    the store is rebuilt only if an already applied bulk file (or the
+    parsing config) changed.
+    '''
+
+    def __init__(self, store_path, parsing_config=None):
+        '''
+        PARAMS:
+        - store_path (str): Where the SQLite database is stored
+        - parsing_config (dict): A dictionary indicating which fields were
+          parsed. A store made with a different config is rebuilt.
+        '''
+        self.conn = sqlite3.connect(store_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS articles '
+                          '(pmid TEXT PRIMARY KEY, file_num INTEGER, doc TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (file_num INTEGER PRIMARY KEY, '
+                          'fname TEXT, md5 TEXT, parquet_mtime REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS config (parsing_config TEXT)')
+
+        # Stores of an older layout or another parsing config are rebuilt
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(files)')]
+        config = self.conn.execute('SELECT parsing_config FROM config').fetchone()
+        parsing_config = json.dumps(parsing_config, sort_keys=True)
+        if 'md5' not in columns or (config is not None and config[0] != parsing_config):
+            self.clear()
+        self.conn.execute('DELETE FROM config')
+        self.conn.execute('INSERT INTO config VALUES (?)', (parsing_config,))
+        self.conn.commit()
+
+
+    def clear(self):
+        '''
+        FUNCTION:
+        - Remove all articles and applied shards.
+        '''
+        self.conn.execute('DROP TABLE IF EXISTS articles')
+        self.conn.execute('DROP TABLE IF EXISTS files')
+        self.conn.execute('CREATE TABLE articles '
+                          '(pmid TEXT PRIMARY KEY, file_num INTEGER, doc TEXT)')
+        self.conn.execute('CREATE TABLE files (file_num INTEGER PRIMARY KEY, '
+                          'fname TEXT, md5 TEXT, parquet_mtime REAL)')
+        self.conn.commit()
+
+
+    def get_new_shards(self, shards):
+        '''
+        FUNCTION:
+        - Find which shards still have to be applied. The applied shards
+          must be the first shards, unchanged; otherwise the store is
+          cleared and all shards are applied again.
+
+        PARAMS:
+        - shards (list): Shard dictionaries from parse_bulk_file_to_shard,
+          in apply order
+
+        OUTPUT:
+        - first_file_num (int): Position of the first shard to apply
+        '''
+        applied = self.conn.execute('SELECT file_num, fname, md5 FROM files '
+                                    'ORDER BY file_num').fetchall()
+        current = [(file_num, shard['fname'], shard['md5'])
+                   for file_num, shard in enumerate(shards)]
+        if applied == current[:len(applied)]:
+            return len(applied)
+        self.clear()
+        return 0
+
+
+    def apply_shard(self, file_num, shard, batch_size=10000):
+        '''
+        FUNCTION:
+        - Apply one bulk file's shard: insert or replace its articles, then
+          remove its deleted citations.
+
+        PARAMS:
+        - file_num (int): Position of the bulk file in the apply order
+        - shard (dict): Shard dictionary from parse_bulk_file_to_shard
+        - batch_size (int): Number of articles inserted at a time
+
+        OUTPUT:
+        - num_revised (int): Articles that replaced an earlier version
+        - num_deleted (int): Articles removed by deleted citations
+        '''
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,NULL)',
+                          (file_num, shard['fname'], shard['md5']))
+
+        # Insert or replace (last writer wins)
+        num_revised = 0
+        with open(shard['pubmed_shard']) as fin:
+            while True:
+                batch = [line.rstrip('\n') for line in itertools.islice(fin, batch_size)]
+                if not batch:
+                    break
+                rows = [(json.loads(doc).get('PMID', '-1'), file_num, doc) for doc in batch]
+                num_revised += self.mark_changed([row[0] for row in rows])
+                self.conn.executemany('INSERT OR REPLACE INTO articles VALUES (?,?,?)', rows)
+
+        # Delete
+        with open(shard['deleted_shard']) as fin:
+            deleted = [line.strip() for line in fin if line.strip()]
+        num_deleted = self.mark_changed(deleted)
+        self.conn.executemany('DELETE FROM articles WHERE pmid = ?',
+                              [(pmid,) for pmid in deleted])
+        self.conn.commit()
+        return num_revised, num_deleted
+
+
+    def mark_changed(self, pmids):
+        '''
+        FUNCTION:
+        - Count how many of the PMIDs are already stored, and mark the bulk
+          files their stored versions came from as changed (so their
+          Parquet files are exported again)
+
+        PARAMS:
+        - pmids (list): PubMed IDs
+        '''
+        count = 0
+        for i in range(0, len(pmids), 500):
+            chunk = pmids[i:i+500]
+            query = 'SELECT file_num, COUNT(*) FROM articles WHERE pmid IN (%s) '\
+                    'GROUP BY file_num' % ','.join('?'*len(chunk))
+            file_counts = self.conn.execute(query, chunk).fetchall()
+            count += sum(file_count for _, file_count in file_counts)
+            self.conn.executemany('UPDATE files SET parquet_mtime = NULL WHERE file_num = ?',
+                                  [(file_num,) for file_num, _ in file_counts])
+        return count
+
+
+    def iter_docs(self):
+        '''
+        FUNCTION:
+        - Iterate the stored articles (JSON strings), in the order their
+          latest version was applied.
+        '''
+        for (doc,) in self.conn.execute('SELECT doc FROM articles ORDER BY rowid'):
+            yield doc
+
+
+    def export(self, pubmed_output_file):
+        '''
+        FUNCTION:
+        - Write the deduplicated articles, one JSON object per line.
+
+        PARAMS:
+        - pubmed_output_file (text wrapper): Where the parsed PubMed data will be stored
+
+        OUTPUT:
+        - num_docs (int): Number of articles written
+        '''
+        num_docs = 0
+        for doc in self.iter_docs():
+            pubmed_output_file.write(doc+'\n')
+            num_docs += 1
+        return num_docs
+
+
+    def export_parquet(self, parquet_dir):
+        '''
+        FUNCTION:
+        - Write the deduplicated articles as Parquet, one file per bulk file
+          (the one each article's latest version came from). Only the files
+          of bulk files whose articles changed (or whose Parquet file was
+          changed or removed since it was exported) are written again.
+
+        PARAMS:
+        - parquet_dir (str): Where the Parquet files will be stored
+
+        OUTPUT:
+        - num_files (int): Number of Parquet files written
+        '''
+        if not os.path.isdir(parquet_dir):
+            os.makedirs(parquet_dir)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS articles_file_num ON articles(file_num)')
+        files = self.conn.execute('SELECT file_num, fname, parquet_mtime FROM files').fetchall()
+
+        # Remove Parquet files not made from the store
+        fnames = set(fname+'.parquet' for _, fname, _ in files)
+        for file in os.listdir(parquet_dir):
+            if file.endswith('.parquet') and file not in fnames:
+                os.remove(os.path.join(parquet_dir, file))
+
+        # One writer per bulk file, every bulk file gets a (maybe empty) file
+        num_files = 0
+        for file_num, fname, parquet_mtime in sorted(files):
+            parquet_file = os.path.join(parquet_dir, fname+'.parquet')
+            if parquet_mtime is not None and os.path.isfile(parquet_file) \
+               and os.path.getmtime(parquet_file) == parquet_mtime:
+                continue
+            writer = ColumnarWriter(parquet_file)
+            query = 'SELECT doc FROM articles WHERE file_num = ? ORDER BY rowid'
+            for (doc,) in self.conn.execute(query, (file_num,)):
+                writer.write(json.loads(doc))
+            writer.close()
+            self.conn.execute('UPDATE files SET parquet_mtime = ? WHERE file_num = ?',
+                              (os.path.getmtime(parquet_file), file_num))
+            num_files += 1
+        self.conn.commit()
+        return num_files
+
+
+    def close(self):
+        self.conn.close()
+
+
+
+def merge_shards(shards, pubmed_output_file, filestat_output_file,
+                 logfile=None, store_path=None, parquet_dir=None, parsing_config=None):
+    '''
+    FUNCTION:
+    - Concatenate the shards into the final parsed PubMed and file stat
+      outputs, in the given (bulk file) order.
+    - With a PMID store, the articles are instead applied to the store in
+      that order (revisions replace, deletions remove) and exported once
+      per PMID. Shards applied by an earlier run are not applied again.
+
+    PARAMS:
+    - shards (list): Shard dictionaries from parse_bulk_file_to_shard
+    - pubmed_output_file (text wrapper): Where the parsed PubMed data will be stored
+    - filestat_output_file (text wrapper): Where article stats are stored
+    - logfile (text wrapper): Log file of the parsing progress
+    - store_path (str): Where the PMID store (SQLite) is kept. Default: no
+      store, the shards are concatenated as they are
+    - parquet_dir (str): Where the Parquet output (one file per bulk file)
+      is stored. Default: no Parquet output
+    - parsing_config (dict): A dictionary indicating which fields were parsed
+    '''
+    def print_progress(msg):
+        if logfile is not None:
+            logfile.write(msg+'\n')
+        print(msg)
+
+    for shard in shards:
+        with open(shard['filestat_shard']) as fin:
+            shutil.copyfileobj(fin, filestat_output_file)
+
+    # Concatenate
+    if store_path is None:
+        if parquet_dir is not None:
+            if os.path.isdir(parquet_dir):
+                shutil.rmtree(parquet_dir)
+            os.makedirs(parquet_dir)
+        for shard in shards:
+            with open(shard['pubmed_shard']) as fin:
+                shutil.copyfileobj(fin, pubmed_output_file)
+            if parquet_dir is not None:
+                shutil.copyfile(shard['parquet_shard'],
+                                os.path.join(parquet_dir, shard['fname']+'.parquet'))
+        return
+
+    # Apply the new shards to the PMID store, then export
+    store = PMIDStore(store_path, parsing_config)
+    first_file_num = store.get_new_shards(shards)
+    print_progress('PMID store: '+str(first_file_num)+' bulk files already applied, applying '\
+                   +str(len(shards)-first_file_num))
+    for file_num in range(first_file_num, len(shards)):
+        shard = shards[file_num]
+        num_revised, num_deleted = store.apply_shard(file_num, shard)
+        if num_revised > 0 or num_deleted > 0:
+            print_progress(shard['fname']+': '+str(num_revised)+' revised, '\
+                           +str(num_deleted)+' deleted articles')
+    num_docs = store.export(pubmed_output_file)
+    if parquet_dir is not None:
+        print_progress(str(store.export_parquet(parquet_dir))+' Parquet files written')
+    store.close()
+    print_progress(str(num_docs)+' unique PMIDs exported')
+
+
+
+def parse_dirs_parallel(source_dirs, shard_dir, pubmed_output_file, 
+                        filestat_output_file, parsing_config, logfile,
+                        workers=None, streaming=True, manifest_path=None,
+                        store_path=None, parquet_dir=None):
+    '''
+    FUNCTION:
+    - Parse the bulk files of several directories (e.g., baseline and 
+      updatefiles) with a pool of worker processes. Each worker writes the
+      shard of one bulk file. The shards are then merged in a deterministic
+      order: directory order, then file name order.
+    - With a manifest, only new or changed bulk files are parsed; the 
+      shards of the others (including those finished before a crash) are
+      reused.
+    - With a PMID store, update files' revisions and deleted citations are
+      applied, so each PMID is output exactly once (its latest version).
+    - With a Parquet directory, the documents are also written in a 
+      columnar format, one Parquet file per bulk file.
+    
+    PARAMS:
+    - source_dirs (list): [(source_dir, ndir),...] where ndir is 'baseline'
+      or 'updatefiles', the name of the directory
+    - shard_dir (str): Where the per-file shards will be stored
+    - pubmed_output_file (text wrapper): Where the parsed PubMed data will be stored
+    - filestat_output_file (text wrapper): Where article stats are stored
+    - parsing_config (dict): A dictionary indicating which fields to parse
+    - logfile (text wrapper): Log file of the parsing progress
+    - workers (int): Number of worker processes. Default: number of CPUs.
+      1 parses the bulk files in this process
+    - streaming (bool): Stream each file's articles (iterparse) and read 
+      the zipped .xml.gz files directly
+    - manifest_path (str): Where the parsing manifest is stored. Default:
+      no manifest, every bulk file is parsed
+    - store_path (str): Where the PMID store (SQLite) is kept. Default: no
+      store, the shards are concatenated as they are
+    - parquet_dir (str): Where the Parquet output is stored. Default: no 
+      Parquet output
+    
+    OUTPUT:
+    - shards (list): Shard dictionaries, in merge order
+    '''
+    
+    ''' Pre-parsing '''
+    if workers is None:
+        workers = cpu_count()
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    columnar = parquet_dir is not None
+    manifest = None
+    if manifest_path is not None:
+        manifest = ParseManifest(manifest_path, parsing_config, columnar=columnar)
+    
+    # Bulk files of all directories, in merge order
+    tasks = []
+    for source_dir, ndir in source_dirs:
+        if not os.path.isdir(source_dir):
+            print('Directory not found during parsing: '+source_dir)
+            continue
+        bulk_files = list_bulk_files(source_dir, streaming)
+        msg = 'Parsing '+ndir+' containing '+str(len(bulk_files))+' bulk files'
+        logfile.write(msg+'\n')
+        print(msg)
+        for file in bulk_files:
+            tasks.append((os.path.join(source_dir, file), shard_dir, 
+                          parsing_config, streaming, columnar))
+    
+    # Reuse the shards of unchanged bulk files
+    fname2shard = dict()
+    if manifest is not None:
+        for task in tasks:
+            shard = manifest.get_current_shard(task[0])
+            if shard is not None:
+                fname2shard[shard['fname']] = shard
+    todo_tasks = [task for task in tasks if 
+                  task[0].split('/')[-1].split('.')[0] not in fname2shard]
+    total_files = len(todo_tasks)
+    
+    # Print progress: starting
+    msg = 'Reusing '+str(len(fname2shard))+' parsed bulk files. Parsing '\
+          +str(total_files)+' bulk files with '+str(workers)+' workers'
+    logfile.write(msg+'\n'+'='*50+'\n')
+    print(msg+'\n'+'='*50)
+    
+    
+    ''' Parsing '''
+    # Record each shard as soon as it is finished, in any order
+    t1 = time.time()
+    pool = Pool(workers) if workers > 1 else None
+    parsed_shards = pool.imap_unordered(parse_bulk_file_to_shard, todo_tasks) \
+                    if pool is not None else map(parse_bulk_file_to_shard, todo_tasks)
+    try:
+        for file_count, shard in enumerate(parsed_shards, 1):
+            fname2shard[shard['fname']] = shard
+            if manifest is not None:
+                manifest.record(shard)
             
-            # Parse if it is is an .xml file
-            # NOTE: Check that the year and file name is correct here. 
-            # Sometimes they change both. Check the ftp baseline server
-            if re.search(r'^pubmed'+YEAR_LAST_TWO+'n\d\d\d\d.xml$', file) is not None:   
-
-                # Parse
-                PRS = Parser(os.path.join(source_dir, file), pubmed_output_file,
-                             filestat_output_file, parsing_config)
-                PRS.parse_pubmed_file(logfile) 
-                
-                # Print progress
-                file_count += 1
-                msg='Parsing '+str(file_count)+'/'+str(total_files)+' from '\
-                    + ndir + ':' + file
-                logfile.write(msg + "\n")
-                print(msg) 
\ No newline at end of file
+            # Print progress
+            msg = 'Parsing '+str(file_count)+'/'+str(total_files)+': '\
+                  +shard['fname']+', '+str(round(time.time()-t1))+' seconds'
+            logfile.write(shard['log']+msg+'\n')
+            print(msg)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    
+    
+    ''' Merging '''
+    # Merge in task order (directory order, then file name order)
+    shards = [fname2shard[task[0].split('/')[-1].split('.')[0]] for task in tasks]
+    if manifest is not None:
+        manifest.save(fnames=fname2shard.keys())
+    merge_shards(shards, pubmed_output_file, filestat_output_file, 
+                 logfile=logfile, store_path=store_path, parquet_dir=parquet_dir,
+                 parsing_config=parsing_config)
+    msg = 'Merged '+str(len(shards))+' shards. Total time: '\
+          +str(round(time.time()-t1))+' seconds'
+    logfile.write(msg+'\n')
+    print(msg)
+    return shards
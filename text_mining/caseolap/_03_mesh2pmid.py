@@ -1,80 +1,212 @@
 import time, re, sys, os, json
+from array import array
 from collections import defaultdict
+import numpy as np
+from text_mining.caseolap._02_parsing import iter_parsed_records
 
+
+'''
+Compact MeSH to PMID index
+'''
+class MeSHPostings(object):
+    '''
+    Reads a MeSH to PMID index made by MeSH2PMID.mesh2pmid_mapping. The
+    index is a directory with:
+    - terms.json: MeSH terms, the term number is the position in the list
+    - offsets.npy: Term number -> start of its PMIDs in postings.npy
+    - postings.npy: Sorted PMIDs (uint32) of term 0, then term 1, ...
+    The arrays are memory-mapped, so only the PMIDs that are used are read.
+    '''
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.terms = json.load(open(os.path.join(index_dir, 'terms.json'), 'r'))
+        self.term2num = {term:num for num, term in enumerate(self.terms)}
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r')
+        self.postings = np.load(os.path.join(index_dir, 'postings.npy'), mmap_mode='r')
+
+    def __contains__(self, term):
+        return term in self.term2num
+
+    def pmids(self, term):
+        '''
+        FUNCTION:
+        - Sorted PMIDs (uint32) of one MeSH term, empty if not indexed
+        '''
+        num = self.term2num.get(term)
+        if num is None:
+            return np.zeros(0, dtype=np.uint32)
+        return self.postings[self.offsets[num]:self.offsets[num+1]]
+
+    def union(self, terms):
+        '''
+        FUNCTION:
+        - Sorted PMIDs (uint32) having any of the MeSH terms
+        '''
+        arrays = [self.pmids(term) for term in terms if term in self.term2num]
+        if len(arrays) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        return np.unique(np.concatenate(arrays))
+
+    def counts(self):
+        '''
+        FUNCTION:
+        - MeSH term -> number of PMIDs (the posting lengths)
+        '''
+        return dict(zip(self.terms, np.diff(self.offsets).tolist()))
+
+    def items(self):
+        '''
+        FUNCTION:
+        - Iterate through (MeSH term, sorted PMIDs)
+        '''
+        for num, term in enumerate(self.terms):
+            yield term, self.postings[self.offsets[num]:self.offsets[num+1]]
+
+
+def save_mesh2pmid_index(index_dir, terms, keys):
+    '''
+    FUNCTION:
+    - Sort the (term number << 32 | PMID) keys and save them as a MeSH to
+      PMID index (see MeSHPostings). Duplicate keys are saved once.
+
+    PARAMS:
+    - index_dir (str): Output directory
+    - terms (list): MeSH terms, indexed by term number
+    - keys (numpy array of uint64): One key per (MeSH term, PMID), sorted
+      in place (no copy of the keys is made)
+    '''
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    # Sort in place, find repeated (MeSH term, PMID)
+    keys.sort()
+    repeated = np.flatnonzero(keys[1:] == keys[:-1]) + 1
+
+    # Split the keys into posting lists (PMIDs are the low 32 bits); each
+    # term's offset is moved back by the repeated keys before it
+    offsets = np.searchsorted(keys, np.arange(len(terms)+1, dtype=np.uint64) << np.uint64(32))
+    offsets = (offsets - np.searchsorted(repeated, offsets)).astype(np.int64)
+    postings = keys.astype(np.uint32)
+    if len(repeated) > 0:
+        postings = np.delete(postings, repeated)
+
+    # Save each file under a temporary name, then rename it
+    for name, array_data in (('postings.npy', postings), ('offsets.npy', offsets)):
+        with open(os.path.join(index_dir, name+'.tmp'), 'wb') as fout:
+            np.save(fout, array_data)
+        os.replace(os.path.join(index_dir, name+'.tmp'), os.path.join(index_dir, name))
+    with open(os.path.join(index_dir, 'terms.json.tmp'), 'w') as fout:
+        json.dump(terms, fout)
+    os.replace(os.path.join(index_dir, 'terms.json.tmp'), os.path.join(index_dir, 'terms.json'))
+
+
+
+'''
+MeSH to PMID mapping
+'''
 # MeSH to PMID object (stored two dictionaries)
 class MeSH2PMID(object):
-    
+
     def __init__(self):
-        self.mesh2pmid       = dict()  # MeSH to list of PMIDs 
+        self.mesh2pmid       = None   # MeSH to sorted PMIDs (MeSHPostings)
         self.mesh2pmid_count = dict() # MeSH to number of PMIDs
-        
-    def mesh2pmid_mapping(self, parsed_data_inputfile, mesh2pmid_outputfile, logfile):
+
+    def mesh2pmid_mapping(self, parsed_data_inputfile, mesh2pmid_index_dir, logfile):
         '''
         FUNCTION:
-        - Map MeSH to PMIDs and output them as files
-        
+        - Map MeSH to PMIDs in one pass over the parsed documents and save
+          the mapping as a compact index (sorted uint32 PMIDs per MeSH term,
+          see MeSHPostings). Each (MeSH, PMID) pair only takes 8 bytes
+          while mapping, instead of a Python string per PMID.
+
         PARAMS:
-        - parsed_data_inputfile (JSON file): Parsed text files 
-        - mesh2pmid_outputfile (JSON file): Stored mesh2pmid mapping
+        - parsed_data_inputfile (JSON file or Parquet directory): Parsed text
+          files. From Parquet, only the PMID and MeSH columns are read.
+        - mesh2pmid_index_dir (str): Directory of the stored mesh2pmid index
         - logfile (Text file): Stores progress
         '''
-        
+
         # Read in parsed pubmed documents
-        with open(parsed_data_inputfile) as fin:
-            print('MeSH to PMID mapping is running...')
-            start = time.time()
-            
-            # For each parsed document, map PMID to MeSH
-            for num_docs, document in enumerate(fin):
-                    
-                # Get PMID and MeSH
-                pub_info = json.loads(document.strip())
-                pmid_mesh = dict()
-                pmid_mesh['pmid'] = pub_info.get('PMID', '-1')                   
-                pmid_mesh['mesh_heading'] = ' '.join(pub_info['MeshHeadingList'])
-
-                # Map PMID to MeSH
-                if pmid_mesh['pmid'] != '-1':
-                    for mesh in pub_info['MeshHeadingList']:
-                        self.mesh2pmid.setdefault(mesh,[]).append(pmid_mesh['pmid'])
-
-                # Print progress
-                if num_docs % 500000 == 0:
-                    msg = str(num_docs) +' PMIDs attempted to map to MeSH terms'
-                    logfile.write(msg+'\n')
-                    print(msg, end = '\r')
-
-            # Export 'MeSH to PMID' mapping table (this loads one line at a time,
-            # the textcube file reads it in one line at a time)
-            print('Exporting MeSH to PMID mapping')
-            mesh2pmid_fout = open(mesh2pmid_outputfile, 'w')
-            for mesh, pmids in self.mesh2pmid.items():
-                json.dump({mesh:pmids}, mesh2pmid_fout)
-                mesh2pmid_fout.write('\n')
+        documents = iter_parsed_records(parsed_data_inputfile, ['PMID', 'MeshHeadingList'])
+        print('MeSH to PMID mapping is running...')
+        start = time.time()
+
+        # MeSH term -> term number, (term number << 32 | PMID) keys
+        mesh2num = dict()
+        keys = array('Q')
+
+        # For each parsed document, map PMID to MeSH
+        for num_docs, pub_info in enumerate(documents):
+
+            # Get PMID and MeSH
+            pmid = pub_info.get('PMID', '-1')
+
+            # Map PMID to MeSH
+            if pmid != '-1' and pmid.isdigit():
+                pmid = int(pmid)
+                for mesh in pub_info['MeshHeadingList']:
+                    keys.append(mesh2num.setdefault(mesh, len(mesh2num)) << 32 | pmid)
+
+            # Print progress
+            if num_docs % 500000 == 0:
+                msg = str(num_docs) +' PMIDs attempted to map to MeSH terms'
+                logfile.write(msg+'\n')
+                print(msg, end = '\r')
 
-            # Print final progress
-            print('Finished MeSH to PMID mapping. Time = '+\
+        # Export 'MeSH to PMID' index (memory-mapped by the textcube)
+        print('Exporting MeSH to PMID mapping')
+        terms = sorted(mesh2num, key=mesh2num.get)
+        keys = np.frombuffer(keys, dtype=np.uint64)
+        save_mesh2pmid_index(mesh2pmid_index_dir, terms, keys)
+        del keys
+        self.mesh2pmid = MeSHPostings(mesh2pmid_index_dir)
+
+        # Print final progress
+        msg = str('Finished MeSH to PMID mapping. '+str(len(terms))+' MeSH terms, '+\
+                  str(len(self.mesh2pmid.postings))+' MeSH-PMID pairs. Time = '+\
                   str(round(time.time()-start)/60)+' minutes')
-            
-        
-    def mesh2pmid_mapping_stat(self, mesh2pmid_countfile, logfile): 
+        logfile.write(msg+'\n')
+        print(msg)
+
+
+    def mesh2pmid_mapping_stat(self, mesh2pmid_countfile, logfile):
         '''
         FUNCTION:
-        - Get count on the numer of MeSH to PMID mappings 
-        
+        - Get count on the numer of MeSH to PMID mappings
+
         PARAMS:
         - mesh2pmid_countfile (JSON file): Stores counts of MeSH to PMIDs
         - logfile (Text file): Stores progress
         '''
-        
+
         # Printing progress
         msg = 'MeSH to PMID mapping stat is running.'
         logfile.write(msg+'\n')
         print(msg)
-        
-        # Make mapping
-        for mesh, pmids in self.mesh2pmid.items():
-            self.mesh2pmid_count[mesh] = len(pmids)
-        
+
+        # Make mapping (lengths of the posting lists)
+        self.mesh2pmid_count = self.mesh2pmid.counts()
+
         # Export mapping
-        json.dump(self.mesh2pmid_count, open(mesh2pmid_countfile,'w'))
\ No newline at end of file
+        json.dump(self.mesh2pmid_count, open(mesh2pmid_countfile,'w'))
+
+
+    def export_mesh2pmid_json(self, mesh2pmid_outputfile, logfile):
+        '''
+        FUNCTION:
+        - Export the mapping in the older JSON format, one {"MeSH":[PMIDs]}
+          per line (only needed by scripts not reading the index)
+
+        PARAMS:
+        - mesh2pmid_outputfile (JSON file): Stored mesh2pmid mapping
+        - logfile (Text file): Stores progress
+        '''
+        msg = 'Exporting MeSH to PMID mapping as JSON: '+mesh2pmid_outputfile
+        logfile.write(msg+'\n')
+        print(msg)
+
+        with open(mesh2pmid_outputfile, 'w') as mesh2pmid_fout:
+            for mesh, pmids in self.mesh2pmid.items():
+                json.dump({mesh:[str(pmid) for pmid in pmids.tolist()]}, mesh2pmid_fout)
+                mesh2pmid_fout.write('\n')
@@ -1,131 +1,464 @@
-import time, re, sys, os, json
+import time, re, sys, os, json, threading
 from collections import defaultdict
-from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, helpers
+from text_mining.caseolap._02_parsing import iter_parsed_records
 
 
-def populate_index(parsed_text_infile, logfile, index_name, type_name, 
-                   index_populate_config):
+'''
+Bulk indexing engine
+'''
+class LockedIterator(object):
+    '''
+    Lets several threads take items from one iterator
+    '''
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.iterator)
+
+
+
+class BulkIndexer(object):
+    '''
+    Sends documents to ElasticSearch with several threads. Each thread runs
+    elasticsearch.helpers.streaming_bulk over one shared stream of actions,
+    so a thread waiting on the cluster doesn't hold up the others. Chunks
+    are limited by number of documents and by bytes. Documents rejected
+    with 429 (cluster busy) are retried with exponential backoff, slowing
+    that thread down (back-pressure). Documents that still fail are
+    written to a dead-letter file, one JSON per line, with their action so
+    they can be indexed again (iter_dead_letter_actions). Each thread keeps
+    the actions of its chunk in flight until their results are back.
+    Can be run against a local stand-in (es_standin.StandinElasticsearch).
+    '''
+
+    def __init__(self, es, logfile, threads=4, chunk_size=500,
+                 max_chunk_bytes=10*1024*1024, max_retries=8, initial_backoff=2,
+                 max_backoff=600, dead_letter_file=None, request_timeout=500,
+                 report_every=100000):
+        '''
+        PARAMS:
+        - es (Elasticsearch): The client (e.g., Elasticsearch('http://localhost:9200'))
+        - logfile (file): The place to write the progress of indexing
+        - threads (int): Number of chunks sent at a time
+        - chunk_size (int): Maximum number of documents per chunk
+        - max_chunk_bytes (int): Maximum size of a chunk in bytes
+        - max_retries (int): Retries of a document rejected with 429
+        - initial_backoff (float): Seconds before the first retry, doubled
+          for each further retry
+        - max_backoff (float): Maximum seconds between retries
+        - dead_letter_file (str): Where failed documents are written (optional)
+        - request_timeout (float): Seconds before a bulk request times out
+        - report_every (int): Print progress every this many documents
+        '''
+        self.es = es
+        self.logfile = logfile
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter_file = dead_letter_file
+        self.request_timeout = request_timeout
+        self.report_every = report_every
+
+        # Progress, shared by the threads
+        self.lock = threading.Lock()
+        self.num_indexed = 0
+        self.num_failed = 0
+        self.dead_letters = None
+        self.start = None
+
+
+    def print_progress(self, msg):
+        self.logfile.write(msg+'\n')
+        print(msg)
+
+
+    def record(self, ok, info, action=None):
+        # Count one document's result, write it (and its action) to the 
+        # dead-letter file if it failed
+        with self.lock:
+            if ok:
+                self.num_indexed += 1
+            else:
+                self.num_failed += 1
+                if self.dead_letters is not None:
+                    op_type, item = list(info.items())[0]
+                    self.dead_letters.write(json.dumps({
+                        '_id': item.get('_id'), 'op_type': op_type,
+                        'status': item.get('status'), 'error': item.get('error'),
+                        'exception': str(item['exception']) if 'exception' in item else None,
+                        'action': action},
+                        default=str)+'\n')
+            num_done = self.num_indexed + self.num_failed
+            if num_done % self.report_every == 0:
+                seconds = time.time() - self.start
+                self.print_progress(str(num_done)+' documents sent in '+\
+                                    str(round(seconds/60,3))+' minutes ('+\
+                                    str(round(num_done/max(seconds,1e-9)))+' docs/sec, '+\
+                                    str(self.num_failed)+' failed)')
+
+
+    def worker(self, actions):
+        # Bulk index from the shared stream of actions until it is empty.
+        # The actions sent and not yet answered (about one chunk) are kept
+        # by _id, for the dead-letter file
+        in_flight = dict()
+        def track(actions):
+            for action in actions:
+                in_flight.setdefault(str(action.get('_id')), []).append(action)
+                yield action
+        
+        for ok, info in helpers.streaming_bulk(self.es, track(actions),
+                                               chunk_size=self.chunk_size,
+                                               max_chunk_bytes=self.max_chunk_bytes,
+                                               raise_on_error=False,
+                                               raise_on_exception=False,
+                                               max_retries=self.max_retries,
+                                               initial_backoff=self.initial_backoff,
+                                               max_backoff=self.max_backoff,
+                                               request_timeout=self.request_timeout):
+            item = list(info.values())[0]
+            sent = in_flight.get(str(item.get('_id')))
+            action = sent.pop(0) if sent else None
+            if sent is not None and len(sent) == 0:
+                del in_flight[str(item.get('_id'))]
+            self.record(ok, info, action)
+
+
+    def index(self, actions):
+        '''
+        FUNCTION:
+        - Index all actions (dicts with '_index', '_id', '_source', ...)
+
+        PARAMS:
+        - actions (iterable): The actions, read lazily
+
+        OUTPUT:
+        - report (dict): Number of documents 'indexed' and 'failed',
+          'seconds' and 'docs_per_sec'
+        '''
+        self.start = time.time()
+        if self.dead_letter_file is not None:
+            self.dead_letters = open(self.dead_letter_file, 'w')
+
+        try:
+            # Several streaming_bulk threads share one stream of actions
+            actions = LockedIterator(actions)
+            with ThreadPoolExecutor(max_workers=max(1, self.threads)) as executor:
+                futures = [executor.submit(self.worker, actions) for _ in range(max(1, self.threads))]
+                for future in futures:
+                    future.result()
+        finally:
+            if self.dead_letters is not None:
+                self.dead_letters.close()
+
+        seconds = time.time() - self.start
+        return {'indexed': self.num_indexed, 'failed': self.num_failed,
+                'seconds': round(seconds, 1),
+                'docs_per_sec': round((self.num_indexed+self.num_failed)/max(seconds,1e-9), 1)}
+
+
+
+def iter_dead_letter_actions(dead_letter_file):
     '''
     FUNCTION:
-    - This populates the ElasticSearch index with information from PubMed
-      publications: PMID, title, abstract, MeSH terms, date, author, 
-      location, journal, and full text if available.. 
+    - Read the actions of the failed documents back from a dead-letter
+      file, e.g., to index them again with BulkIndexer.index
+
+    PARAMS:
+    - dead_letter_file (str): Dead-letter file written by a BulkIndexer
+    '''
+    with open(dead_letter_file) as fin:
+        for line in fin:
+            dead_letter = json.loads(line)
+            if dead_letter.get('action') is not None:
+                yield dead_letter['action']
+
+
+
+'''
+Bulk-load lifecycle
+'''
+def versioned_index_name(index_name):
+    '''
+    FUNCTION:
+    - Name of a new version of the index (e.g., pubmed_lift_20240131120000),
+      to be built while the alias index_name still points to the old one
+    '''
+    return index_name+'_'+time.strftime('%Y%m%d%H%M%S')
+
+
+def delete_index(es, index_name):
+    '''
+    FUNCTION:
+    - Delete the index index_name. If index_name is an alias (left by a
+      versioned build), the indices it points to are removed with it.
+
+    PARAMS:
+    - es (Elasticsearch): The client
+    - index_name (str): The index or alias to delete
+
+    OUTPUT:
+    - deleted (list): Names of the deleted indices
+    '''
+    if es.indices.exists_alias(name=index_name):
+        deleted = list(es.indices.get_alias(name=index_name))
+        es.indices.update_aliases(body={'actions': [{'remove_index': {'index': name}}
+                                                    for name in deleted]})
+    elif es.indices.exists(index=index_name):
+        deleted = [index_name]
+        es.indices.delete(index=index_name)
+    else:
+        deleted = []
+    return deleted
+
+
+def start_bulk_load(es, index_name, logfile):
+    '''
+    FUNCTION:
+    - Turn off refreshes and replicas of the index while it is loaded, so
+      the cluster doesn't make and copy new segments every second.
+    
+    PARAMS:
+    - es (Elasticsearch): The client
+    - index_name (str): The index being loaded
+    - logfile: Output file, where the progress will be printed.
+    
+    OUTPUT:
+    - previous_settings (dict): 'refresh_interval' (None if default) and 
+      'number_of_replicas' to restore with finish_bulk_load
+    '''
+    settings = es.indices.get_settings(index=index_name)
+    settings = list(settings.values())[0]['settings']['index']
+    previous_settings = {'refresh_interval': settings.get('refresh_interval'),
+                         'number_of_replicas': settings.get('number_of_replicas', '1')}
+    
+    es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1',
+                                                              'number_of_replicas': 0}})
+    msg = 'Bulk-load settings on '+index_name+' (refresh off, 0 replicas). Previous: '+\
+          str(previous_settings)
+    logfile.write(msg+'\n')
+    print(msg)
+    return previous_settings
+
+
+def finish_bulk_load(es, index_name, previous_settings, logfile, max_num_segments=1):
+    '''
+    FUNCTION:
+    - After the index was loaded: restore its refresh interval, refresh,
+      force-merge it into max_num_segments segments, then restore its
+      replicas (so the merged segments are copied only once).
     
     PARAMS:
-    - parsed_text_infile (JSON): The input file of parsed publications
-      (keys and values for
-      title:'what the title actually is', etc.)
+    - es (Elasticsearch): The client
+    - index_name (str): The index that was loaded
+    - previous_settings (dict): Output of start_bulk_load
     - logfile: Output file, where the progress will be printed.
+    - max_num_segments (int): Segments per shard after the force-merge 
+      (None to skip the force-merge)
+    '''
+    start = time.time()
+    es.indices.put_settings(index=index_name, body={'index': 
+                            {'refresh_interval': previous_settings['refresh_interval']}})
+    es.indices.refresh(index=index_name)
+    
+    if max_num_segments is not None:
+        msg = 'Force-merging '+index_name+' into '+str(max_num_segments)+' segment(s)'
+        logfile.write(msg+'\n')
+        print(msg)
+        es.indices.forcemerge(index=index_name, max_num_segments=max_num_segments,
+                              request_timeout=6*3600)
+    
+    es.indices.put_settings(index=index_name, body={'index': 
+                            {'number_of_replicas': previous_settings['number_of_replicas']}})
+    msg = 'Restored settings on '+index_name+' '+str(previous_settings)+'. '+\
+          str(round(time.time()-start))+' seconds'
+    logfile.write(msg+'\n')
+    print(msg)
+
+
+def swap_alias(es, alias, index_name, logfile, delete_old=True):
+    '''
+    FUNCTION:
+    - Point the alias to the new index in one atomic request, so searches
+      on the alias keep working during a rebuild. An older index with the
+      alias' name (made before versioned indices were used) is replaced.
+    
+    PARAMS:
+    - es (Elasticsearch): The client
+    - alias (str): The name searched by the later steps (e.g., pubmed_lift)
+    - index_name (str): The new, fully loaded index
+    - logfile: Output file, where the progress will be printed.
+    - delete_old (bool): Delete the indices the alias pointed to before
+    '''
+    actions = []
+    old_indices = []
+    if es.indices.exists_alias(name=alias):
+        old_indices = [name for name in es.indices.get_alias(name=alias) if name != index_name]
+        actions += [{'remove': {'index': name, 'alias': alias}} for name in old_indices]
+    elif es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    
+    msg = 'Alias '+alias+' -> '+index_name+' (was: '+str(old_indices)+')'
+    logfile.write(msg+'\n')
+    print(msg)
+    
+    if delete_old:
+        for name in old_indices:
+            es.indices.delete(index=name)
+
+
+
+'''
+Index the parsed publications
+'''
+def index_fields(index_populate_config):
+    '''
+    FUNCTION:
+    - Fields to read from the parsed publications
+
+    PARAMS:
+    - index_populate_config (JSON): Indicates which fields (e.g., title) to
+      index.
+    '''
+    fields = ['PMID', 'ArticleTitle', 'Abstract', 'full_text']
+    if index_populate_config['date']:
+        fields += ['PubDate', 'Year']
+    if index_populate_config['MeSH']:
+        fields.append('MeshHeadingList')
+    if index_populate_config['location']:
+        fields.append('Country')
+    if index_populate_config['author']:
+        fields.append('AuthorList')
+    if index_populate_config['journal']:
+        fields.append('Journal')
+    return fields
+
+
+def make_index_action(paper_info, index_name, type_name, index_populate_config):
+    '''
+    FUNCTION:
+    - Make the bulk indexing action of one publication: PMID, title,
+      abstract, MeSH terms, date, author, location, journal, and full
+      text if available.
+
+    PARAMS:
+    - paper_info (dict): One parsed publication
     - index_name (str): The name you chose for the index
     - type_name (str): The name you chose for the index type
-    - index_populate_config (JSON): Indicates which fields (e.g., title) to 
+    - index_populate_config (JSON): Indicates which fields (e.g., title) to
       index.
     '''
-    
-    es = Elasticsearch()
-    batch_num = 0
-    
-    with open(parsed_text_infile, 'r') as fin: 
-        start = time.time()
-        BATCH_SIZE = 500    # number of document processed in each batch index
-        batch_data = []     # data in batch index
+    # Get information on each document (e.g., title, abstract, date)
+    data_dict = {}
 
-        
-        '''Collect a batch of documents'''
-        # Iterate through all documents
-        for doc_count, document in enumerate(fin): 
-
-            # Get information on each document (e.g., title, abstract, date)
-            paper_info = json.loads(document.strip())
-            data_dict = {}
-
-            # PMID, title, abstract, full text
-            data_dict['pmid'] = paper_info.get('PMID', '-1')                     
-            data_dict['title'] = paper_info.get('ArticleTitle')                   
-            data_dict['abstract'] = paper_info.get('Abstract', '')               
-            data_dict['full_text'] = paper_info['full_text']    
-            data_dict['introduction'] = ''
-            data_dict['methods'] = ''
-            data_dict['results'] = ''
-            data_dict['discussion'] = ''
-            
-            # Date
-            if index_populate_config['date']:                                   
-                data_dict['date'] = str(paper_info['PubDate'])
-                
-                # Year
-                year = paper_info['PubDate']['Year']
-                try: 
-                    year = int(year)
-                except:
-                    try:
-                        year = int(hit.date['MedlineDate'].split(' ')[0])
-                    except:
-                        year = -1
-                data_dict['year'] = str(year)
-
-            # MeSH
-            if index_populate_config['MeSH']:                                   
-                data_dict['MeSH'] = paper_info['MeshHeadingList']
-
-            # Location (where paper was published)
-            if index_populate_config['location']:                               
-                data_dict['location'] = paper_info['Country']
-
-            # Authors
-            if index_populate_config['author']:                                 
-                data_dict['author'] = paper_info['AuthorList']
-
-            # Journal
-            if index_populate_config['journal']:                                 
-                data_dict['journal'] = paper_info['Journal']
-
-            op_dict = {'index': {
-                        '_index': index_name,
-                        '_type': type_name,
-                        '_id': data_dict['pmid']}}
-            
-            # Put current data into the batch 
-            batch_data.append(op_dict)
-            batch_data.append(data_dict) 
-
-            
-            '''Index a batch of documents'''
-            # Bulk indexing
-            if doc_count % BATCH_SIZE == 0 and doc_count != 0:
-                
-                # Index
-                es.bulk(index = index_name, body = batch_data, request_timeout = 500)
-                batch_data = []
-                
-                # Print progress
-                elapsed_time = round(time.time() - start, 3)
-                msg = str(doc_count)+' documents indexed in '\
-                     +str(round(elapsed_time/60,3))+' minutes'
-                logfile.write(msg+'\n')
-                batch_num += 1
-                if batch_num % 100 == 0:
-                    print(msg)
-                
-        '''Index the remainder in the last batch'''
-        # If, at the end of the input file, there are leftover files in the 
-        # incomplete batch, index them
-        if batch_data != []:
-
-            # Index
-            es.bulk(index = index_name, body = batch_data, request_timeout = 500)
-            batch_data = []
-
-            # Print progress
-            elapsed_time = round(time.time() - start, 3)
-            msg = str(doc_count)+' documents indexed in '\
-                 +str(round(elapsed_time/60,3))+' minutes'
-            logfile.write(msg+'\n')
-            print(msg)
-
-            
-        '''Print that the process is complete'''
-        elapsed_time = round(time.time() - start, 3)
-        msg = 'Finished indexing in '+str(round(elapsed_time/60,3))+' minutes'
-        logfile.write(msg + '\n')
-        print(msg)                    
\ No newline at end of file
+    # PMID, title, abstract, full text
+    data_dict['pmid'] = paper_info.get('PMID', '-1')
+    data_dict['title'] = paper_info.get('ArticleTitle')
+    data_dict['abstract'] = paper_info.get('Abstract', '')
+    data_dict['full_text'] = paper_info['full_text']
+    data_dict['introduction'] = ''
+    data_dict['methods'] = ''
+    data_dict['results'] = ''
+    data_dict['discussion'] = ''
+
+    # Date
+    if index_populate_config['date']:
+        data_dict['date'] = str(paper_info['PubDate'])
+
+        # Year
+        data_dict['year'] = str(paper_info['Year'])
+
+    # MeSH
+    if index_populate_config['MeSH']:
+        data_dict['MeSH'] = paper_info['MeshHeadingList']
+
+    # Location (where paper was published)
+    if index_populate_config['location']:
+        data_dict['location'] = paper_info['Country']
+
+    # Authors
+    if index_populate_config['author']:
+        data_dict['author'] = paper_info['AuthorList']
+
+    # Journal
+    if index_populate_config['journal']:
+        data_dict['journal'] = paper_info['Journal']
+
+    return {'_index': index_name,
+            '_type': type_name,
+            '_id': data_dict['pmid'],
+            '_source': data_dict}
+
+
+def populate_index(parsed_text_infile, logfile, index_name, type_name,
+                   index_populate_config, threads=4, chunk_size=500,
+                   max_chunk_bytes=10*1024*1024, max_retries=8,
+                   dead_letter_file=None, es_hosts=None):
+    '''
+    FUNCTION:
+    - This populates the ElasticSearch index with information from PubMed
+      publications: PMID, title, abstract, MeSH terms, date, author,
+      location, journal, and full text if available..
+    - Documents are sent by a BulkIndexer (parallel streaming bulk requests,
+      429 retries, dead-letter file).
+
+    PARAMS:
+    - parsed_text_infile (JSON or Parquet directory): The input file of
+      parsed publications (keys and values for
+      title:'what the title actually is', etc.). From Parquet, only the
+      columns of the indexed fields are read.
+    - logfile: Output file, where the progress will be printed.
+    - index_name (str): The name you chose for the index
+    - type_name (str): The name you chose for the index type
+    - index_populate_config (JSON): Indicates which fields (e.g., title) to
+      index.
+    - threads (int): Number of bulk requests sent at a time
+    - chunk_size (int): Maximum number of documents per bulk request
+    - max_chunk_bytes (int): Maximum size of a bulk request in bytes
+    - max_retries (int): Retries of documents rejected with 429
+    - dead_letter_file (str): Where failed documents are written (optional)
+    - es_hosts (list): ElasticSearch hosts (default: localhost:9200)
+
+    OUTPUT:
+    - report (dict): See BulkIndexer.index
+    '''
+    es = Elasticsearch(es_hosts)
+
+    # Bulk indexing actions, made while reading the parsed publications
+    fields = index_fields(index_populate_config)
+    actions = (make_index_action(paper_info, index_name, type_name, index_populate_config)
+               for paper_info in iter_parsed_records(parsed_text_infile, fields))
+
+    # Index
+    msg = 'Indexing with '+str(threads)+' threads, chunks of up to '+\
+          str(chunk_size)+' documents / '+str(max_chunk_bytes)+' bytes'
+    logfile.write(msg+'\n')
+    print(msg)
+    indexer = BulkIndexer(es, logfile, threads=threads, chunk_size=chunk_size,
+                          max_chunk_bytes=max_chunk_bytes, max_retries=max_retries,
+                          dead_letter_file=dead_letter_file)
+    report = indexer.index(actions)
+
+
+    '''Print that the process is complete'''
+    msg = 'Finished indexing in '+str(round(report['seconds']/60,3))+' minutes. '+\
+          str(report['indexed'])+' documents indexed, '+str(report['failed'])+\
+          ' failed ('+str(report['docs_per_sec'])+' docs/sec)'
+    if report['failed'] > 0 and dead_letter_file is not None:
+        msg += '. Failed documents: '+dead_letter_file
+    logfile.write(msg + '\n')
+    print(msg)
+    return report
@@ -1,15 +1,329 @@
-import json, sys, time
+import json, sys, time, os
+import numpy as np
+from bisect import bisect_left
+from text_mining.caseolap._03_mesh2pmid import MeSHPostings
+
+
+'''
+MeSH tree index
+'''
+class MeSHTreeIndex(object):
+    '''
+    MeSH tree numbers (e.g., C14.280.647) sorted as strings. All tree 
+    numbers starting with a root are then one contiguous interval of the 
+    sorted list, found with two binary searches instead of a scan of the
+    whole tree. Each root's descendant MeSH terms are kept once found.
+    The sorted tree can be cached to disk (JSON) and is reused while the
+    MeSH tree file doesn't change.
+    '''
+    
+    def __init__(self, tree_numbers, mesh_terms):
+        '''
+        PARAMS:
+        - tree_numbers (list): Sorted MeSH tree numbers
+        - mesh_terms (list): MeSH term (name) of each tree number
+        '''
+        self.tree_numbers = tree_numbers
+        self.mesh_terms = mesh_terms
+        self.root2terms = dict()
+
+
+    @classmethod
+    def load(cls, infile_meshtree, cache_file=None):
+        '''
+        FUNCTION:
+        - Read the MeSH tree file ('MeSH term;tree number' lines), or its 
+          cached index if the cache was made from the same file.
+        
+        PARAMS:
+        - infile_meshtree: Input file path of the MeSH tree
+        - cache_file: File path of the cached index (optional)
+        '''
+        stat = os.stat(infile_meshtree)
+        source = {'file': os.path.abspath(infile_meshtree), 
+                  'size': stat.st_size, 'mtime': stat.st_mtime}
+        
+        # Reuse the cached index
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                cache = json.load(open(cache_file, 'r'))
+                if cache['source'] == source:
+                    return cls(cache['tree_numbers'], cache['mesh_terms'])
+            except (ValueError, KeyError):
+                pass
+        
+        # Read in MeSH tree (term; tree number), sort by tree number
+        tree = []
+        with open(infile_meshtree) as fin:
+            for line in fin:
+                line = line.strip().split(';')
+                if len(line) >= 2:
+                    tree.append((line[1], line[0]))
+        tree.sort()
+        index = cls([tree_number for tree_number, _ in tree], 
+                    [mesh_term for _, mesh_term in tree])
+        
+        # Save the cache
+        if cache_file is not None:
+            with open(cache_file+'.tmp', 'w') as fout:
+                json.dump({'source': source, 'tree_numbers': index.tree_numbers,
+                           'mesh_terms': index.mesh_terms}, fout)
+            os.replace(cache_file+'.tmp', cache_file)
+        return index
+
+
+    def descendant_interval(self, root_tree_number):
+        '''
+        FUNCTION:
+        - (start, end) of the sorted tree numbers starting with the root
+        '''
+        start = bisect_left(self.tree_numbers, root_tree_number)
+        if root_tree_number == '':
+            return start, len(self.tree_numbers)
+        # First string after all strings starting with the root
+        after = root_tree_number[:-1] + chr(ord(root_tree_number[-1]) + 1)
+        return start, bisect_left(self.tree_numbers, after, lo=start)
+
+
+    def descendant_terms(self, root_tree_numbers):
+        '''
+        FUNCTION:
+        - MeSH terms of all tree numbers starting with any of the roots
+        
+        PARAMS:
+        - root_tree_numbers (list): Root MeSH tree numbers
+        '''
+        mesh_terms = set()
+        for root_tree_number in root_tree_numbers:
+            if root_tree_number not in self.root2terms:
+                start, end = self.descendant_interval(root_tree_number)
+                self.root2terms[root_tree_number] = frozenset(self.mesh_terms[start:end])
+            mesh_terms.update(self.root2terms[root_tree_number])
+        return mesh_terms
+
+
+
+'''
+PMID bitmaps
+'''
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+class PMIDBitmap(object):
+    '''
+    A set of PMIDs stored as a bitmap: bit p (little-endian within each 
+    byte) is set if PMID p is in the set. At 1 bit per possible PMID, all
+    of PubMed takes a few MB per set, and union (|), intersection (&) and
+    difference (-) are single vectorized operations.
+    '''
+    
+    def __init__(self, bits=None):
+        '''
+        PARAMS:
+        - bits (numpy array of uint8): The packed bits (optional, empty set)
+        '''
+        self.bits = np.zeros(0, dtype=np.uint8) if bits is None else bits
+
+
+    @classmethod
+    def from_pmids(cls, pmids):
+        '''
+        FUNCTION:
+        - Make a bitmap from PMIDs (ints or digit strings, repeats allowed)
+        '''
+        if not isinstance(pmids, np.ndarray):
+            pmids = [int(pmid) for pmid in pmids]
+        pmids = np.asarray(pmids, dtype=np.int64)
+        if len(pmids) == 0:
+            return cls()
+        flags = np.zeros(int(pmids.max())+1, dtype=bool)
+        flags[pmids] = True
+        return cls(np.packbits(flags, bitorder='little'))
+
+
+    def aligned(self, other):
+        # Both bitmaps' bits, padded with zeros to the same length
+        size = max(len(self.bits), len(other.bits))
+        return (np.pad(self.bits, (0, size-len(self.bits))),
+                np.pad(other.bits, (0, size-len(other.bits))))
+
+    def __or__(self, other):
+        bits, other_bits = self.aligned(other)
+        return PMIDBitmap(bits | other_bits)
+
+    def __and__(self, other):
+        size = min(len(self.bits), len(other.bits))
+        return PMIDBitmap(self.bits[:size] & other.bits[:size])
+
+    def __sub__(self, other):
+        bits, other_bits = self.aligned(other)
+        return PMIDBitmap((bits & ~other_bits)[:len(self.bits)])
+
+    def __len__(self):
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def __contains__(self, pmid):
+        try:
+            pmid = int(pmid)
+        except ValueError:
+            return False
+        return 0 <= pmid < 8*len(self.bits) and bool(self.bits[pmid >> 3] >> (pmid & 7) & 1)
+
+
+    def contains(self, pmids):
+        '''
+        FUNCTION:
+        - Membership of many PMIDs at once (numpy array of bool)
+        '''
+        pmids = np.asarray(pmids, dtype=np.int64)
+        found = (pmids >= 0) & (pmids < 8*len(self.bits))
+        inside = pmids[found]
+        found[found] = (self.bits[inside >> 3] >> (inside & 7) & 1).astype(bool)
+        return found
+
+
+    def to_array(self):
+        '''
+        FUNCTION:
+        - Sorted PMIDs (numpy array of uint32)
+        '''
+        return np.flatnonzero(np.unpackbits(self.bits, bitorder='little')).astype(np.uint32)
+
+    def to_strings(self):
+        '''
+        FUNCTION:
+        - Sorted PMIDs as strings (like the JSON files)
+        '''
+        return [str(pmid) for pmid in self.to_array().tolist()]
+
+
+
+class TextCubeBitmaps(object):
+    '''
+    The textcube as one PMIDBitmap per category (category number -> PMIDs),
+    saved compressed as a .npz file.
+    '''
+    
+    def __init__(self, bitmaps):
+        '''
+        PARAMS:
+        - bitmaps (list): PMIDBitmap of each category number
+        '''
+        self.bitmaps = bitmaps
 
+    def __len__(self):
+        return len(self.bitmaps)
+
+    def __getitem__(self, cat_num):
+        return self.bitmaps[cat_num]
+
+    def __iter__(self):
+        return iter(self.bitmaps)
+
+
+    @classmethod
+    def from_category2pmids(cls, category2pmids):
+        '''
+        FUNCTION:
+        - Make the bitmaps from lists of PMIDs (e.g., textcube_category2pmid.json)
+        '''
+        return cls([PMIDBitmap.from_pmids(pmids) for pmids in category2pmids])
+
+
+    @classmethod
+    def load(cls, textcube_file):
+        '''
+        FUNCTION:
+        - Load the bitmaps from a .npz file, or make them from a 
+          textcube_pmid2category.json file ([[PMID, category number],...])
+        '''
+        if textcube_file.endswith('.npz'):
+            with np.load(textcube_file) as data:
+                num_cat = int(data['num_cat'])
+                return cls([PMIDBitmap(data['category_'+str(cat_num)]) 
+                            for cat_num in range(num_cat)])
+        
+        category2pmids = dict()
+        for pmid, cat_num in json.load(open(textcube_file, 'r')):
+            if pmid == 'doc_id':
+                continue
+            category2pmids.setdefault(int(cat_num), []).append(pmid)
+        num_cat = max(category2pmids) + 1 if category2pmids else 0
+        return cls.from_category2pmids([category2pmids.get(cat_num, []) 
+                                        for cat_num in range(num_cat)])
+
+
+    def save(self, textcube_file):
+        '''
+        FUNCTION:
+        - Save the bitmaps as a compressed .npz file
+        '''
+        arrays = {'category_'+str(cat_num): bitmap.bits 
+                  for cat_num, bitmap in enumerate(self.bitmaps)}
+        with open(textcube_file+'.tmp', 'wb') as fout:
+            np.savez_compressed(fout, num_cat=len(self.bitmaps), **arrays)
+        os.replace(textcube_file+'.tmp', textcube_file)
+
+
+    def union(self, cat_nums=None):
+        '''
+        FUNCTION:
+        - PMIDs in any of the categories (all categories by default)
+        '''
+        cat_nums = range(len(self.bitmaps)) if cat_nums is None else cat_nums
+        union = PMIDBitmap()
+        for cat_num in cat_nums:
+            union = union | self.bitmaps[cat_num]
+        return union
+
+    def intersection(self, cat_nums):
+        '''
+        FUNCTION:
+        - PMIDs in all of the categories
+        '''
+        cat_nums = list(cat_nums)
+        if len(cat_nums) == 0:
+            return PMIDBitmap()
+        intersection = self.bitmaps[cat_nums[0]]
+        for cat_num in cat_nums[1:]:
+            intersection = intersection & self.bitmaps[cat_num]
+        return intersection
+
+    def difference(self, cat_num, other_cat_nums):
+        '''
+        FUNCTION:
+        - PMIDs in the category, but in none of the other categories
+        '''
+        return self.bitmaps[cat_num] - self.union(other_cat_nums)
+
+    def categories_of(self, pmid):
+        '''
+        FUNCTION:
+        - Category numbers of one PMID
+        '''
+        return [cat_num for cat_num, bitmap in enumerate(self.bitmaps) if pmid in bitmap]
+
+    def cardinalities(self):
+        '''
+        FUNCTION:
+        - Number of PMIDs per category
+        '''
+        return [len(bitmap) for bitmap in self.bitmaps]
+
+
+
+'''
+TextCube
+'''
 class TextCube(object):
     def __init__(self,category_names):
         self.category_names = category_names
-        self.category2pmids = [set() for _ in range(len(self.category_names))]
+        self.category2pmids = None # TextCubeBitmaps, category number -> PMIDs
         self.concerned_cat = []
-        self.pmid2category = []
 
         
     def descendant_mesh(self, infile_root_cat, infile_meshtree, 
-                        outfile_meshterms_percat, logfile):
+                        outfile_meshterms_percat, logfile, meshtree_cache=None):
         '''
         FUNCTION:
         - Starting from the category's root node tree number, 
@@ -24,6 +338,7 @@ class TextCube(object):
         - outfile_meshterms_percat: Output file path of where the
           list of each category's MeSH terms will be saved
         - logfile: Output file path, writes progress
+        - meshtree_cache: File path of the cached MeSH tree index (optional)
         '''
         
         # Print update about which step is running
@@ -40,30 +355,13 @@ class TextCube(object):
         self.num_cat = len(self.concerned_cat)
         
         
-        # MeSH terms in each category
-        self.mesh_terms_per_cat = [set() for _ in range(self.num_cat)]
+        # Read in MeSH tree (term; tree number), sorted by tree number
+        self.meshtree_index = MeSHTreeIndex.load(infile_meshtree, meshtree_cache)
         
         
-        # Read in MeSH tree (term; tree number)
-        with open(infile_meshtree) as fin:
-            for line in fin:
-                line = line.strip().split(';')
-
-                # MeSH Term, Tree Number
-                mesh_term = line[0]
-                tree_number = line[1]
-
-                # For each category
-                for cat_num, root_tree_numbers in enumerate(self.concerned_cat):
-
-                    # For each root tree number in the category
-                    for root_tree_number in root_tree_numbers:
-
-                        # If this tree number is a descendant of the root
-                        if tree_number.startswith(root_tree_number):
-
-                            # Then save its MeSH term
-                            self.mesh_terms_per_cat[cat_num].add(mesh_term)
+        # MeSH terms in each category (descendants of its root tree numbers)
+        self.mesh_terms_per_cat = [self.meshtree_index.descendant_terms(root_tree_numbers)
+                                   for root_tree_numbers in self.concerned_cat]
 
                             
         # Output number of MeSH terms per category
@@ -85,7 +383,8 @@ class TextCube(object):
         - Map categories to PMIDs (e.g., Disease Category : [PMIDs studying the disease category])
 
         PARAMS:
-        - input_file_mesh2pmid: Input file path, stores the MeSH-PMIDs mappings
+        - input_file_mesh2pmid: Input path, stores the MeSH-PMIDs mappings. Either
+          the index directory of step 03 (memory-mapped) or the older JSON file
         - output_file_textcube_category2pmid: Output file path, stores Category-PMIDs
         - logfile: Output file path, stores progress
         '''
@@ -96,6 +395,40 @@ class TextCube(object):
         print(msg)
 
         start = time.time()
+        if os.path.isdir(input_file_mesh2pmid):
+            self.category2pmids_from_index(input_file_mesh2pmid)
+        else:
+            self.category2pmids_from_json(input_file_mesh2pmid, logfile)
+        msg = 'Mapped categories to PMIDs. '+str(round(time.time()-start,4))+' seconds'
+        logfile.write(msg+'\n')
+        print(msg)
+        
+        # Export one category at a time ([[PMIDs of category 0], ...])
+        with open(output_file_textcube_category2pmid, 'w') as fout:
+            fout.write('[')
+            for cat_num, bitmap in enumerate(self.category2pmids):
+                fout.write(', ' if cat_num > 0 else '')
+                json.dump(bitmap.to_strings(), fout)
+            fout.write(']')
+
+        # Print result summary
+        for cat_num, name in enumerate(self.category_names):    
+            logfile.write(name + " includes " + str(len(self.category2pmids[cat_num])) + " documents. \n")
+   
+
+
+    def category2pmids_from_json(self, input_file_mesh2pmid, logfile):
+        '''
+        FUNCTION:
+        - Map categories to PMIDs from the older JSON file, one 
+          {"MeSH":[PMIDs]} per line
+
+        PARAMS:
+        - input_file_mesh2pmid: Input file path, stores the MeSH-PMIDs mappings
+        - logfile: Output file path, stores progress
+        '''
+        start = time.time()
+        category2pmids = [set() for _ in range(self.num_cat)]
         for input_index, line in enumerate(open(input_file_mesh2pmid)):
 
             # Print progress
@@ -117,18 +450,28 @@ class TextCube(object):
                 if mesh in self.mesh_terms_per_cat[cat_num]:
 
                     # Add: Category -has-> PMIDs
-                    self.category2pmids[cat_num] = \
-                    self.category2pmids[cat_num].union(set(pmids)) 
+                    category2pmids[cat_num].update(pmids)
 
-        # Switch sets to lists, export                
-        for category in range(len(self.category2pmids)):
-            self.category2pmids[category] = list(self.category2pmids[category])
-        json.dump(self.category2pmids, open(output_file_textcube_category2pmid, 'w'))
+        # Switch sets to bitmaps
+        self.category2pmids = TextCubeBitmaps.from_category2pmids(category2pmids)
+
+
+
+    def category2pmids_from_index(self, index_dir):
+        '''
+        FUNCTION:
+        - Map categories to PMIDs from the MeSH-PMIDs index: each category's 
+          MeSH terms' PMID arrays go straight into the category's bitmap, 
+          without making Python strings.
+
+        PARAMS:
+        - index_dir: Input directory, the MeSH-PMIDs index of step 03
+        '''
+        mesh2pmids = MeSHPostings(index_dir)
+        self.category2pmids = TextCubeBitmaps([
+            PMIDBitmap.from_pmids(mesh2pmids.union(self.mesh_terms_per_cat[cat_num]))
+            for cat_num in range(self.num_cat)])
 
-        # Print result summary
-        for cat_num, name in enumerate(self.category_names):    
-            logfile.write(name + " includes " + str(len(self.category2pmids[cat_num])) + " documents. \n")
-   
 
 
     def pmid2category_mapping(self, output_file_textcube_pmid2category, logfile):
@@ -144,11 +487,31 @@ class TextCube(object):
         logfile.write(msg+'\n============================================== \n')
         print(msg)
         
-        for cat_num in range(self.num_cat):
-            for cur_pmid in self.category2pmids[cat_num]:
-                self.pmid2category.append([cur_pmid, cat_num])
+        # Export one category at a time, from the bitmaps
+        with open(output_file_textcube_pmid2category, 'w') as fout:
+            fout.write('[')
+            first = True
+            for cat_num, bitmap in enumerate(self.category2pmids):
+                for cur_pmid in bitmap.to_array().tolist():
+                    fout.write(('' if first else ', ')+'["'+str(cur_pmid)+'", '+str(cat_num)+']')
+                    first = False
+            fout.write(']')
+
+
+    def save_bitmaps(self, output_file_textcube_bitmaps, logfile):
+        '''
+        FUNCTION:
+        - Save the category bitmaps (category number -> PMIDs) as a .npz file,
+          read by the synonym counting and metadata update steps
         
-        json.dump(self.pmid2category, open(output_file_textcube_pmid2category, 'w'))
+        PARAMS:
+        - output_file_textcube_bitmaps: Output file path (.npz)
+        - logfile: Output file path, stores progress
+        '''
+        msg = 'Saving textcube bitmaps: '+output_file_textcube_bitmaps
+        logfile.write(msg+'\n')
+        print(msg)
+        self.category2pmids.save(output_file_textcube_bitmaps)
             
 
             
@@ -170,20 +533,9 @@ class TextCube(object):
 
         # Open output file to write stats to
         with open(outputfile_textcube_stat, 'w') as fout:
-            all_pmids = [] 
-            category_count = [0]*self.num_cat
 
             # Get PMID & Category counts
-            for pmid2catnum in self.pmid2category:
-
-                # PMID
-                pmid = pmid2catnum[0]
-                all_pmids.append(pmid)
-
-                # Category
-                cat_num = pmid2catnum[1]
-                category_count[cat_num] += 1
-
+            category_count = self.category2pmids.cardinalities()
 
             # Write PMID & Category counts
             print('\nCategory: Documents (From All Years)\n'+'='*19)
@@ -194,8 +546,7 @@ class TextCube(object):
                 fout.write(msg+'\n')
                 print(msg)
                 
-            num_documents = str("{:,}".format(len(set(all_pmids))))
+            num_documents = str("{:,}".format(len(self.category2pmids.union())))
             msg = 'TOTAL: '+ num_documents
             fout.write(msg+'\n')
             print(msg)
-
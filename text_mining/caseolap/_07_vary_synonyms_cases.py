@@ -68,27 +68,7 @@ class VarySynonymsCases(object):
         PARAMS: 
         - synonym = synonym you want to case-vary
         '''
-        indices_of_words_to_be_case_varied = list()
-        
-        
-        # Check all words in the synonym
-        synonym_as_list = synonym.replace('-', ' - ').replace('/','/ ').split(' ')
-        
-        for word_ind, word in enumerate(synonym_as_list):
-            if word == '': 
-                continue
-                
-            # Uppercase word to be case-varied, e.g., Peroxidase, not PrEP
-            good_upper_case = (word[0].isupper() and word[1:].replace('/','').islower()) 
-            
-            # Lowercase word to be case-varied, e.g., perodixase
-            good_lower_case = word.replace('/','').islower()  
-            
-            # If it should be case-varied, store the index
-            if (good_upper_case or good_lower_case) and word.replace('/','').isalpha():
-                indices_of_words_to_be_case_varied.append(word_ind)
-                
-        return indices_of_words_to_be_case_varied
+        return vary_case_inds(synonym)
 
 
 
@@ -256,6 +236,44 @@ class VarySynonymsCases(object):
 
 
                     
+    def export_canonical_syns(self, canonical_entity_dict_path):
+        '''
+        FUNCTION:
+        - Save the entity dictionary without case-varying the synonyms 
+          (one canonical synonym each, duplicates and empty names removed).
+          Step 08 matches these with their case-fold masks (case_fold_mask)
+          instead of searching every case-varied synonym.
+
+        PARAMS:
+        - canonical_entity_dict_path: Output file path (JSON, ID:[syns])
+        '''
+        json.dump(self.canonical_syns(), open(canonical_entity_dict_path, 'w'))
+
+
+    def canonical_syns(self):
+        '''
+        FUNCTION:
+        - ID -> synonyms as they are (not case-varied), without duplicates
+          or empty names
+        '''
+        id2canonical_syns = dict()
+        for ID, syns in self.id2syns.items():
+            syns = [syn.replace('_',' ') for syn in syns if type(syn) == str and len(syn) > 0]
+            id2canonical_syns[ID] = list(dict.fromkeys(syns))
+        return id2canonical_syns
+
+
+    def gets_canonical_syns(self):
+        '''
+        FUNCTION:
+        - Instead of gets_final_syns: write the synonyms without case-varying
+          them, in the same format (ID|synonym|...) 
+        '''
+        with open(self.case_varied_entites_path, 'w') as fout:
+            for ID, syns in self.canonical_syns().items():
+                fout.write(ID+'|'+'|'.join(syns)+'\n')
+
+
     def gets_final_syns(self):
         '''
         FUNCTION: 
@@ -301,6 +319,82 @@ class VarySynonymsCases(object):
             
             
             
+def vary_case_inds(synonym):
+    '''
+    FUNCTION: 
+    Return the locations of the words to case-vary (not acronyms), 
+    see VarySynonymsCases.vary_case_inds
+    '''
+    indices_of_words_to_be_case_varied = list()
+    
+    
+    # Check all words in the synonym
+    synonym_as_list = synonym.replace('-', ' - ').replace('/','/ ').split(' ')
+    
+    for word_ind, word in enumerate(synonym_as_list):
+        if word == '': 
+            continue
+            
+        # Uppercase word to be case-varied, e.g., Peroxidase, not PrEP
+        good_upper_case = (word[0].isupper() and word[1:].replace('/','').islower()) 
+        
+        # Lowercase word to be case-varied, e.g., perodixase
+        good_lower_case = word.replace('/','').islower()  
+        
+        # If it should be case-varied, store the index
+        if (good_upper_case or good_lower_case) and word.replace('/','').isalpha():
+            indices_of_words_to_be_case_varied.append(word_ind)
+            
+    return indices_of_words_to_be_case_varied
+
+
+
+def case_fold_mask(synonym):
+    '''
+    FUNCTION:
+    - The positions of the characters of a synonym whose case may vary 
+      when matching it: the first letter of each word that would be 
+      case-varied (vary_case_inds). Matching the synonym with these 
+      characters in any case is the same as matching any of its case-varied
+      synonyms, e.g., 'Fake PrO-10 name' -> [0, 12] matches 'fake PrO-10 Name'.
+
+    PARAMS:
+    - synonym (str): The canonical synonym
+    
+    OUTPUT:
+    - mask (list): Character positions in the synonym
+    '''
+    mask = list()
+    word_inds = set(vary_case_inds(synonym))
+    position = 0
+    for word_ind, word in enumerate(synonym.replace('-', ' - ').replace('/','/ ').split(' ')):
+        if word == '':
+            continue
+        position = synonym.find(word, position)
+        if word_ind in word_inds:
+            mask.append(position)
+        position += len(word)
+    return mask
+
+
+
+def case_variants(synonym):
+    '''
+    FUNCTION:
+    - All case-varied versions of a synonym (both cases of the characters
+      in its case_fold_mask), e.g., for queries that can't fold the case
+    '''
+    variants = ['']
+    last = 0
+    for position in case_fold_mask(synonym):
+        char = synonym[position]
+        variants = [variant + synonym[last:position] + case 
+                    for variant in variants for case in dict.fromkeys([char, char.swapcase()])]
+        last = position + 1
+    return [variant + synonym[last:] for variant in variants]
+
+
+
 def multiprocess_a_dict_of_keys_and_lists_values(thedict, the_function):
     '''
     FUNCTION:
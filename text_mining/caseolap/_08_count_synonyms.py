@@ -1,25 +1,465 @@
-import sys, json, time, os
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search, Q
-from multiprocessing import cpu_count, Process
+import sys, json, time, os, re, heapq
+from array import array
+import numpy as np
+from multiprocessing import cpu_count, Process, Queue
+from concurrent.futures import ThreadPoolExecutor
+from text_mining.caseolap._02_parsing import iter_parsed_records
+from text_mining.caseolap._06_textcube import PMIDBitmap, TextCubeBitmaps
+from text_mining.caseolap._07_vary_synonyms_cases import case_fold_mask, case_variants
 
+
+'''
+Local synonym matching (Aho-Corasick)
+'''
+def replace_hyphens(text):
+    # Replace hyphens not at end of word (w/spaces), as in the indexed search
+    return text.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
+
+
+def synonym_pattern(syn, case_fold=False):
+    '''
+    FUNCTION:
+    - The synonym as counted in the documents' sections (hyphens replaced)
+      and, with case_fold, a regular expression matching it with the 
+      characters of its case-fold mask in either case (case_fold_mask). 
+      One canonical synonym then matches all of its case-varied synonyms.
+    
+    OUTPUT:
+    - pattern (str): The synonym, hyphens replaced
+    - regex (compiled regular expression): None if nothing is case-folded
+    '''
+    pattern = replace_hyphens(syn+' ')
+    if not case_fold:
+        return pattern, None
+    
+    # Mask positions in the pattern (leading spaces are stripped from it)
+    unstripped = (syn+' ').replace('- ','@$#!').replace('-',' ').replace('@$#!','- ')
+    lead = len(unstripped) - len(unstripped.lstrip())
+    folded = set(position - lead for position in case_fold_mask(syn))
+    if not folded:
+        return pattern, None
+    regex = ''.join('[' + re.escape(char.lower()) + re.escape(char.upper()) + ']' 
+                    if position in folded else re.escape(char)
+                    for position, char in enumerate(pattern))
+    return pattern, re.compile(regex)
+
+
+def count_pattern(section, pattern, regex=None):
+    '''
+    FUNCTION:
+    - Non-overlapping occurrences of the synonym in a section (str.count,
+      or the case-folded regular expression from synonym_pattern)
+    '''
+    if regex is None:
+        return section.count(pattern)
+    return len(regex.findall(section))
+
+
+class SynonymAutomaton(object):
+    '''
+    All synonyms compiled into one Aho-Corasick automaton, so a document is
+    scanned once for every synonym. The automaton matches the lowercase 
+    text, then each match is checked against the synonym's case. As in the
+    (case-sensitive) indexed search, a synonym is counted in a document 
+    where it appears as whole words in the same case, and the count is the
+    str.count of the synonym in each section (same case, non-overlapping). 
+    With case_fold, the case of the characters in each synonym's case-fold
+    mask is ignored (synonym_pattern). Requires pyahocorasick.
+    '''
+    
+    def __init__(self, synonyms, case_fold=False):
+        '''
+        PARAMS:
+        - synonyms (list): The synonyms (hyphens are replaced when matching)
+        - case_fold (bool): Whether the synonyms are canonical synonyms
+          matched with their case-fold masks
+        '''
+        try:
+            import ahocorasick
+        except ImportError:
+            raise ImportError('pyahocorasick is needed to count synonyms without '
+                              'ElasticSearch (pip install pyahocorasick)')
+        
+        # Synonym as matched -> original synonyms
+        self.patterns = []
+        self.regexes = []
+        self.pattern2syns = []
+        pattern2num = dict()
+        for syn in synonyms:
+            pattern, regex = synonym_pattern(syn, case_fold)
+            if pattern == '':
+                continue
+            pattern_key = (pattern, None if regex is None else regex.pattern)
+            if pattern_key not in pattern2num:
+                pattern2num[pattern_key] = len(self.patterns)
+                self.patterns.append(pattern)
+                self.regexes.append(regex)
+                self.pattern2syns.append([])
+            self.pattern2syns[pattern2num[pattern_key]].append(syn)
+        
+        # Lowercase synonym -> synonyms (matched in lowercase text)
+        lower2nums = dict()
+        for pattern_num, pattern in enumerate(self.patterns):
+            lower2nums.setdefault(pattern.lower(), []).append(pattern_num)
+        
+        # Compile the automaton
+        self.automaton = ahocorasick.Automaton()
+        for lower, pattern_nums in lower2nums.items():
+            self.automaton.add_word(lower, (len(lower), pattern_nums))
+        self.automaton.make_automaton()
+
+
+    def count(self, sections):
+        '''
+        FUNCTION:
+        - Count the synonyms in a document's sections
+        
+        PARAMS:
+        - sections (list): The document's texts (e.g., title, abstract), 
+          hyphens already replaced
+        
+        OUTPUT:
+        - syn2count (dict): Original synonym -> count, for the synonyms
+          found as whole words in the same case
+        '''
+        pattern2count = dict()
+        whole_word_patterns = set()
+        
+        for section in sections:
+            # Match in lowercase, at the same positions (characters whose
+            # lowercase is longer, e.g. 'İ', are kept as they are)
+            lower = section.lower()
+            if len(lower) != len(section):
+                lower = ''.join(char if len(char.lower()) != 1 else char.lower()
+                                for char in section)
+            
+            last_end = dict()
+            for end, (length, pattern_nums) in self.automaton.iter(lower):
+                start = end - length + 1
+                whole_word = (start == 0 or not lower[start-1].isalnum()) and \
+                             (end+1 == len(lower) or not lower[end+1].isalnum())
+                
+                for pattern_num in pattern_nums:
+                    # Only same-case occurrences (as count_pattern)
+                    regex = self.regexes[pattern_num]
+                    if regex is None:
+                        same_case = section[start:end+1] == self.patterns[pattern_num]
+                    else:
+                        same_case = regex.fullmatch(section[start:end+1]) is not None
+                    if not same_case:
+                        continue
+                    if whole_word:
+                        whole_word_patterns.add(pattern_num)
+                    
+                    # Count non-overlapping occurrences
+                    if start <= last_end.get(pattern_num, -1):
+                        continue
+                    last_end[pattern_num] = end
+                    pattern2count[pattern_num] = pattern2count.get(pattern_num, 0) + 1
+        
+        syn2count = dict()
+        for pattern_num in whole_word_patterns:
+            for syn in self.pattern2syns[pattern_num]:
+                syn2count[syn] = pattern2count.get(pattern_num, 0)
+        return syn2count
+
+
+
+'''
+Indexed search (ElasticSearch)
+'''
+# Indexed fields searched for each key
+KEY2FIELDS = {'abstract': ['title', 'abstract'],
+              'full_text': ['abstract', 'title', 'full_text'],
+              'full_text_no_methods': ['abstract', 'title', 'introduction', 
+                                       'results', 'discussion']}
+
+
+def phrase_query(syn, key, name=None, case_fold=False):
+    '''
+    FUNCTION:
+    - Query for the publications with the synonym (phrase) in the sections
+      of the key. With a name, each clause is named, so the hits report
+      the synonym in meta.matched_queries.
+    
+    PARAMS:
+    - syn (str): The synonym
+    - key (str): 'abstract', 'full_text' or 'full_text_no_methods'
+    - name (str): Name of the query, or None
+    - case_fold (bool): Whether to match the synonym's case-varied versions
+      too (the index is case sensitive, so they are clauses of the query)
+    '''
+    from elasticsearch_dsl import Q
+    if key not in KEY2FIELDS:
+        print("ERROR: Key is neither 'abstract' nor 'full_text'")
+        sys.exit()
+    phrases = case_variants(syn) if case_fold else [syn]
+    if name is None:
+        clauses = [Q('match_phrase', **{field: phrase}) 
+                   for phrase in phrases for field in KEY2FIELDS[key]]
+    else:
+        clauses = [Q('match_phrase', **{field: {'query': phrase, '_name': name}}) 
+                   for phrase in phrases for field in KEY2FIELDS[key]]
+    return Q('bool', should=clauses, minimum_should_match=1)
+
+
+def hit_sections(hit, key):
+    '''
+    FUNCTION:
+    - The searched sections of a hit (e.g., abstract, title), hyphens not
+      at end of word replaced (w/spaces)
+    '''
+    sections = []
+    for field in KEY2FIELDS[key]:
+        text = getattr(hit, field, None)
+        if type(text) == str:
+            sections.append(replace_hyphens(text))
+    return sections
+
+
+def source_fields(key):
+    '''
+    FUNCTION:
+    - Fields of the hits needed for counting
+    '''
+    return ['pmid', 'year'] + KEY2FIELDS[key]
+
+
+
+'''
+Synonym count store
+'''
+class SynonymCounts(object):
+    '''
+    Reads the synonym counts saved by save_synonym_counts. The store is a 
+    directory with:
+    - synonyms.json: Synonyms, the synonym number is the position in the list
+    - pmids.npy, synonyms.npy, counts.npy: One (PMID, synonym number, count)
+      per row (uint32), sorted by PMID then synonym number
+    - synonym_order.npy: Rows sorted by synonym number then PMID
+    - synonym_offsets.npy: Synonym number -> start of its rows in synonym_order
+    The arrays are memory-mapped, so looking up a PMID or a synonym only 
+    reads its rows.
+    '''
+    
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.synonyms = json.load(open(os.path.join(store_dir, 'synonyms.json'), 'r'))
+        self.syn2num = {syn:num for num, syn in enumerate(self.synonyms)}
+        self.pmids, self.syn_nums, self.counts, self.synonym_order, self.synonym_offsets = \
+            [np.load(os.path.join(store_dir, name+'.npy'), mmap_mode='r') 
+             for name in SYNONYM_COUNT_ARRAYS]
+    
+    @classmethod
+    def load(cls, path):
+        '''
+        FUNCTION:
+        - Read the counts from the store directory, or from the older 
+          pmid_synonym_counts JSON file ({PMID:{Synonym:Count,...},...}),
+          which is converted to a store in memory
+        '''
+        if os.path.isdir(path):
+            return cls(path)
+        store = cls.__new__(cls)
+        store.store_dir = None
+        store.syn2num = dict()
+        rows = [array('I'), array('I'), array('I')]
+        for pmid, syn2cnt in json.load(open(path, 'r')).items():
+            for syn, count in syn2cnt.items():
+                for column, value in zip(rows, (int(pmid), store.syn2num.setdefault(syn, len(store.syn2num)), count)):
+                    column.append(value)
+        store.synonyms = sorted(store.syn2num, key=store.syn2num.get)
+        store.pmids, store.syn_nums, store.counts, store.synonym_order, store.synonym_offsets = \
+            sort_synonym_counts(len(store.synonyms), *[np.frombuffer(column, dtype=np.uint32) for column in rows])
+        return store
+    
+    def __len__(self):
+        return len(self.pmids)
+    
+    def unique_pmids(self):
+        '''
+        FUNCTION:
+        - Sorted PMIDs with any synonym count (numpy array of uint32)
+        '''
+        if len(self.pmids) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        return np.asarray(self.pmids[np.concatenate(([True], self.pmids[1:] != self.pmids[:-1]))])
+    
+    def by_pmid(self, pmid):
+        '''
+        FUNCTION:
+        - Synonym -> count of one PMID (empty if none was found)
+        '''
+        start, end = np.searchsorted(self.pmids, [int(pmid), int(pmid)+1])
+        return {self.synonyms[num]: count for num, count in 
+                zip(self.syn_nums[start:end].tolist(), self.counts[start:end].tolist())}
+    
+    def by_synonym(self, syn):
+        '''
+        FUNCTION:
+        - PMIDs and counts of one synonym (numpy arrays, sorted by PMID)
+        '''
+        num = self.syn2num.get(syn)
+        if num is None:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+        rows = self.synonym_order[self.synonym_offsets[num]:self.synonym_offsets[num+1]]
+        return self.pmids[rows], self.counts[rows]
+    
+    def items(self, rows_per_chunk=1000000):
+        '''
+        FUNCTION:
+        - Iterate through (PMID, {Synonym:Count,...}) in PMID order, like 
+          the items of the older nested dictionary, reading the arrays in
+          chunks
+        '''
+        pmid, syn2cnt = None, dict()
+        for start in range(0, len(self.pmids), rows_per_chunk):
+            end = start + rows_per_chunk
+            for row_pmid, num, count in zip(self.pmids[start:end].tolist(), 
+                                            self.syn_nums[start:end].tolist(),
+                                            self.counts[start:end].tolist()):
+                if row_pmid != pmid:
+                    if pmid is not None:
+                        yield str(pmid), syn2cnt
+                    pmid, syn2cnt = row_pmid, dict()
+                syn2cnt[self.synonyms[num]] = count
+        if pmid is not None:
+            yield str(pmid), syn2cnt
+    
+    def export_json(self, outfile):
+        '''
+        FUNCTION:
+        - Export the older {PMID:{Synonym:Count,...},...} JSON file, one 
+          PMID at a time
+        '''
+        with open(outfile, 'w') as fout:
+            fout.write('{')
+            for num, (pmid, syn2cnt) in enumerate(self.items()):
+                fout.write((', ' if num > 0 else '')+json.dumps(pmid)+': '+json.dumps(syn2cnt))
+            fout.write('}')
+
+
+SYNONYM_COUNT_ARRAYS = ['pmids', 'synonyms', 'counts', 'synonym_order', 'synonym_offsets']
+
+
+def sort_synonym_counts(num_synonyms, pmids, syn_nums, counts):
+    '''
+    FUNCTION:
+    - Sort (PMID, synonym number, count) rows by PMID then synonym number,
+      adding up the counts of repeated (PMID, synonym), and index the rows
+      by synonym (see SynonymCounts)
+    
+    OUTPUT:
+    - pmids, syn_nums, counts, synonym_order, synonym_offsets (numpy arrays)
+    '''
+    order = np.lexsort((syn_nums, pmids))
+    pmids, syn_nums, counts = pmids[order], syn_nums[order], counts[order]
+    if len(pmids) > 0:
+        first = np.flatnonzero(np.concatenate(([True], (pmids[1:] != pmids[:-1]) |
+                                                       (syn_nums[1:] != syn_nums[:-1]))))
+        counts = np.add.reduceat(counts.astype(np.uint64), first).astype(np.uint32)
+        pmids, syn_nums = pmids[first], syn_nums[first]
+    synonym_order = np.argsort(syn_nums, kind='stable').astype(np.uint32)
+    synonym_offsets = np.concatenate(([0], np.cumsum(np.bincount(syn_nums, minlength=num_synonyms)))).astype(np.int64)
+    return pmids, syn_nums, counts, synonym_order, synonym_offsets
+
+
+def save_synonym_counts(store_dir, synonyms, pmids, syn_nums, counts):
+    '''
+    FUNCTION:
+    - Save (PMID, synonym number, count) rows as a synonym count store
+      (see SynonymCounts)
+    
+    PARAMS:
+    - store_dir (str): Output directory
+    - synonyms (list): Synonyms, indexed by synonym number
+    - pmids, syn_nums, counts (numpy arrays of uint32): One row per 
+      (PMID, synonym) found, in any order
+    '''
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    arrays = sort_synonym_counts(len(synonyms), pmids, syn_nums, counts)
+    
+    # Save each file under a temporary name, then rename it
+    for name, array_data in zip(SYNONYM_COUNT_ARRAYS, arrays):
+        with open(os.path.join(store_dir, name+'.npy.tmp'), 'wb') as fout:
+            np.save(fout, array_data)
+        os.replace(os.path.join(store_dir, name+'.npy.tmp'), os.path.join(store_dir, name+'.npy'))
+    with open(os.path.join(store_dir, 'synonyms.json.tmp'), 'w') as fout:
+        json.dump(synonyms, fout)
+    os.replace(os.path.join(store_dir, 'synonyms.json.tmp'), os.path.join(store_dir, 'synonyms.json'))
+
+
+
+def cost_balanced_batches(synonyms, syn2cost, synonyms_per_query=1):
+    '''
+    FUNCTION:
+    - Split the synonyms into query batches of similar total cost (hits):
+      each synonym, most hits first, goes to the batch with the lowest 
+      cost so far. A batch is closed once it holds synonyms_per_query 
+      synonyms or its cost reaches the average, so a very common synonym
+      is searched in a batch of its own.
+    
+    PARAMS:
+    - synonyms (list): The synonyms
+    - syn2cost (dict): Estimated hits per synonym (estimate_synonym_hits)
+    - synonyms_per_query (int): Maximum synonyms per batch
+    
+    OUTPUT:
+    - batches (list of lists): The batches, most costly first
+    '''
+    batch_size = max(synonyms_per_query, 1)
+    num_batches = max(-(-len(synonyms)//batch_size), 1)
+    
+    # Each query also costs something without hits
+    syn2cost = {syn: syn2cost.get(syn, 0)+1 for syn in synonyms}
+    target = sum(syn2cost.values())/num_batches
+    
+    # Open batches as (cost, batch number)
+    batches, batch_costs = [[] for _ in range(num_batches)], [0]*num_batches
+    open_batches = [(0, b) for b in range(num_batches)]
+    for syn in sorted(synonyms, key=lambda syn: -syn2cost[syn]):
+        if len(open_batches) > 0:
+            cost, b = heapq.heappop(open_batches)
+        else:
+            cost, b = 0, len(batches)
+            batches.append([])
+            batch_costs.append(0)
+        batches[b].append(syn)
+        batch_costs[b] = cost+syn2cost[syn]
+        if len(batches[b]) < batch_size and batch_costs[b] < target:
+            heapq.heappush(open_batches, (batch_costs[b], b))
+    
+    order = sorted(range(len(batches)), key=lambda b: -batch_costs[b])
+    return [batches[b] for b in order if len(batches[b]) > 0]
+
+
+
+'''
+Synonym counting
+'''
 class CountSynonyms(object):
     
-    def __init__(self, entity_dict_path, textcube_pmid2category):
+    def __init__(self, entity_dict_path, textcube_pmid2category, case_fold=False):
         '''
         FUNCTION:
         Initialize class attributes.
         - entity_dict: Dictionary. ID to synonyms/names.
         - synonyms: List. Entity synonyms/names. 
-        - pmid_and_cat: List of lists [[PMID1:Cat_0],...,[PMID_N:Cat_n]]
-        - relevant_pmids: PMIDs for publications studying the categories
-          of interest.
-        - pmid_syn_cnt: Dictionary of dictionaries. Synonyms to PMIDs to 
-          Synonym Counts. 
+        - textcube: TextCubeBitmaps. Category number -> PMIDs bitmap.
+        - relevant_pmids: PMIDBitmap. PMIDs for publications studying the 
+          categories of interest.
+        - pmid_syn_cnt: SynonymCounts. PMIDs to Synonyms to Synonym Counts
+          (after get_synonyms_pmid_counts).
+        - case_fold: Bool. Whether the synonyms are canonical (not 
+          case-varied) and matched with their case-fold masks.
         
         PARAMS:
         - entity_dict_path: Input file path. Where the entity_dict is stored.
-        - textcube_pmid2category: Input file path. Maps PMIDs to category.
+        - textcube_pmid2category: Input file path. Maps PMIDs to category,
+          either the textcube bitmaps (.npz) or textcube_pmid2category.json
+        - case_fold: Whether to match the synonyms' case-varied versions 
+          (step 07 case_fold_mask), e.g., the canonical entity dict
         '''
         # Make entity dict
         self.id2syns = json.load(open(entity_dict_path))
@@ -30,14 +470,17 @@ class CountSynonyms(object):
         synonyms = list(set(synonyms))
         self.synonyms = [syn.replace('_',' ').strip('\n') for syn in synonyms]
             
-        # PMID-Category ([[PMID1:Cat_0],...,[PMID_N:Cat_n]])
-        self.pmid_and_cat = json.load(open(textcube_pmid2category))
+        # Category -> PMIDs bitmaps
+        self.textcube = TextCubeBitmaps.load(textcube_pmid2category)
         
-        # PMIDs of interest
-        self.relevant_pmids = set(map(lambda x: x[0], self.pmid_and_cat))
+        # PMIDs of interest (in any category)
+        self.relevant_pmids = self.textcube.union()
         
         # Synonym Count per PMID
-        self.pmid_syn_cnt = dict()
+        self.pmid_syn_cnt = None
+        
+        # Match the case-varied versions of the synonyms
+        self.case_fold = case_fold
     
     
 
@@ -63,97 +506,58 @@ class CountSynonyms(object):
         - start_year (int): The earliest year of publications you want to look at
         - end_year (int): The latest year of publications you want to look at
         '''
+        from elasticsearch_dsl import Search, Q
         
-        # Open output path
+        # Open output path (appending: a process counts many batches)
         temp_logfile = logfile[:-4]+'_'+str(b_id)+'.txt'
         temp_pmid_syn_cnt_path = pmid_syn_cnt_path[:-4]+'_'+str(b_id)+'.txt'
         
-        with open(temp_pmid_syn_cnt_path,'w') as fout1,\
-               open(temp_logfile,'w') as fout2:
+        with open(temp_pmid_syn_cnt_path,'a') as fout1,\
+               open(temp_logfile,'a') as fout2:
         
             # For each synonym from a list of all synonyms
-            total_size = len(batch)
-            for syn_index, syn in enumerate(batch):
-                                
-                # Print progress
-                if b_id == 1:
-                    print('Batch 1 Progress:', syn_index,'/',total_size, end='\r')
+            for syn in batch:
                 
                 # Define the query
-                if key == "abstract":
-                    query = Q("match_phrase", title=syn) |\
-                            Q("match_phrase", abstract=syn)
-                elif key == "full_text":
-                    query = Q("match_phrase", abstract=syn) | \
-                            Q("match_phrase", title=syn) | \
-                            Q("match_phrase", full_text=syn)
-                elif key == 'full_text_no_methods':
-                     query = Q("match_phrase", abstract=syn) | \
-                             Q("match_phrase", title=syn) | \
-                             Q("match_phrase", introduction=syn) | \
-                             Q("match_phrase", results=syn) | \
-                             Q("match_phrase", discussion=syn)
-                else:
-                    print("ERROR: Key is neither 'abstract' nor 'full_text'")
-                    sys.exit
-
-
-                # Perform the query
+                query = phrase_query(syn, key, case_fold=self.case_fold)
+
+                # Only publications in the years of interest (filter, not scored)
+                query = Q('bool', must=[query], 
+                          filter=[Q('range', year={'gte':start_year, 'lte':end_year})])
+
+                # Perform the query, only fetching the needed fields
                 s = Search(using=es, index=index_name).\
-                params(request_timeout=300).query(query) 
+                params(request_timeout=300).query(query).source(source_fields(key))
 
 
                 # Analyze the query results (synonym counts)
                 syn_cnts_all_pubs = 0 # Total hits for a synonym
+                syn_hits = 0 # Publications scanned for a synonym (relevant or not)
 
                 # Synonym: mid-phrase hyphens with spaces, keep hyphens at end of word
                 orig_syn = syn
-                syn = (syn+' ').replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
+                syn, regex = synonym_pattern(syn, self.case_fold)
                 
                 
                 # For each synonym-containing publication
                 for hit in s.scan():
+                    syn_hits += 1
                     
                     # Proceed if the publication topic is of interest
                     pmid = str(hit.pmid)
                     if pmid in self.relevant_pmids:
                                                 
                         # Check if publication is in a year of interest
-                        if int(hit.year) not in range(start_year, end_year+1):
+                        if not start_year <= int(hit.year) <= end_year:
                             continue      
                     
                         # Document sections (e.g., title, abstract, full_text)
-                        sections = []
-    
-                        # Replace hyphens not at end of word (w/spaces)
-                        if type(hit.abstract) == str: 
-                            hit.abstract = hit.abstract.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
-                            sections.append(hit.abstract)
-                        if type(hit.title) == str:    
-                            hit.title = hit.title.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
-                            sections.append(hit.title)
-                        
-                        if key == 'full_text':
-                            if type(hit.full_text) == str: 
-                                hit.full_text = hit.full_text.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
-                                sections.append(hit.full_text)
-                        
-                        if key == 'full_text_no_methods':
-                            if type(hit.introduction) == str: 
-                                hit.introduction = hit.introduction.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
-                                sections.append(hit.introduction)  
-                            if type(hit.results) == str: 
-                                    hit.results = hit.results.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
-                                    sections.append(hit.results) 
-                            if type(hit.discussion) == str: 
-                                    hit.discussion = hit.discussion.replace('- ','@$#!').replace('-',' ').replace('@$#!','- ').strip()
-                                    sections.append(hit.discussion)      
-                        
+                        sections = hit_sections(hit, key)
 
                         # Count the synonym in each section of the publication
                         syn_cnt_this_pub = 0 
                         for section in sections:
-                            syn_cnt_this_pub += section.count(syn)
+                            syn_cnt_this_pub += count_pattern(section, syn, regex)
                         syn_cnts_all_pubs += syn_cnt_this_pub
 
                         # Save the pmid->syn->counts (thread-safe manner)
@@ -163,18 +567,248 @@ class CountSynonyms(object):
                 if syn_cnts_all_pubs > 0:
                     fout2.write('#counts:'+str(syn_cnts_all_pubs)+\
                                   '|'+orig_syn+'\n') 
+                
+                # Save hits->synonyms, the search cost for the next run
+                if syn_hits > 0:
+                    fout2.write('#hits:'+str(syn_hits)+'|'+orig_syn+'\n')
        
     
     
     
     
+    def count_synonym_batches(self, b_id, batch, key, es, logfile, pmid_syn_cnt_path,
+                              index_name, start_year, end_year, synonyms_per_query):
+        '''
+        FUNCTION:
+        Count batch of synonyms in all indexed publications, searching 
+        synonyms_per_query synonyms per query instead of one. Each synonym 
+        is a named query, so each hit (fetched once per query) reports 
+        which synonyms it has, and only those are counted in it. Same 
+        output as count_synonym. (Called in syn_search)
+        
+        PARAMS:
+        - b_id, batch, key, es, logfile, pmid_syn_cnt_path, index_name, 
+          start_year, end_year: As in count_synonym
+        - synonyms_per_query: Number of synonyms in one query
+        '''
+        from elasticsearch_dsl import Search, Q
+        
+        # Open output path (appending: a process counts many batches)
+        temp_logfile = logfile[:-4]+'_'+str(b_id)+'.txt'
+        temp_pmid_syn_cnt_path = pmid_syn_cnt_path[:-4]+'_'+str(b_id)+'.txt'
+        
+        with open(temp_pmid_syn_cnt_path,'a') as fout1,\
+               open(temp_logfile,'a') as fout2:
+            
+            # For each group of synonyms
+            for group_start in range(0, len(batch), synonyms_per_query):
+                group = batch[group_start:group_start+synonyms_per_query]
+                
+                # Define the query: any synonym (named by its position), in the years of interest
+                query = Q('bool', should=[phrase_query(syn, key, name=str(num), case_fold=self.case_fold) 
+                                          for num, syn in enumerate(group)],
+                          minimum_should_match=1,
+                          filter=[Q('range', year={'gte':start_year, 'lte':end_year})])
+                
+                # Perform the query, only fetching the needed fields
+                s = Search(using=es, index=index_name).\
+                params(request_timeout=300).query(query).source(source_fields(key))
+                
+                # Synonyms: mid-phrase hyphens with spaces, keep hyphens at end of word
+                syns = [synonym_pattern(syn, self.case_fold) for syn in group]
+                syn_cnts_all_pubs = [0]*len(group) # Total hits per synonym
+                syn_hits = [0]*len(group) # Publications scanned per synonym (relevant or not)
+                
+                # For each publication with any of the synonyms
+                for hit in s.scan():
+                    matched = sorted(set(int(name) for name in hit.meta.matched_queries))
+                    for num in matched:
+                        syn_hits[num] += 1
+                    
+                    # Proceed if the publication topic is of interest
+                    pmid = str(hit.pmid)
+                    if pmid not in self.relevant_pmids:
+                        continue
+                    if not start_year <= int(hit.year) <= end_year:
+                        continue
+                    
+                    # Count the matched synonyms in each section of the publication
+                    sections = hit_sections(hit, key)
+                    for num in matched:
+                        syn_cnt_this_pub = 0
+                        for section in sections:
+                            syn_cnt_this_pub += count_pattern(section, *syns[num])
+                        syn_cnts_all_pubs[num] += syn_cnt_this_pub
+                        
+                        # Save the pmid->syn->counts (thread-safe manner)
+                        fout1.write(pmid+'|'+group[num]+'|'+str(syn_cnt_this_pub)+'\n')
+                
+                # Save counts->synonyms (thread-safe manner)
+                for num, orig_syn in enumerate(group):
+                    if syn_cnts_all_pubs[num] > 0:
+                        fout2.write('#counts:'+str(syn_cnts_all_pubs[num])+\
+                                    '|'+orig_syn+'\n')
+                    if syn_hits[num] > 0:
+                        fout2.write('#hits:'+str(syn_hits[num])+'|'+orig_syn+'\n')
+    
+    
+    
+    
+    def count_synonym_worker(self, b_id, queue, key, es, logfile, pmid_syn_cnt_path,
+                             index_name, start_year, end_year, synonyms_per_query):
+        '''
+        FUNCTION:
+        Count batches of synonyms taken from a shared queue until it is 
+        empty (None), so processes that finish early take more batches.
+        (Called in syn_search)
+        
+        PARAMS:
+        - queue: multiprocessing.Queue of batches (lists of synonyms)
+        - b_id, key, es, logfile, pmid_syn_cnt_path, index_name, start_year,
+          end_year, synonyms_per_query: As in count_synonym_batches
+        '''
+        num_batches = 0
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            if synonyms_per_query > 1:
+                self.count_synonym_batches(b_id, batch, key, es, logfile, pmid_syn_cnt_path,
+                                           index_name, start_year, end_year, synonyms_per_query)
+            else:
+                self.count_synonym(b_id, batch, key, es, logfile, pmid_syn_cnt_path,
+                                   index_name, start_year, end_year)
+            
+            # Print progress
+            num_batches += 1
+            if b_id == 1:
+                print('Process 1 Progress:', num_batches, 'batches', end='\r')
+    
+    
+    
+    
+    def estimate_synonym_hits(self, key, es, logfile, index_name, 
+                              start_year, end_year, threads=8):
+        '''
+        FUNCTION:
+        Estimates how long each synonym takes to search: its number of 
+        hits, i.e. publications scanned, relevant or not. They are read from 
+        the previous search's log file (#hits:N|synonym, not found = 0), or 
+        if it has none (no previous search, or counted locally), counted 
+        with count queries (no documents are fetched).
+        
+        PARAMS:
+        - key, es, index_name, start_year, end_year: As in count_synonym
+        - logfile: The (merged) log file of the previous run
+        - threads: Count queries sent at a time
+        
+        OUTPUT:
+        - syn2cost (dict): Synonym -> estimated cost
+        '''
+        # Previous search's hits
+        if os.path.exists(logfile):
+            syn2cost, found = dict.fromkeys(self.synonyms, 0), False
+            with open(logfile) as fin:
+                for line in fin:
+                    if line.startswith('#hits:'):
+                        found = True
+                        hits, syn = line[len('#hits:'):].rstrip('\n').split('|', 1)
+                        if syn in syn2cost:
+                            syn2cost[syn] = int(hits)
+            if found:
+                return syn2cost
+        
+        # Number of hits per synonym
+        from elasticsearch_dsl import Search, Q
+        def count_hits(syn):
+            query = Q('bool', must=[phrase_query(syn, key, case_fold=self.case_fold)],
+                      filter=[Q('range', year={'gte':start_year, 'lte':end_year})])
+            return Search(using=es, index=index_name).\
+                   params(request_timeout=300).query(query).count()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return dict(zip(self.synonyms, executor.map(count_hits, self.synonyms)))
+    
+    
+    
+    
+    '''Find and count synonyms (local, no index)'''
+    
+    def count_synonyms_locally(self, b_id, num_parts, automaton, parsed_corpus,
+                               key, logfile, pmid_syn_cnt_path, start_year, end_year):
+        '''
+        FUNCTION:
+        Count all synonyms in one part of the parsed publications, reading 
+        each publication once. (Called in syn_search)
+        
+        PARAMS:
+        - b_id: Which part of the publications to read (0 to num_parts-1)
+        - num_parts: Number of parts (processes)
+        - automaton: SynonymAutomaton of all synonyms
+        - parsed_corpus: Parsed publications, pubmed.json or the Parquet 
+          directory
+        - key: 'abstract' or 'full_text' indicating the sections to be searched.
+          'abstract' searches the title and abstract. 'full_'text' also searches 
+          the full text. 'full_text_no_methods' is searched as 'abstract' 
+          (the sections are not parsed)
+        - logfile: Where the log will be stored, the threads' log file parts
+          are temporarily stored before being merged later
+        - pmid_syn_cnt_path: Path. Nested dictionary mapping pmids to synonyms 
+          to counts
+        - start_year (int): The earliest year of publications you want to look at
+        - end_year (int): The latest year of publications you want to look at
+        '''
+        # Only read the needed fields
+        fields = ['PMID', 'ArticleTitle', 'Abstract', 'Year']
+        if key == 'full_text':
+            fields.append('full_text')
+        syn2count = dict() # Total hits for a synonym
+        
+        temp_pmid_syn_cnt_path = pmid_syn_cnt_path[:-4]+'_'+str(b_id)+'.txt'
+        with open(temp_pmid_syn_cnt_path,'w') as fout1:
+            
+            # Only publications of interest (topic and year), filtered before reading the text
+            documents = iter_parsed_records(parsed_corpus, fields, b_id, num_parts,
+                                            pmids=self.relevant_pmids,
+                                            years=(start_year, end_year))
+            for num_docs, record in enumerate(documents):
+                # Print progress
+                if b_id == 1 and num_docs % 10000 == 0:
+                    print('Part 1 Progress:', num_docs, 'publications', end='\r')
+                pmid = str(record['PMID'])
+                
+                # Document sections, hyphens not at end of word replaced (w/spaces)
+                sections = []
+                for field in fields:
+                    if field in ('PMID', 'Year'):
+                        continue
+                    if type(record.get(field)) == str:
+                        sections.append(replace_hyphens(record[field]))
+                
+                # Count the synonyms and save pmid->syn->counts (thread-safe manner)
+                for syn, syn_cnt_this_pub in automaton.count(sections).items():
+                    fout1.write(pmid+'|'+syn+'|'+str(syn_cnt_this_pub)+'\n')
+                    syn2count[syn] = syn2count.get(syn, 0) + syn_cnt_this_pub
+        
+        # Save counts->synonyms (thread-safe manner)
+        temp_logfile = logfile[:-4]+'_'+str(b_id)+'.txt'
+        with open(temp_logfile,'w') as fout2:
+            for syn, syn_cnts_all_pubs in syn2count.items():
+                if syn_cnts_all_pubs > 0:
+                    fout2.write('#counts:'+str(syn_cnts_all_pubs)+'|'+syn+'\n')
+    
+    
+    
+    
     ### Search and count synonyms: to optimize and find count from indexer ###
     def synonym_search(self, key, logfile, syn_pmid_count_in, index_name, 
-                       start_year, end_year):          
+                       start_year, end_year, parsed_corpus=None, synonyms_per_query=1):          
         '''
         FUNCTION:
-        Uses threading to call count_synonym, searching for synonyms in the indexed
-        publications.
+        Uses multiprocessing to call count_synonym, searching for synonyms in the 
+        indexed publications. The synonyms are split into batches of similar
+        estimated hits (estimate_synonym_hits, cost_balanced_batches), most
+        hits first, and the processes
+        take batches from a shared queue (count_synonym_worker).
         
         PARAMS:
         - key: 'abstract' or 'full_text' indicating the sections to be searched.
@@ -186,38 +820,63 @@ class CountSynonyms(object):
         - index_name: Name of the index being searched. 
         - start_year (int): The earliest year of publications you want to look at
         - end_year (int): The latest year of publications you want to look at
+        - parsed_corpus: Parsed publications (pubmed.json or the Parquet 
+          directory). If given, the synonyms are counted by reading them
+          once with count_synonyms_locally (no ElasticSearch needed). 
+        - synonyms_per_query (int): Synonyms searched per query (named queries,
+          see count_synonym_batches). 1 searches each synonym separately.
         '''
         
         # Initialize variables
         print("Synonym count is running.....")
         start_time = time.time()
-        es = Elasticsearch(timeout=300)
         procs = cpu_count()
         
         # Clear old output
         for b_id in range(procs):
             temp_path = syn_pmid_count_in[:-4]+'_'+str(b_id)+'.txt'
             open(temp_path,'w')
+            open(logfile[:-4]+'_'+str(b_id)+'.txt','w')
         
-        # List of batches for multiprocessing
-        batches = [[] for i in range(procs)] 
+        # Count locally: each process reads a part of the publications
+        if parsed_corpus is not None:
+            automaton = SynonymAutomaton(self.synonyms, self.case_fold)
+            print("Running jobs. "+\
+                  str(round(time.time()-start_time, 1))+' seconds')
+            jobs = []
+            for b_id in range(procs):
+                jobs.append(Process(target = self.count_synonyms_locally,
+                                    args = [b_id, procs, automaton, parsed_corpus,
+                                            key, logfile, syn_pmid_count_in,
+                                            start_year, end_year]))
+            for j in jobs: j.start()
+            for j in jobs: j.join()
+            print(len(self.synonyms),' synonyms successfully counted! '+\
+                  str(round(time.time()-start_time, 1))+' seconds')
+            return
         
-        # Create batches and send to multiprocessing
-        for i, syn in enumerate(self.synonyms):
-            
-            # Add synonym to a batch
-            b_id = i%procs
-            batches[b_id].append(syn)
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(timeout=300)
+        
+        # Batches of similar cost, most hits first, so no process is left
+        # with the common synonyms at the end
+        syn2cost = self.estimate_synonym_hits(key, es, logfile, index_name,
+                                              start_year, end_year)
+        queue = Queue()
+        for batch in cost_balanced_batches(self.synonyms, syn2cost, synonyms_per_query):
+            queue.put(batch)
+        for b_id in range(procs):
+            queue.put(None)
             
-        # Create a list of jobs
+        # Create a list of jobs (each takes batches from the queue)
         print("Running jobs. "+\
               str(round(time.time()-start_time, 1))+' seconds')
         jobs = []
-        for b_id, batch in enumerate(batches):
-            jobs.append(Process(target = self.count_synonym, 
-                                args = [b_id, batch, key, es, logfile, 
+        for b_id in range(procs):
+            jobs.append(Process(target = self.count_synonym_worker,
+                                args = [b_id, queue, key, es, logfile,
                                         syn_pmid_count_in, index_name,
-                                       start_year, end_year]))
+                                        start_year, end_year, synonyms_per_query]))
         
         # Run the jobs
         for j in jobs: j.start()
@@ -260,16 +919,17 @@ class CountSynonyms(object):
     def get_synonyms_pmid_counts(self, syn_pmid_count, pmid_syn_count_out):
         '''
         FUNCTION:
-        Merges temp files with synonym counts (files produced previously).
-        Makes {PMID: {synonym:count,...}
+        Merges temp files with synonym counts (files produced previously),
+        one line at a time, into a synonym count store (see SynonymCounts):
+        PMID -> synonym -> count, looked up by PMID or by synonym.
         
         PARAMS:
         - syn_pmid_count: Input file. PMIDs per synonym.
           i.e., {synonym : {pmid:count,...}, ...
-        - pmid_syn_count_out:  Output file. Synonyms per PMID.
-          i.e., {PMID: {synonym:count,...}, ...
+        - pmid_syn_count_out:  Output directory. Synonym count store.
         '''
-        psc = dict() 
+        syn2num = {syn:num for num, syn in enumerate(self.synonyms)}
+        pmids, syn_nums, counts = array('I'), array('I'), array('I')
         procs = cpu_count()
         
         ### Merge synonyms-per-pmid files
@@ -280,15 +940,19 @@ class CountSynonyms(object):
                 for line in fin:
                     line = line.split('|')
                     pmid, syn, cnt = line[0], line[1], int(line[2])
-                    if cnt == 0:
+                    if cnt == 0 or not pmid.isdigit():
                         continue
-                    psc[pmid][syn] = psc.setdefault(pmid,{}).setdefault(syn,0)+cnt
+                    pmids.append(int(pmid))
+                    syn_nums.append(syn2num.setdefault(syn, len(syn2num)))
+                    counts.append(cnt)
             os.remove(syn_pmid_temp)
 
         
-        ### Export synonym-per-pmid files
-        self.pmid_syn_cnt = psc
-        json.dump(self.pmid_syn_cnt, open(pmid_syn_count_out,'w'))
+        ### Export synonym-per-pmid store
+        save_synonym_counts(pmid_syn_count_out, sorted(syn2num, key=syn2num.get),
+                            *[np.frombuffer(column, dtype=np.uint32) for column in (pmids, syn_nums, counts)])
+        del pmids, syn_nums, counts
+        self.pmid_syn_cnt = SynonymCounts(pmid_syn_count_out)
             
     
     
@@ -302,20 +966,23 @@ class CountSynonyms(object):
         PARAMS:
         - synfound_pmid2cat: Output file. PMID->CategoryNum
         '''
+        ### PMIDs with synonyms found
+        synfound_pmids = PMIDBitmap.from_pmids(self.pmid_syn_cnt.unique_pmids())
+        
         ### Write header
         with open(synfound_pmid2cat, "w") as fout:
             fout.write("doc_id\tlabel_id\n")
             
             ### Write PMID--->CategoryNumber
-            for pmid, cat in self.pmid_and_cat:
-                if pmid in self.pmid_syn_cnt:
+            for cat, bitmap in enumerate(self.textcube):
+                for pmid in (bitmap & synfound_pmids).to_array().tolist():
                     fout.write(str(pmid) + "\t" + str(cat) + "\n") 
                     
                     
                     
     
     def finish_synonym_search(self, logfile, syn_pmid_count, \
-                              pmid_syn_count_out, synfound_pmid2cat):
+                              pmid_syn_count_out, synfound_pmid2cat, pmid_syn_count_json=None):
         '''
         FUNCTION:
         Finishes the synonym count process: 
@@ -327,7 +994,10 @@ class CountSynonyms(object):
         - syn_pmid_count: Path. Nested dictionary mapping pmids to 
           synonyms to counts.
           Aka pmid_syn_cnt.
-        - pmid_syn_count_out: Output path. Nested dict of pmid to synonym to count.
+        - pmid_syn_count_out: Output directory. Synonym count store (pmid to 
+          synonym to count).
+        - pmid_syn_count_json: Output path. Also export the store as the older
+          nested dict of pmid to synonym to count (JSON), if given.
         '''
         
         ### Merge logfiles
@@ -336,6 +1006,8 @@ class CountSynonyms(object):
         
         ### Merge and export synonyms per PMIDs
         self.get_synonyms_pmid_counts(syn_pmid_count, pmid_syn_count_out)
+        if pmid_syn_count_json is not None:
+            self.pmid_syn_cnt.export_json(pmid_syn_count_json)
         
                 
         ### Export pmid--->category number
@@ -1,5 +1,126 @@
-import json
+import json, os
+import numpy as np
+from scipy import sparse
+from text_mining.caseolap._08_count_synonyms import SynonymCounts
 
+
+'''
+Document x entity count matrix
+'''
+class EntityCountMatrix(object):
+    '''
+    Entity counts of the documents as a sparse matrix (scipy CSR), one row
+    per PMID (sorted) and one column per entity. Made by step 10, read by 
+    steps 11 and 12, and saved as one .npz file with the row and column
+    labels.
+    '''
+    
+    def __init__(self, pmids, entities, counts):
+        '''
+        PARAMS:
+        - pmids (numpy array): Row labels, sorted PMIDs
+        - entities (list): Column labels, entity IDs
+        - counts (scipy sparse matrix): PMIDs x entities counts
+        '''
+        self.pmids = np.asarray(pmids, dtype=np.uint32)
+        self.entities = list(entities)
+        self.counts = sparse.csr_matrix(counts)
+        self.entity2num = {entity:num for num, entity in enumerate(self.entities)}
+    
+    def __len__(self):
+        return len(self.pmids)
+    
+    @classmethod
+    def from_nested_dict(cls, pmid2entity2count):
+        '''
+        FUNCTION:
+        - Make the matrix from {PMID:{Entity:Count,...},...} (counts can 
+          be strings, as in the older metadata files)
+        '''
+        entity2num, rows, cols, counts = dict(), [], [], []
+        pmids = sorted(pmid2entity2count, key=int)
+        for row, pmid in enumerate(pmids):
+            for entity, count in pmid2entity2count[pmid].items():
+                rows.append(row)
+                cols.append(entity2num.setdefault(entity, len(entity2num)))
+                counts.append(int(count))
+        matrix = sparse.csr_matrix((np.array(counts, dtype=np.int64), (rows, cols)),
+                                   shape=(len(pmids), len(entity2num)))
+        return cls([int(pmid) for pmid in pmids], sorted(entity2num, key=entity2num.get), matrix)
+    
+    @classmethod
+    def load(cls, path):
+        '''
+        FUNCTION:
+        - Load the matrix from its .npz file, or make it from the older
+          entitycount text file (PMID Entity|Count ...) or 
+          pmid2entity2count JSON file
+        '''
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                           shape=tuple(data['shape']))
+                return cls(data['pmids'], data['entities'].tolist(), matrix)
+        if path.endswith('.json'):
+            return cls.from_nested_dict(json.load(open(path, 'r')))
+        pmid2entity2count = dict()
+        with open(path) as fin:
+            for line in fin:
+                line = line.strip().split(' ')
+                pmid2entity2count[line[0]] = dict(entity2count.split('|') 
+                                                  for entity2count in line[1:])
+        return cls.from_nested_dict(pmid2entity2count)
+    
+    def save(self, path):
+        '''
+        FUNCTION:
+        - Save the matrix as a compressed .npz file
+        '''
+        with open(path+'.tmp', 'wb') as fout:
+            np.savez_compressed(fout, data=self.counts.data, indices=self.counts.indices,
+                                indptr=self.counts.indptr, shape=np.array(self.counts.shape),
+                                pmids=self.pmids, entities=np.array(self.entities, dtype=str))
+        os.replace(path+'.tmp', path)
+    
+    def rows(self, pmids):
+        '''
+        FUNCTION:
+        - Row numbers of the PMIDs in the matrix, and the PMIDs not in it
+        '''
+        pmids = np.asarray([int(pmid) for pmid in pmids], dtype=np.int64)
+        rows = np.searchsorted(self.pmids, pmids)
+        found = rows < len(self.pmids)
+        found[found] = self.pmids[rows[found]] == pmids[found]
+        return rows[found], pmids[~found]
+    
+    def items(self):
+        '''
+        FUNCTION:
+        - Iterate through (PMID, {Entity:Count,...}), like the items of 
+          the older nested dictionary
+        '''
+        for row, pmid in enumerate(self.pmids.tolist()):
+            start, end = self.counts.indptr[row], self.counts.indptr[row+1]
+            yield str(pmid), {self.entities[col]: count for col, count in 
+                              zip(self.counts.indices[start:end].tolist(), 
+                                  self.counts.data[start:end].tolist())}
+    
+    def export_text(self, entitycount_outfile):
+        '''
+        FUNCTION:
+        - Export the older entitycount text file: PMID Entity|Count ...
+        '''
+        with open(entitycount_outfile, 'w') as fout:
+            for pmid, entity2count in self.items():
+                if len(entity2count) > 0:
+                    fout.write(pmid+' '+''.join(entity+'|'+str(count)+' ' 
+                                                for entity, count in entity2count.items())+'\n')
+
+
+
+'''
+PMID -> Synonym counts to PMID -> Entity counts
+'''
 class MakeEntityCounts(object):
     
     def __init__(self, id2syns_path, remove_syns_infile, pmid_syn_count_in):
@@ -11,7 +132,8 @@ class MakeEntityCounts(object):
         PARAMS:
         - remove_syns_infile: Synonyms to remove and not query.
         - entity_dict_path: entity ID to synonyms mapping
-        - pmid_syn_count_out: Output file. PMID -> Synonym -> Synonym counts
+        - pmid_syn_count_in: Input path. PMID -> Synonym -> Synonym counts,
+          the synonym count store (or the older JSON file)
         '''
         
         ### Synonyms to not consider in the search
@@ -30,7 +152,7 @@ class MakeEntityCounts(object):
                     self.syn2id.setdefault(syn,[]).append(ID)
 
         # Map PMIDs -> synonyms -> synonym counts
-        self.pcs = json.load(open(pmid_syn_count_in))
+        self.pcs = SynonymCounts.load(pmid_syn_count_in)
 
         
 #    def entitycount(self, entitycount_outfile):
@@ -77,34 +199,56 @@ class MakeEntityCounts(object):
 #            print(len(self.syn2id))
 #            #print(self.syn2id)
         
+    def entitycount_matrix(self):
+        '''
+        FUNCTION:
+        Makes the PMID x entity count matrix: the (PMID x synonym counts) 
+        times (synonym x entity) matrix of the good synonyms, so the counts
+        of all synonyms of an entity are added up
+        
+        OUTPUT:
+        - EntityCountMatrix
+        '''
+        # Synonym x entity (1 per entity of each good synonym)
+        entities = sorted(set(entity_id for ids in self.syn2id.values() for entity_id in ids))
+        entity2num = {entity_id:num for num, entity_id in enumerate(entities)}
+        bad_syns = set(self.bad_syns)
+        syn_rows, entity_cols = [], []
+        for syn_num, synonym in enumerate(self.pcs.synonyms):
+            if synonym not in bad_syns and synonym in self.syn2id:
+                for entity_id in self.syn2id[synonym]:
+                    syn_rows.append(syn_num)
+                    entity_cols.append(entity2num[entity_id])
+        syn2entity = sparse.csr_matrix((np.ones(len(syn_rows), dtype=np.int64), (syn_rows, entity_cols)),
+                                       shape=(len(self.pcs.synonyms), len(entities)))
+        
+        # PMID x synonym counts (rows of the count store are sorted by PMID)
+        pmids = np.asarray(self.pcs.pmids)
+        new_pmid = np.concatenate(([True], pmids[1:] != pmids[:-1])) if len(pmids) > 0 else np.zeros(0, dtype=bool)
+        pmid_rows = np.cumsum(new_pmid) - 1
+        pmid2syn = sparse.csr_matrix((np.asarray(self.pcs.counts, dtype=np.int64), 
+                                      (pmid_rows, np.asarray(self.pcs.syn_nums))),
+                                     shape=(int(new_pmid.sum()), len(self.pcs.synonyms)))
+        
+        # PMID x entity counts, PMIDs with any entity
+        counts = pmid2syn.dot(syn2entity).tocsr()
+        counts.eliminate_zeros()
+        found = np.diff(counts.indptr) > 0
+        return EntityCountMatrix(pmids[new_pmid][found], entities, counts[found].astype(np.uint32))
+    
+    
     def entitycount(self, entitycount_outfile):
         '''
         FUNCTION:
-        Writes filtered entitycount.txt:
+        Saves the PMID x entity count matrix (.npz, see EntityCountMatrix), or
+        writes filtered entitycount.txt:
         PMID EntityID1|Count ... EntityIDn|Count
         
         PARAMS:
-        - entitycount_outfile: entitycount output
-        '''
-        with open(entitycount_outfile,'w') as fout:
-            # For each PMID
-            for pmid in self.pcs:
-                tempd = dict()
-                
-                # For each good synonym in the publication
-                for synonym in self.pcs[pmid]:
-                    if synonym not in self.bad_syns and synonym in self.syn2id:
-                        
-                        # Get the current synonym count in current publication
-                        syn_count = self.pcs[pmid][synonym]
-
-                        # Map the good synonym to its entity ID(s)
-                        for entity_id in self.syn2id[synonym]:
-                            tempd[entity_id] = tempd.get(entity_id,0) + syn_count 
-                # Save mappings: PMID entity_ID|count ...
-                if len(tempd) > 0:
-                    fout.write(pmid+' ')
-                    for entity_id in tempd:
-                        ent_count = tempd[entity_id]
-                        fout.write(entity_id+'|'+str(ent_count)+' ')
-                    fout.write('\n')
+        - entitycount_outfile: entitycount output (.npz or .txt)
+        '''
+        entity_counts = self.entitycount_matrix()
+        if entitycount_outfile.endswith('.npz'):
+            entity_counts.save(entitycount_outfile)
+        else:
+            entity_counts.export_text(entitycount_outfile)
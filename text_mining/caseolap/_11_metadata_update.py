@@ -1,4 +1,6 @@
 import json
+from text_mining.caseolap._06_textcube import PMIDBitmap, TextCubeBitmaps
+from text_mining.caseolap._10_make_entity_counts import EntityCountMatrix
 
 
 class MetadataUpdate():
@@ -6,7 +8,7 @@ class MetadataUpdate():
     
     def __init__(self, category_names):
         self.category_names = category_names
-        self.pmid2entity2count = dict()
+        self.entity_counts = None  # PMID x entity counts (EntityCountMatrix)
         self.category2pmids = dict()         
         
         # Map Category Name -> Category Number 
@@ -19,52 +21,40 @@ class MetadataUpdate():
                                  output_file_pmid2entity2count, logfile):
         '''
         FUNCTION:
-        - This reformats the entitycount file into a nested dictionary so
-          it can be used in the CaseOLAP score calculation. 
+        - This reads the PMID x entity count matrix of step 10 so it can be 
+          used in the CaseOLAP score calculation. 
         
         PARAMS:
-        - input_file_entity_count (TXT): Text file with lines for each PMID and 
-          its entities and their counts (e.g., 1234567 entity1|4 entity2|3 ...)
-        - output_file_pmid2entity2count (JSON): Collected and merged data from the 
-          input file will be written here, storing PMID->Entity->Entity Count
+        - input_file_entity_count (NPZ): PMID x entity count matrix (see 
+          EntityCountMatrix). Can also be the older text file with lines for
+          each PMID and its entities and their counts (e.g., 1234567 entity1|4 ...)
+        - output_file_pmid2entity2count (NPZ): The matrix is written here, 
+          storing PMID->Entity->Entity Count. A .json file name writes the
+          older nested dictionary instead.
         - logfile (TXT): Writes the progress 
         '''
         
         # Print progress
-        msg = 'Updating the PMID -to-> Entity Count dictionary'
+        msg = 'Updating the PMID -to-> Entity Count matrix'
         logfile.write(msg+'\n'+'='*len(msg)+'\n')
         print(msg)
         
         
-        # PMID->Entity->Entity Count Dictionary'''
-        with open(input_file_entitycount) as fin:
-            for line in fin:
-                
-                # Read in data
-                line = line.strip().split(' ')
-                pmid = line[0]
-                entities2count_list = line[1:]
-                entities2counts = dict()
-
-                for entity2count in entities2count_list:
-                    entity2count = entity2count.split('|')
-                        
-                    # Entity, Count
-                    entity = entity2count[0]
-                    count = entity2count[1]
-                    
-                    # Entity->Count
-                    entities2counts[entity] = count
-                    
-                    # PMID->Entity->Count
-                    self.pmid2entity2count[pmid] = entities2counts
-                            
-                # Write to logfile
-                logfile.write('PMID: '+str(pmid)+\
-                              " Entity Counts: "+str(entities2counts)+'\n')
+        # PMID->Entity->Entity Count matrix
+        self.entity_counts = EntityCountMatrix.load(input_file_entitycount)
+        
+        # Write to logfile
+        logfile.write('PMIDs: '+str(len(self.entity_counts.pmids))+\
+                      ' Entities: '+str(len(self.entity_counts.entities))+\
+                      ' PMID-Entity Counts: '+str(self.entity_counts.counts.nnz)+'\n')
 
         # Export
-        json.dump(self.pmid2entity2count, open(output_file_pmid2entity2count, 'w') )
+        if output_file_pmid2entity2count.endswith('.json'):
+            json.dump({pmid: {entity: str(count) for entity, count in entity2count.items()}
+                       for pmid, entity2count in self.entity_counts.items()},
+                      open(output_file_pmid2entity2count, 'w'))
+        else:
+            self.entity_counts.save(output_file_pmid2entity2count)
                 
                 
 
@@ -77,10 +67,10 @@ class MetadataUpdate():
           was found.
          
         PARAMS:
-        - input_file_textcube_pmid2category (JSON): This list of lists indicates 
+        - input_file_textcube_pmid2category (JSON or NPZ): This list of lists indicates 
           the PMIDs and the category (number) they belong to (e.g., [['123456',0],...])
           This is for all documents (publications) in the category regardless of if
-          they have an entity.
+          they have an entity. Can also be the textcube bitmaps (.npz).
         - output_file_metadata_category2pmids (JSON): This dictionary mapping category
           names to PMIDs has a subset of the above input information; the category-PMID
           mappings are only for PMIDs that had an entity discovered in them.
@@ -93,29 +83,24 @@ class MetadataUpdate():
         print(msg)
 
             
-        # PMID to Category Dictionary
-        pmids2categories = json.load(open(input_file_textcube_pmid2category))
-        for pmid2category in pmids2categories:
-            
-            # PMID, Category (PMIDs irrespective of entities found, from textcube)
-            pmid = pmid2category[0]
-
-            category_num = pmid2category[1]
-            if pmid == 'doc_id':
-                continue
-                
-            # PMIDs w/entities found
-            if pmid in self.pmid2entity2count:
-                
-                # PMID->Category (PMIDs w/entities found)
+        # Category -> PMIDs bitmaps (PMIDs irrespective of entities found, from textcube)
+        textcube = TextCubeBitmaps.load(input_file_textcube_pmid2category)
+        
+        # PMIDs w/entities found
+        pmids_with_entities = PMIDBitmap.from_pmids(self.entity_counts.pmids)
+        
+        # Category->PMIDs (PMIDs w/entities found)
+        for category_num in range(min(len(textcube), len(self.category_names))):
+            pmids = (textcube[category_num] & pmids_with_entities).to_strings()
+            if len(pmids) > 0:
                 category_name = self.category_num2name[category_num]
-                self.category2pmids.setdefault(category_name,list()).append(pmid)                                
+                self.category2pmids[category_name] = pmids
                 
                 
         # Write results        
         for name in self.category_names:                       
             logfile.write("Category: " +name+" includes"+\
-                          str(len(self.category2pmids[name]))+\
+                          str(len(self.category2pmids.get(name, [])))+\
                           " documents containing entities.\n")
         
         # Export results
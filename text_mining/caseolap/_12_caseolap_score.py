@@ -1,19 +1,489 @@
 import pandas as pd, numpy as np, matplotlib.pyplot as plt, seaborn as sns, json, os
+from scipy import sparse
+from multiprocessing import Pool
+from text_mining.caseolap._02_parsing import iter_parsed_records
+from text_mining.caseolap._06_textcube import PMIDBitmap
+from text_mining.caseolap._10_make_entity_counts import EntityCountMatrix
 
 
 # Note: "Term Frequency" here doesn't mean relative frequency of a term compared
 # to all other terms in the document. It just means the absolute count.
 
+def caseolap_scores_from_counts(tf, num_pmids, k1=1.2, b=0.75):
+    '''
+    FUNCTION:
+    - Calculate the scores of all entities in all categories from their
+      counts per category, with the same formulas as the Caseolap class 
+      steps (popularity, ntf, ndf, distinctiveness, CaseOLAP score). The 
+      counts can have leading dimensions (e.g., years x categories x 
+      entities) which are scored independently.
+
+    PARAMS:
+    - tf (numpy array): (...) x categories x entities, entity counts
+    - num_pmids (numpy array): (...) x categories x entities, number of 
+      PMIDs with the entity
+    - k1, b: Normalized term frequency parameters
+
+    OUTPUT:
+    - scores (dict): Name ('tf', 'num_pmids', 'popularity', 'ntf', 'ndf', 
+      'distinctiveness', 'caseolap') -> (...) x categories x entities array
+    '''
+    tf = np.asarray(tf, dtype=np.float64)
+    num_pmids = np.asarray(num_pmids, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Popularity
+        total_tf = tf.sum(axis=-1, keepdims=True)
+        popularity = np.log(tf + 1) / np.log(total_tf)
+
+        # Normalized term frequency
+        total_num_ents = (tf > 0).sum(axis=-1, keepdims=True)
+        hit_to_entity_ratio = total_tf / total_num_ents
+        ntf = (tf * (k1 + 1)) / \
+              (tf + (k1 * (1 - b + (b * (total_tf / hit_to_entity_ratio)))))
+
+        # Normalized document frequency (0 if not in the category)
+        ndf = np.log(1 + num_pmids) / np.log(1 + num_pmids.max(axis=-1, keepdims=True, initial=0))
+
+        # Distinctiveness: e^(ntf*ndf)-1 over 1 + the sum over all categories
+        exp_ntf_ndf_ratio = np.exp(ntf * ndf)
+        distinctiveness = (exp_ntf_ndf_ratio - 1) / (1 + exp_ntf_ndf_ratio.sum(axis=-2, keepdims=True))
+
+    return {'tf': tf, 'num_pmids': num_pmids, 'popularity': popularity,
+            'ntf': ntf, 'ndf': ndf, 'distinctiveness': distinctiveness,
+            'caseolap': distinctiveness * popularity}
+
+
+def caseolap_scores(entity_counts, category_indicator, k1=1.2, b=0.75):
+    '''
+    FUNCTION:
+    - Calculate the scores of all entities in all categories at once 
+      (caseolap_scores_from_counts). The counts per category are matrix
+      products, the scores are array operations.
+
+    PARAMS:
+    - entity_counts (scipy sparse matrix): PMIDs x entities counts
+    - category_indicator (scipy sparse matrix): PMIDs x categories, 1 if the
+      PMID is in the category
+    - k1, b: Normalized term frequency parameters
+
+    OUTPUT:
+    - scores (dict): Name ('tf', 'num_pmids', 'popularity', 'ntf', 'ndf', 
+      'distinctiveness', 'caseolap') -> categories x entities numpy array
+    '''
+    category2pmid = sparse.csr_matrix(category_indicator, dtype=np.float64).T.tocsr()
+    counts = sparse.csr_matrix(entity_counts, dtype=np.float64)
+    found = counts.copy()
+    found.data[:] = 1
+
+    # Entity counts and number of PMIDs per category
+    tf = np.asarray(category2pmid.dot(counts).todense())
+    num_pmids = np.asarray(category2pmid.dot(found).todense())
+
+    return caseolap_scores_from_counts(tf, num_pmids, k1, b)
+
+
+def read_pmid_years(parsed_corpus, pmids):
+    '''
+    FUNCTION:
+    - Read the publication years of the PMIDs from the parsed PubMed
+      documents (only the PMID and year are read)
+
+    PARAMS:
+    - parsed_corpus (str): pubmed.json or the Parquet directory
+    - pmids (numpy array): Sorted PMIDs
+
+    OUTPUT:
+    - years (numpy array): Year of each PMID, -1 if unknown
+    '''
+    pmids = np.asarray(pmids, dtype=np.int64)
+    years = np.full(len(pmids), -1, dtype=np.int64)
+    for record in iter_parsed_records(parsed_corpus, ['PMID', 'Year'],
+                                      pmids=PMIDBitmap.from_pmids(pmids)):
+        row = np.searchsorted(pmids, int(record['PMID']))
+        if row < len(pmids) and pmids[row] == int(record['PMID']) and record['Year'] is not None:
+            years[row] = record['Year']
+    return years
+
+
+
+'''
+Entity counts per category and year
+'''
+class CaseolapCube(object):
+    '''
+    Entity counts (TF) and numbers of PMIDs with the entity (DF) per 
+    category and publication year, one row per (category, year) and one 
+    column per entity (scipy CSR). The CaseOLAP scores only depend on these
+    sums, so the scores of any year window and category subset are 
+    recomputed from the cube without going back to the documents. Saved as
+    one .npz file.
+    '''
+
+    def __init__(self, categories, years, entities, tf, num_pmids, category_year_pmids):
+        '''
+        PARAMS:
+        - categories (list): Category names
+        - years (numpy array): Consecutive years (the cube's year axis)
+        - entities (list): Entity IDs
+        - tf (scipy sparse matrix): (categories*years) x entities counts,
+          row = category number * number of years + year number
+        - num_pmids (scipy sparse matrix): Same as tf, number of PMIDs
+        - category_year_pmids (numpy array): categories x years, number of 
+          PMIDs in the category
+        '''
+        self.categories = list(categories)
+        self.years = np.asarray(years, dtype=np.int64)
+        self.entities = list(entities)
+        self.tf = sparse.csr_matrix(tf)
+        self.num_pmids = sparse.csr_matrix(num_pmids)
+        self.category_year_pmids = np.asarray(category_year_pmids, dtype=np.int64)
+
+    @classmethod
+    def build(cls, entity_counts, category2pmids, pmid_years, category_names):
+        '''
+        FUNCTION:
+        - Sum the PMIDs' entity counts per category and year. PMIDs without
+          a known year are left out.
+
+        PARAMS:
+        - entity_counts (EntityCountMatrix): PMID x entity counts
+        - category2pmids (dict): Category name -> PMIDs
+        - pmid_years (numpy array): Year of each PMID (row) of entity_counts,
+          -1 if unknown (read_pmid_years)
+        - category_names (list): Category names, in the cube's order
+        '''
+        pmid_years = np.asarray(pmid_years, dtype=np.int64)
+        known = pmid_years[pmid_years >= 0]
+        first_year = known.min() if len(known) > 0 else 0
+        years = np.arange(first_year, known.max()+1) if len(known) > 0 else np.zeros(0, dtype=np.int64)
+
+        # (Category, year) x PMIDs indicator
+        rows, cols = [], []
+        for cat_num, category in enumerate(category_names):
+            cat_rows, _ = entity_counts.rows(category2pmids.get(category, []))
+            cat_rows = cat_rows[pmid_years[cat_rows] >= 0]
+            rows.append(cat_num * len(years) + pmid_years[cat_rows] - first_year)
+            cols.append(cat_rows)
+        rows, cols = np.concatenate(rows).astype(np.int64), np.concatenate(cols).astype(np.int64)
+        indicator = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                      shape=(len(category_names)*len(years), len(entity_counts)))
+        indicator.data[:] = 1
+
+        # Sums per (category, year)
+        counts = sparse.csr_matrix(entity_counts.counts, dtype=np.int64)
+        found = counts.copy()
+        found.data[:] = 1
+        category_year_pmids = np.diff(indicator.indptr).reshape(len(category_names), len(years))
+        return cls(category_names, years, entity_counts.entities, indicator.dot(counts),
+                   indicator.dot(found), category_year_pmids)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        FUNCTION:
+        - Load the cube from its .npz file
+        '''
+        with np.load(path) as data:
+            matrices = [sparse.csr_matrix((data[name+'_data'], data[name+'_indices'], data[name+'_indptr']),
+                                          shape=tuple(data['shape'])) for name in ('tf', 'num_pmids')]
+            return cls(data['categories'].tolist(), data['years'], data['entities'].tolist(),
+                       matrices[0], matrices[1], data['category_year_pmids'])
+
+    def save(self, path):
+        '''
+        FUNCTION:
+        - Save the cube as a compressed .npz file
+        '''
+        arrays = dict()
+        for name, matrix in (('tf', self.tf), ('num_pmids', self.num_pmids)):
+            arrays[name+'_data'] = matrix.data
+            arrays[name+'_indices'] = matrix.indices
+            arrays[name+'_indptr'] = matrix.indptr
+        with open(path+'.tmp', 'wb') as fout:
+            np.savez_compressed(fout, shape=np.array(self.tf.shape), years=self.years,
+                                categories=np.array(self.categories, dtype=str),
+                                entities=np.array(self.entities, dtype=str),
+                                category_year_pmids=self.category_year_pmids, **arrays)
+        os.replace(path+'.tmp', path)
+
+    def window_counts(self, windows, categories=None):
+        '''
+        FUNCTION:
+        - Sum the counts of the categories over each year window (one 
+          sparse matrix product for all the windows)
+
+        PARAMS:
+        - windows (list of tuples): (start year, end year), inclusive. 
+          None means the first/last year of the cube.
+        - categories (list): Category names (default: all)
+
+        OUTPUT:
+        - tf, num_pmids (numpy arrays): windows x categories x entities
+        '''
+        categories = self.categories if categories is None else list(categories)
+        cat_nums = [self.categories.index(category) for category in categories]
+
+        # (Window, category) x (category, year) selection
+        first_year = self.years[0] if len(self.years) > 0 else 0
+        rows, cols = [], []
+        for window_num, (start_year, end_year) in enumerate(windows):
+            start = 0 if start_year is None else min(max(start_year - first_year, 0), len(self.years))
+            end = len(self.years) if end_year is None else min(max(end_year - first_year + 1, 0), len(self.years))
+            year_nums = np.arange(start, max(start, end))
+            for num, cat_num in enumerate(cat_nums):
+                rows.append(np.full(len(year_nums), window_num*len(cat_nums) + num))
+                cols.append(cat_num*len(self.years) + year_nums)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        selection = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                      shape=(len(windows)*len(cat_nums), self.tf.shape[0]))
+
+        shape = (len(windows), len(cat_nums), len(self.entities))
+        tf = np.asarray(selection.dot(self.tf).todense()).reshape(shape)
+        num_pmids = np.asarray(selection.dot(self.num_pmids).todense()).reshape(shape)
+        return tf, num_pmids
+
+    def scores(self, start_year=None, end_year=None, categories=None):
+        '''
+        FUNCTION:
+        - Recompute the scores for a year window and category subset
+
+        PARAMS:
+        - start_year, end_year (int): Year window, inclusive (default: all years)
+        - categories (list): Category names (default: all)
+
+        OUTPUT:
+        - score_dfs (dict): Score name -> entities x categories DataFrame,
+          only the entities found in the window (like calculate_all_scores)
+        '''
+        categories = self.categories if categories is None else list(categories)
+        tf, num_pmids = self.window_counts([(start_year, end_year)], categories)
+        found = np.flatnonzero(tf[0].sum(axis=0) > 0)
+        scores = caseolap_scores_from_counts(tf[0][:, found], num_pmids[0][:, found])
+        index = pd.Index([self.entities[col] for col in found.tolist()], name='entity')
+        return {name: pd.DataFrame(values.T, index=index, columns=categories)
+                for name, values in scores.items()}
+
+    def sliding_window_scores(self, width=5, step=1, start_year=None, end_year=None, 
+                              categories=None):
+        '''
+        FUNCTION:
+        - Recompute the scores of every year window of the given width 
+          (e.g., every 5-year window since 1990) in one pass
+
+        PARAMS:
+        - width (int): Number of years per window
+        - step (int): Years between the windows' starts
+        - start_year (int): First window's start (default: the cube's first year)
+        - end_year (int): Last year of the last window (default: the cube's last year)
+        - categories (list): Category names (default: all)
+
+        OUTPUT:
+        - scores (DataFrame): One row per window, category and entity found
+          in the window: start year, end year, category, entity, tf, 
+          num_pmids, popularity, distinctiveness, caseolap
+        '''
+        categories = self.categories if categories is None else list(categories)
+        start_year = int(self.years[0]) if start_year is None else start_year
+        end_year = int(self.years[-1]) if end_year is None else end_year
+        windows = [(year, year+width-1) for year in range(start_year, end_year-width+2, step)]
+        if not windows:
+            return pd.DataFrame(columns=['start_year', 'end_year', 'category', 'entity', 'tf', 
+                                         'num_pmids', 'popularity', 'distinctiveness', 'caseolap'])
+        tf, num_pmids = self.window_counts(windows, categories)
+        scores = caseolap_scores_from_counts(tf, num_pmids)
+
+        # Windows x categories x entities -> rows of the entities found in each window
+        window_nums, entity_nums = np.nonzero(tf.sum(axis=1) > 0)
+        window_nums = np.repeat(window_nums, len(categories))
+        cat_nums = np.tile(np.arange(len(categories)), len(entity_nums))
+        entity_nums = np.repeat(entity_nums, len(categories))
+        windows = np.array(windows, dtype=np.int64).reshape(-1, 2)
+        entities = np.array(self.entities, dtype=object)
+        df = pd.DataFrame({'start_year': windows[window_nums, 0], 
+                           'end_year': windows[window_nums, 1],
+                           'category': np.array(categories, dtype=object)[cat_nums],
+                           'entity': entities[entity_nums]})
+        for name in ('tf', 'num_pmids', 'popularity', 'distinctiveness', 'caseolap'):
+            df[name] = scores[name][window_nums, cat_nums, entity_nums]
+        return df
+
+
+BOOTSTRAP_SCORES = ['popularity', 'distinctiveness', 'caseolap']
+bootstrap_data = dict()  # Set in each bootstrap worker process (init_bootstrap_worker)
+
+
+def init_bootstrap_worker(entity_counts, category_rows):
+    '''
+    FUNCTION:
+    - Keep the PMID x entity counts and the categories' rows in the worker
+      process, so they are sent once instead of with every task
+    '''
+    counts = sparse.csr_matrix(entity_counts, dtype=np.float64)
+    found = counts.copy()
+    found.data[:] = 1
+    bootstrap_data['counts'] = counts
+    bootstrap_data['found'] = found
+    bootstrap_data['category_rows'] = category_rows
+
+
+def bootstrap_replicates(task):
+    '''
+    FUNCTION:
+    - Score bootstrap replicates: in each replicate, each category's PMIDs
+      are resampled with replacement (same number of PMIDs). A PMID drawn
+      w times has weight w, so the counts of all replicates and categories
+      are one weighted sparse matrix product with the PMID x entity counts.
+
+    PARAMS:
+    - task (tuple): Number of replicates, random seed (SeedSequence)
+
+    OUTPUT:
+    - scores (dict): Name (BOOTSTRAP_SCORES) -> replicates x categories x 
+      entities (float32)
+    '''
+    num_replicates, seed = task
+    rng = np.random.default_rng(seed)
+    category_rows = bootstrap_data['category_rows']
+    counts, found = bootstrap_data['counts'], bootstrap_data['found']
+
+    # (Replicate, category) x PMIDs weights
+    rows, cols = [], []
+    for replicate in range(num_replicates):
+        for cat_num, cat_rows in enumerate(category_rows):
+            cols.append(cat_rows[rng.integers(0, len(cat_rows), len(cat_rows))] if len(cat_rows) else cat_rows)
+            rows.append(np.full(len(cat_rows), replicate*len(category_rows) + cat_num))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    weights = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                shape=(num_replicates*len(category_rows), counts.shape[0]))
+
+    # Scores of all replicates
+    shape = (num_replicates, len(category_rows), counts.shape[1])
+    tf = np.asarray(weights.dot(counts).todense()).reshape(shape)
+    num_pmids = np.asarray(weights.dot(found).todense()).reshape(shape)
+    scores = caseolap_scores_from_counts(tf, num_pmids)
+    return {name: scores[name].astype(np.float32) for name in BOOTSTRAP_SCORES}
+
+
+TEMPORAL_SCORES = ['tf', 'num_pmids', 'popularity', 'distinctiveness', 'caseolap']
+
+
+def save_temporal_scores(cube, store_dir, width=1, start_year=None, end_year=None,
+                         categories=None, years_per_chunk=10):
+    '''
+    FUNCTION:
+    - Score every year of the cube at once (caseolap_scores_from_counts on
+      years x categories x entities counts) and save the entity x category
+      x year tensors of the scores. Each year is scored on the window of
+      'width' years ending that year (width=None: all years up to it).
+    - The years are scored years_per_chunk at a time and written to 
+      memory-mapped .npy files, so the whole tensors are never in memory.
+
+    PARAMS:
+    - cube (CaseolapCube): Entity counts per (category, year)
+    - store_dir (str): Output directory (TemporalScores)
+    - width (int): Years per window (1: per-year scores)
+    - start_year, end_year (int): Years to score (default: the cube's years)
+    - categories (list): Category names (default: all)
+    - years_per_chunk (int): Number of years scored per pass
+    '''
+    categories = cube.categories if categories is None else list(categories)
+    start_year = int(cube.years[0]) if start_year is None else start_year
+    end_year = int(cube.years[-1]) if end_year is None else end_year
+    years = list(range(start_year, end_year+1))
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    with open(os.path.join(store_dir, 'labels.json'), 'w') as fout:
+        json.dump({'entities': cube.entities, 'categories': categories, 'years': years, 
+                   'width': width}, fout)
+    shape = (len(cube.entities), len(categories), len(years))
+    tensors = {name: np.lib.format.open_memmap(os.path.join(store_dir, name+'.npy.tmp'), mode='w+',
+                                               dtype=np.float64, shape=shape)
+               for name in TEMPORAL_SCORES}
+
+    # Years x categories x entities scores -> entity x category x year
+    for start in range(0, len(years), years_per_chunk):
+        chunk_years = years[start:start+years_per_chunk]
+        windows = [(None if width is None else year-width+1, year) for year in chunk_years]
+        tf, num_pmids = cube.window_counts(windows, categories)
+        scores = caseolap_scores_from_counts(tf, num_pmids)
+        for name, tensor in tensors.items():
+            tensor[:, :, start:start+len(chunk_years)] = scores[name].transpose(2, 1, 0)
+
+    for tensor in tensors.values():
+        tensor.flush()
+    del tensors
+    for name in TEMPORAL_SCORES:
+        os.replace(os.path.join(store_dir, name+'.npy.tmp'), os.path.join(store_dir, name+'.npy'))
+
+
+
+class TemporalScores(object):
+    '''
+    Reads the score tensors saved by save_temporal_scores. The store is a
+    directory with:
+    - labels.json: Entities, categories and years (the tensors' axes) and
+      the window width
+    - tf.npy, num_pmids.npy, popularity.npy, distinctiveness.npy, 
+      caseolap.npy: entities x categories x years (float64)
+    The arrays are memory-mapped and stored entity by entity, so an 
+    entity's time series or any slice only reads its part of the files.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        labels = json.load(open(os.path.join(store_dir, 'labels.json'), 'r'))
+        self.entities = labels['entities']
+        self.categories = labels['categories']
+        self.years = labels['years']
+        self.width = labels['width']
+        self.entity2num = {entity:num for num, entity in enumerate(self.entities)}
+        self.scores = {name: np.load(os.path.join(store_dir, name+'.npy'), mmap_mode='r')
+                       for name in TEMPORAL_SCORES}
+
+    def series(self, entity, score='caseolap'):
+        '''
+        FUNCTION:
+        - One entity's scores: years x categories DataFrame
+        '''
+        values = np.asarray(self.scores[score][self.entity2num[entity]])
+        return pd.DataFrame(values.T, index=pd.Index(self.years, name='year'), 
+                            columns=self.categories)
+
+    def year(self, year, score='caseolap'):
+        '''
+        FUNCTION:
+        - All entities' scores in one year: entities x categories DataFrame
+        '''
+        values = np.asarray(self.scores[score][:, :, self.years.index(year)])
+        return pd.DataFrame(values, index=pd.Index(self.entities, name='entity'), 
+                            columns=self.categories)
+
+
+
+
 class Caseolap(object):
 
     def __init__(self, category2pmids, pmid2entity2count, result_dir,
                  categories_path, logfile):
-
+        '''
+        PARAMS:
+        - category2pmids (dict): Category name -> PMIDs
+        - pmid2entity2count (EntityCountMatrix or dict): PMID x entity counts
+          (or the nested dict PMID -> entity -> count)
+        - result_dir (str): Output directory
+        - categories_path (str): Category names (JSON)
+        - logfile (file): Logs progress
+        '''
         self.category_names = json.load(open(categories_path))
         self.category2pmids = category2pmids
-        self.pmid2entity2count = pmid2entity2count
+        if isinstance(pmid2entity2count, dict):
+            pmid2entity2count = EntityCountMatrix.from_nested_dict(pmid2entity2count)
+        self.entity_counts = pmid2entity2count
         self.all_entities = list()
-        self.category2pmid2entity2count = dict()
+        self.category2rows = dict()  # Category -> rows of its PMIDs in entity_counts
         self.category2entities = dict()
         self.category2entity2count = dict()  # Includes entities with 1+ counts
         self.category2entity2tf = dict()  # Includes entities with 0 counts
@@ -25,6 +495,8 @@ class Caseolap(object):
         self.category2entity2ntf_ndf_ratio = dict()
         self.category2entity2distinctiveness = dict()
         self.category2entity2caseolap = dict()
+        self.score_dfs = dict()  # Score name -> entities x categories (calculate_all_scores)
+        self.bootstrap_dfs = dict()  # Score name -> (entity, category) intervals (bootstrap_scores)
 
         self.result_dir = result_dir
         self.result_stat = list()
@@ -121,24 +593,25 @@ class Caseolap(object):
     def map_category2pmid2entity2count(self):
         '''
         FUNCTION:
-        - Map category to its PMIDS to its entities to the entity counts
+        - Map category to its PMIDs' rows of the PMID x entity count matrix
         '''
         # Iterate through each category name and its publication PMIDs
         for category, category_pmids in self.category2pmids.items():
 
-            # For each PMID, map PMID->Entity->Entity_Count
-            pmid2entity2count = dict()
-            for pmid in category_pmids:
-                try:
-                    entity2count = self.pmid2entity2count[pmid]
-                    pmid2entity2count[pmid] = entity2count
-                except:
-                    print(pmid)
-                    # print(category_pmids)
-                    # print(self.pmid2entity2count)
+            # Rows of the category's PMIDs (PMIDs without entities are printed)
+            rows, missing_pmids = self.entity_counts.rows(category_pmids)
+            for pmid in missing_pmids.tolist():
+                print(pmid)
 
-            # Save Category->PMID->Entity->Entity_Count
-            self.category2pmid2entity2count[category] = pmid2entity2count
+            # Save Category->Rows
+            self.category2rows[category] = rows
+
+    def category_counts(self, category):
+        '''
+        FUNCTION:
+        - The category's PMIDs x entity counts (sparse matrix)
+        '''
+        return self.entity_counts.counts[self.category2rows[category]]
 
     def get_all_entities(self, prefix, dump=False, verbose=False):
         '''
@@ -156,16 +629,12 @@ class Caseolap(object):
         all_categories_entities = list()
 
         # Each category
-        for category, pmid2ent2cnt in self.category2pmid2entity2count.items():
-
-            # Each PMID in the category
-            categorys_entities = list()
-            for pmid, ent2cnt in pmid2ent2cnt.items():
-                # Each entity in the PMID in the category
-                categorys_entities += list(ent2cnt.keys())
+        for category in self.category2rows:
 
-                # Save entities in the category
-            categorys_entities = list(set(categorys_entities))
+            # Entities found in the category's PMIDs
+            num_pmids = np.diff(self.category_counts(category).tocsc().indptr)
+            categorys_entities = [self.entity_counts.entities[col] 
+                                  for col in np.flatnonzero(num_pmids).tolist()]
 
             # Save Category->Entities
             self.category2entities[category] = categorys_entities
@@ -180,7 +649,7 @@ class Caseolap(object):
             all_categories_entities += categorys_entities
 
             # Save all entities discovered (from all categories)
-        self.all_entities = list(set(all_categories_entities))
+        self.all_entities = sorted(set(all_categories_entities))
 
         # Print number of entities
         if verbose:
@@ -195,81 +664,19 @@ class Caseolap(object):
             self.dump_json(self.all_entities, file_name=prefix + '_proteins/' + prefix + '_proteins')
             self.dump_json(self.category2entities, file_name=prefix + '_proteins/' + prefix + '_category2proteins')
 
-    def map_entity2pmid_or_tf(self, pmid2entity2count, tf_or_pmid):
-        '''
-        FUNCTION:
-        - Map entity to either term frequency (count) or PMID
-
-        PARAMS:
-        - pmid2entity2count (nested dict): Maps PMID to entity to count
-        - tf_or_pmid (str): Is either 'tf' or 'pmid'. Indicates whether to
-          map entity to TF or PMID
-        '''
-
-        map_dict = list()
-
-        # Each PMID
-        for pmid, entity2count in pmid2entity2count.items():
-
-            # Each Entity2Count
-            for entity, count in entity2count.items():
-
-                # Map entity to term frequency in a PMID or PMID
-                if tf_or_pmid == 'tf':
-                    map_dict.append({'Entity': entity, 'TF in a PMID': int(count)})
-                elif tf_or_pmid == 'pmid':
-                    map_dict.append({'Entity': entity, 'PMID': pmid})
-
-        return map_dict
-
-    def map_entity2counts_in_category(self, list_of_dicts, operation):
-        '''
-        FUNCTION:
-        - Start with the entity to the counts in each PMID in the category
-        - Map the entity to the counts in the whole category.
-
-        PARAMS:
-        - list_of_dicts: List of dicts of {'Entity':'the_entity', 'tf':0}. Turned
-          into a dataframe.
-        - operation: Whether to take the sum or the count of the entities
-        '''
-        # Dataframe of entity2count dictionary
-        df = pd.DataFrame(list_of_dicts)
-        col = df.columns
-        df = df.set_index(col[0])
-
-        # Group by entity, take the sum
-        if operation == 'sum':
-            gdf = df.groupby(col[0]).sum()
-
-        # Group by entity, take the count
-        elif operation == 'count':
-            gdf = df.groupby(col[0]).count()
-
-        # Pre-mapping
-        entity2count = dict()
-        entities = list(gdf.index)
-        total_counts = list(gdf[col[1]])
-
-        # Map the 'Entity' to 'counts in the category'
-        for entity, total_count in zip(entities, total_counts):
-            entity2count[entity] = total_count
-
-        return entity2count
-
     def get_entity_counts_per_category(self):
         '''
         FUNCTION:
         - For each category, get the entity's term frequency (counts)
         '''
         # For each category...
-        for category, pmid2entity2count in self.category2pmid2entity2count.items():
-            # Map entity to count in each PMID
-            entity2counts = self.map_entity2pmid_or_tf(pmid2entity2count, 'tf')
-
-            # Map entity to counts in all PMIDs
-            entity2count = self.map_entity2counts_in_category(entity2counts, 'sum')
-            self.category2entity2count[category] = entity2count
+        for category in self.category2rows:
+            # Map entity to counts in all PMIDs (column sums)
+            counts = self.category_counts(category).tocsc()
+            entity_counts = np.asarray(counts.sum(axis=0)).ravel()
+            self.category2entity2count[category] = \
+                {self.entity_counts.entities[col]: int(entity_counts[col])
+                 for col in np.flatnonzero(np.diff(counts.indptr)).tolist()}
 
     def category2entity2tf_finder(self):
         '''
@@ -332,17 +739,16 @@ class Caseolap(object):
     def category2entity2num_pmids_finder(self):
         '''
         FUNCTION:
-        - In each category, map the entity to the number of PMIDs it is in(?)
+        - In each category, map the entity to the number of PMIDs it is in
         '''
-        for category, pmid2entity2count in self.category2pmid2entity2count.items():
-            # Map entity to a PMID
-            entity2pmid = self.map_entity2pmid_or_tf(pmid2entity2count, 'pmid')
-
-            # Map entity to number of PMIDs
-            entity2num_pmids = self.map_entity2counts_in_category(entity2pmid, 'count')
+        for category in self.category2rows:
+            # Map entity to number of PMIDs (non-zero counts per column)
+            num_pmids = np.diff(self.category_counts(category).tocsc().indptr)
 
             # Save
-            self.category2entity2num_pmids[category] = entity2num_pmids
+            self.category2entity2num_pmids[category] = \
+                {self.entity_counts.entities[col]: int(num_pmids[col])
+                 for col in np.flatnonzero(num_pmids).tolist()}
 
     def calculate_category2entity2ntf(self):
         '''
@@ -493,6 +899,117 @@ class Caseolap(object):
             file_name = all_or_core + '_proteins/' + all_or_core + '_distinctiveness_score'
             self.df_builder(self.category2entity2distinctiveness, file_name)
 
+    def calculate_all_scores(self, all_or_core, dump=False):
+        '''
+        FUNCTION:
+        - Calculate the popularity, distinctiveness and CaseOLAP scores of all
+          entities at once (caseolap_scores). Same results as the steps from
+          get_entity_counts_per_category to calculate_caseolap_score. Needs
+          map_category2pmid2entity2count and get_all_entities first.
+
+        PARAMS:
+        - dump: Whether to export the scores (same files as the steps)
+        '''
+        # PMIDs x categories indicator (categories in the category names order)
+        rows = [self.category2rows.get(category, np.zeros(0, dtype=np.int64)) 
+                for category in self.category_names]
+        category_nums = [np.full(len(cat_rows), cat_num) for cat_num, cat_rows in enumerate(rows)]
+        indicator = sparse.csr_matrix((np.ones(sum(len(cat_rows) for cat_rows in rows)),
+                                       (np.concatenate(rows), np.concatenate(category_nums))),
+                                      shape=(len(self.entity_counts), len(self.category_names)))
+        indicator.data[:] = 1
+
+        # Scores of the entities found
+        cols = [self.entity_counts.entity2num[entity] for entity in self.all_entities]
+        scores = caseolap_scores(self.entity_counts.counts[:, cols], indicator)
+        for name, values in scores.items():
+            df = pd.DataFrame(values.T, index=pd.Index(self.all_entities, name='entity'),
+                              columns=self.category_names)
+            self.score_dfs[name] = df
+
+        # Category->Entity->Score
+        self.category2entity2popularity = self.score_dfs['popularity'].to_dict()
+        self.category2entity2distinctiveness = self.score_dfs['distinctiveness'].to_dict()
+        self.category2entity2caseolap = self.score_dfs['caseolap'].to_dict()
+        self.category2total_tf = dict(zip(self.category_names, scores['tf'].sum(axis=1).tolist()))
+
+        # Export
+        if dump:
+            for name, file_name in (('popularity', '_popularity_score'),
+                                    ('distinctiveness', '_distinctiveness_score'),
+                                    ('caseolap', '_caseolap')):
+                file_name = all_or_core + '_proteins/' + all_or_core + file_name
+                self.score_dfs[name].to_csv(os.path.join(self.result_dir, file_name+'.csv'))
+            self.dump_json(self.category2entity2caseolap, all_or_core + '_proteins/' + all_or_core + '_caseolap')
+            self.dump_json(self.result_stat, all_or_core + '_proteins/' + all_or_core + '_result_stat')
+
+    def bootstrap_scores(self, all_or_core, num_replicates=200, confidence=0.95, 
+                         workers=1, replicates_per_task=10, seed=0, dump=False):
+        '''
+        FUNCTION:
+        - Bootstrap confidence intervals of the popularity, distinctiveness
+          and CaseOLAP scores: the documents of each category are resampled
+          num_replicates times (bootstrap_replicates), spread over worker
+          processes. Needs calculate_all_scores first.
+
+        PARAMS:
+        - num_replicates (int): Number of bootstrap replicates
+        - confidence (float): Confidence level of the intervals (percentiles)
+        - workers (int): Number of processes
+        - replicates_per_task (int): Replicates scored together (memory:
+          replicates x categories x entities per score)
+        - seed (int): Random seed (same results for any number of workers)
+        - dump: Whether to export the intervals (one CSV per score)
+        '''
+        cols = [self.entity_counts.entity2num[entity] for entity in self.all_entities]
+        category_rows = [self.category2rows.get(category, np.zeros(0, dtype=np.int64)) 
+                         for category in self.category_names]
+        counts = self.entity_counts.counts[:, cols]
+
+        # Replicate tasks, each with its own random seed
+        task_sizes = [min(replicates_per_task, num_replicates - start) 
+                      for start in range(0, num_replicates, replicates_per_task)]
+        tasks = list(zip(task_sizes, np.random.SeedSequence(seed).spawn(len(task_sizes))))
+        shape = (num_replicates, len(self.category_names), len(cols))
+        replicates = {name: np.empty(shape, dtype=np.float32) for name in BOOTSTRAP_SCORES}
+        
+        self.print_progress('Bootstrap: ' + str(num_replicates) + ' replicates, ' + \
+                            str(workers) + ' workers')
+        start = 0
+        if workers > 1:
+            pool = Pool(workers, initializer=init_bootstrap_worker, initargs=(counts, category_rows))
+            results = pool.imap(bootstrap_replicates, tasks)
+        else:
+            init_bootstrap_worker(counts, category_rows)
+            results = map(bootstrap_replicates, tasks)
+        for task_num, scores in enumerate(results, 1):
+            size = len(scores['caseolap'])
+            for name in BOOTSTRAP_SCORES:
+                replicates[name][start:start+size] = scores[name]
+            start += size
+            print('Bootstrap: ' + str(start) + '/' + str(num_replicates) + ' replicates')
+        if workers > 1:
+            pool.close()
+            pool.join()
+
+        # Entity-category score, bootstrap mean, standard deviation and interval
+        index = pd.MultiIndex.from_product([self.all_entities, self.category_names], 
+                                           names=['entity', 'category'])
+        lower_q, upper_q = (1 - confidence) / 2, 1 - (1 - confidence) / 2
+        for name in BOOTSTRAP_SCORES:
+            values = replicates[name]
+            lower, upper = np.nanquantile(values, [lower_q, upper_q], axis=0)
+            df = pd.DataFrame({'score': self.score_dfs[name].values.ravel(),
+                               'mean': np.nanmean(values, axis=0).T.ravel(),
+                               'std': np.nanstd(values, axis=0).T.ravel(),
+                               'lower': lower.T.ravel(), 'upper': upper.T.ravel()}, index=index)
+            self.bootstrap_dfs[name] = df
+
+            # Export
+            if dump:
+                file_name = all_or_core + '_proteins/' + all_or_core + '_' + name + '_bootstrap'
+                df.to_csv(os.path.join(self.result_dir, file_name+'.csv'))
+
     def calculate_caseolap_score(self, all_or_core, dump=False):
         '''
         FUNCTION:
@@ -1,4 +1,6 @@
 import json, pandas as pd, numpy as np, csv, os
+from text_mining.caseolap._06_textcube import PMIDBitmap
+from text_mining.caseolap._08_count_synonyms import SynonymCounts
 
 # Note: counts = #hits, the number of times a synonym was found in the text
 
@@ -19,7 +21,8 @@ class InspectEntityScores(object):
         - scores_in: Input file. CaseOLAP scores csv
         - id2syns_in: Input file. EntityID->Synonyms dict
         - remove_syns_in: Input file. Synonyms not used in the search.
-        - pmid_syn_count_in: Input file. PMID->Synonyms->SynonymCounts
+        - pmid_syn_count_in: Input path. PMID->Synonyms->SynonymCounts, the
+          synonym count store (or the older JSON file)
         - cat2pmids_in: Input file. Category->PMIDS
         '''
 
@@ -50,18 +53,11 @@ class InspectEntityScores(object):
             self.bad_syns = [syn.strip() for syn in fin.readlines()]
 
         # Get "pmid->synonym->counts" dictionary
-        self.pmid2syn2count = json.load(open(pmid_syn_count_in, 'r'))
+        self.pmid2syn2count = SynonymCounts.load(pmid_syn_count_in)
 
-        # Get Category->PMID
+        # Get Category->PMIDs bitmap
         cat2pmid = json.load(open(cat2pmids_in, 'r'))
-
-        # Get PMID->Category
-        pmid2cat = dict()
-        for cat, pmids in cat2pmid.items():
-            for pmid in pmids:
-                pmid2cat[pmid] = pmid2cat.setdefault(pmid, list())
-                pmid2cat[pmid].append(cat)
-        self.pmid2cat = pmid2cat
+        self.cat2bitmap = {cat: PMIDBitmap.from_pmids(pmids) for cat, pmids in cat2pmid.items()}
 
     '''
     PART 1: Getting the ranked synonyms
@@ -85,21 +81,21 @@ class InspectEntityScores(object):
         for cat in self.cols:
             syn2count[cat] = dict()
 
-        # Get each PMID's category
-        for pmid, syn2cnt in self.pmid2syn2count.items():
-
-            # Map category->synonym->counts
-            for syn, count in syn2cnt.items():
-                if syn in self.bad_syns:
-                    continue
-
-                # 'TOTAL' category
-                syn2count['TOTAL'][syn] = syn2count['TOTAL'].get(syn, 0) + count
-
-                # PMID's category/categories
-                cats = self.pmid2cat[pmid]
-                for cat in cats:
-                    syn2count[cat][syn] = syn2count[cat].get(syn, 0) + count
+        # Synonyms counted (not removed)
+        store = self.pmid2syn2count
+        bad_syns = set(self.bad_syns)
+        good = np.array([syn not in bad_syns for syn in store.synonyms], dtype=bool)
+
+        # Map category->synonym->counts (summed over the category's PMIDs)
+        cat2rows = {'TOTAL': slice(None)}
+        for cat, bitmap in self.cat2bitmap.items():
+            if cat in syn2count:
+                cat2rows[cat] = bitmap.contains(store.pmids)
+        for cat, rows in cat2rows.items():
+            sums = np.bincount(store.syn_nums[rows], weights=store.counts[rows],
+                               minlength=len(store.synonyms))
+            for num in np.flatnonzero((sums > 0) & good).tolist():
+                syn2count[cat][store.synonyms[num]] = int(sums[num])
 
         # Sort and export each category's synonym counts
         for cat in self.cols:
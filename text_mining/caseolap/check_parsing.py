@@ -0,0 +1,74 @@
+'''
+Regression check of the PubMed parser: a bulk file with a journal article,
+a book record (PubmedBookArticle) and a deleted citation must give the
+same parsed documents whether it is streamed or read as one tree.
+
+Run: python -m text_mining.caseolap.check_parsing
+'''
+import io, json, os, tempfile
+from text_mining.caseolap._02_parsing import Parser
+
+PARSING_CONFIG = {'PMID': True, 'title': True, 'abstract': True, 'MeSH': True,
+                  'full_text': True, 'author': True, 'journal': True,
+                  'date': True, 'location': True}
+
+BULK_FILE = '''<?xml version="1.0" encoding="utf-8"?>
+<PubmedArticleSet>
+<PubmedArticle><MedlineCitation><PMID Version="1">11</PMID><Article>
+<Journal><JournalIssue><PubDate><Year>2015</Year></PubDate></JournalIssue><Title>A Journal</Title></Journal>
+<ArticleTitle>An article</ArticleTitle><Abstract><AbstractText>Article abstract.</AbstractText></Abstract>
+<AuthorList><Author><LastName>Doe</LastName><ForeName>J</ForeName><Initials>J</Initials></Author></AuthorList>
+</Article><MedlineJournalInfo><Country>United States</Country></MedlineJournalInfo>
+<MeshHeadingList><MeshHeading><DescriptorName>Heart Diseases</DescriptorName></MeshHeading></MeshHeadingList>
+</MedlineCitation></PubmedArticle>
+<PubmedBookArticle><BookDocument><PMID Version="1">22</PMID>
+<Book><Publisher><PublisherName>A Publisher</PublisherName></Publisher><BookTitle>A Book</BookTitle>
+<PubDate><Year>2003</Year></PubDate></Book>
+<ArticleTitle>A chapter</ArticleTitle><Abstract><AbstractText>Chapter abstract.</AbstractText></Abstract>
+</BookDocument><PubmedBookData><History/></PubmedBookData></PubmedBookArticle>
+<DeleteCitation><PMID Version="1">33</PMID></DeleteCitation>
+</PubmedArticleSet>
+'''
+
+
+def parse_bulk_text(bulk_text, streaming):
+    '''
+    FUNCTION:
+    - Parse a bulk file's text
+
+    OUTPUT:
+    - documents (list): The parsed documents
+    - deleted (list): The deleted PMIDs
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bulk_path = os.path.join(tmp_dir, 'pubmed00n0001.xml')
+        with open(bulk_path, 'w') as fout:
+            fout.write(bulk_text)
+        pubmed, filestat, deleted = io.StringIO(), io.StringIO(), io.StringIO()
+        Parser(bulk_path, pubmed, filestat, PARSING_CONFIG,
+               deleted_output_file=deleted).parse_pubmed_file(io.StringIO(), streaming=streaming)
+    documents = [json.loads(line) for line in pubmed.getvalue().splitlines()]
+    return documents, deleted.getvalue().split()
+
+
+def check_book_records():
+    '''
+    FUNCTION:
+    - Check that both parsing modes parse the journal article and the book
+      record (with its year, without journal or country) the same way
+    '''
+    tree_documents, tree_deleted = parse_bulk_text(BULK_FILE, streaming=False)
+    stream_documents, stream_deleted = parse_bulk_text(BULK_FILE, streaming=True)
+    assert tree_documents == stream_documents, (tree_documents, stream_documents)
+    assert tree_deleted == stream_deleted == ['33'], (tree_deleted, stream_deleted)
+    assert [document['PMID'] for document in tree_documents] == ['11', '22']
+
+    article, book = tree_documents
+    assert article['PubDate']['Year'] == '2015' and article['Country'] == 'United States'
+    assert book['PubDate']['Year'] == '2003' and book['ArticleTitle'] == 'A chapter'
+    assert book['Journal'] == '' and book['Country'] == ''
+    print('Parsing check passed: '+str(len(tree_documents))+' documents, both modes agree')
+
+
+if __name__ == '__main__':
+    check_book_records()
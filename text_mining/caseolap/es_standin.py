@@ -0,0 +1,143 @@
+import json, random, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+'''
+Local stand-in ElasticSearch (bulk indexing only)
+'''
+class StandinElasticsearch(object):
+    '''
+    A small in-memory ElasticSearch stand-in, served over HTTP in a thread,
+    to run the BulkIndexer (and populate_index without fast_mode) without
+    a cluster. It answers the client's info request and bulk requests
+    (index, create, delete); the documents are kept in self.docs. Items
+    can be rejected with 429 (cluster busy, to test retries and
+    back-pressure) or failed with 400 (to test the dead-letter file).
+
+    Example:
+        standin = StandinElasticsearch(reject_rate=0.2, fail_ids=['123'])
+        es = Elasticsearch(standin.start())
+        report = BulkIndexer(es, logfile, dead_letter_file='dead.jsonl').index(actions)
+        standin.stop()
+    '''
+
+    def __init__(self, port=0, reject_rate=0.0, fail_ids=(), seed=0):
+        '''
+        PARAMS:
+        - port (int): Port to listen on (0: any free port)
+        - reject_rate (float): Probability that an item is rejected with 429
+        - fail_ids (iterable): Document IDs always failed with 400
+        - seed (int): Seed of the rejections
+        '''
+        self.port = port
+        self.reject_rate = reject_rate
+        self.fail_ids = set(str(doc_id) for doc_id in fail_ids)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.docs = dict()   # (index, _id) -> source
+        self.stats = {'bulk_requests': 0, 'items': 0, 'rejected': 0, 'failed': 0}
+        self.server = None
+
+
+    def bulk_item(self, op_type, meta, source):
+        # Apply one bulk item, return its result
+        index, doc_id = meta.get('_index'), str(meta.get('_id'))
+        self.stats['items'] += 1
+        if doc_id in self.fail_ids:
+            self.stats['failed'] += 1
+            return {'_index': index, '_id': doc_id, 'status': 400,
+                    'error': {'type': 'mapper_parsing_exception',
+                              'reason': 'failed to parse (stand-in)'}}
+        if self.random.random() < self.reject_rate:
+            self.stats['rejected'] += 1
+            return {'_index': index, '_id': doc_id, 'status': 429,
+                    'error': {'type': 'es_rejected_execution_exception',
+                              'reason': 'rejected execution (stand-in)'}}
+        if op_type == 'delete':
+            found = self.docs.pop((index, doc_id), None) is not None
+            return {'_index': index, '_id': doc_id, 'status': 200 if found else 404,
+                    'result': 'deleted' if found else 'not_found'}
+        if op_type == 'create' and (index, doc_id) in self.docs:
+            return {'_index': index, '_id': doc_id, 'status': 409,
+                    'error': {'type': 'version_conflict_engine_exception',
+                              'reason': 'document already exists (stand-in)'}}
+        created = (index, doc_id) not in self.docs
+        self.docs[(index, doc_id)] = source
+        return {'_index': index, '_id': doc_id, 'status': 201 if created else 200,
+                'result': 'created' if created else 'updated'}
+
+
+    def bulk(self, path_index, body):
+        # Apply a bulk request (NDJSON: action line, then source line)
+        lines = [line for line in body.split('\n') if line.strip()]
+        items, errors, i = [], False, 0
+        with self.lock:
+            self.stats['bulk_requests'] += 1
+            while i < len(lines):
+                (op_type, meta), = json.loads(lines[i]).items()
+                meta.setdefault('_index', path_index)
+                source = None
+                if op_type != 'delete':
+                    i += 1
+                    source = json.loads(lines[i])
+                i += 1
+                result = self.bulk_item(op_type, meta, source)
+                errors = errors or 'error' in result
+                items.append({op_type: result})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+
+    def start(self):
+        '''
+        FUNCTION:
+        - Start serving in a daemon thread
+
+        OUTPUT:
+        - url (str): Address to give the Elasticsearch client
+        '''
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, response):
+                body = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def handle_request(self):
+                parts = [part for part in self.path.split('?')[0].split('/') if part]
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode() if length > 0 else ''
+                if not parts:
+                    return self.send(200, {'version': {'number': '7.17.0', 'build_flavor': 'default'},
+                                           'tagline': 'You Know, for Search'})
+                if parts[-1] == '_bulk':
+                    return self.send(200, standin.bulk(parts[0] if len(parts) > 1 else None, body))
+                self.send(400, {'error': 'not supported by the stand-in: '+self.path})
+
+            do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = handle_request
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:'+str(self.port)
+
+
+    def stop(self):
+        '''
+        FUNCTION:
+        - Stop serving
+        '''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -44,6 +44,7 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
 
     download_config_file_path = os.path.join(config_dir,'download_config.json')
     ftp_config_file_path = os.path.join(config_dir,'ftp_config.json')
+    md5_report_path = os.path.join(log_dir,'md5_report.json') # Passed/failed md5 checks per directory
 
     # Input 02
     parsing_config_file = os.path.join(config_dir,'parsing_config.json')
@@ -52,12 +53,24 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     pubmed_path = os.path.join(data_folder,'pubmed.json')     # The parsed PubMed documents (dictionary)
     filestat_path = os.path.join(data_folder,'filestat.json') # Unzipped PubMed download file name : #PMIDs
     logfile_path = os.path.join(log_dir,'parsing_log.txt') # Logs progress on parsing
+    pubmed_shard_dir = os.path.join(data_folder,'pubmed_shards') # One parsed shard per bulk file
+    parse_manifest_path = os.path.join(pubmed_shard_dir,'manifest.json') # Bulk file size/mtime/MD5 -> shard
+    pmid_store_path = os.path.join(data_folder,'pubmed_pmid_store.sqlite') # Latest version of each PMID
+    pubmed_parquet_dir = os.path.join(data_folder,'pubmed_parquet') # Columnar parsed documents, one file per bulk file
+
+    # Other parameters 02
+    stream_parsing = True   # Parse the zipped files directly, one article at a time (no extraction in 01)
+    parsing_workers = cpu_count()  # Bulk files parsed in parallel (1 = no worker processes)
+    columnar_output = False  # Also write Parquet (needs pyarrow); steps 03 and 05 then read only needed columns
+    parsed_pubmed_path = pubmed_parquet_dir if columnar_output else pubmed_path
 
 
     ### Input 03
 
     ### Output 03
     mesh2pmid_outputfile = os.path.join(data_folder,"mesh2pmid.json" )   # {"MeSH Term":[PMID1,...], ...}
+    mesh2pmid_index_dir = os.path.join(data_folder,"mesh2pmid_index")  # MeSH Term -> sorted uint32 PMIDs (memory-mapped)
+    export_mesh2pmid_json = False  # Also export the mapping as mesh2pmid.json (older format)
     mesh2pmid_statfile = os.path.join(data_folder,"mesh2pmid_stat.json") # {"MeSH Term": #PMIDs, ...}
     logFilePath = os.path.join(log_dir,'mesh2pmid_log.txt')           # Logs mapping progress
 
@@ -68,6 +81,7 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     number_shards = 1          # Set to 1 if no cluster
     number_replicas = 0
     case_sensitive = True   # Index the text as case sensitive (True) or lower case (False)
+    versioned_index = False  # Build a new index_name_<timestamp> index, then point the alias index_name to it
 
     # Input file 04
     index_init_config_file = os.path.join(config_dir,'index_init_config.json')
@@ -78,6 +92,14 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
 
     # Output 05
     logfile_path = os.path.join(log_dir,'indexing_log.txt')            # Reports progress on indexing
+    index_dead_letter_path = os.path.join(log_dir,'indexing_failed_documents.jsonl') # Documents that failed to index
+
+    # Other parameters 05
+    index_threads = 4                       # Bulk requests sent at a time
+    index_chunk_size = 500                  # Maximum documents per bulk request
+    index_chunk_bytes = 10*1024*1024        # Maximum bytes per bulk request
+    index_fast_mode = True                  # No refreshes/replicas while loading, restored afterwards
+    index_max_num_segments = 1              # Force-merge into this many segments after loading (None: skip)
 
     # Names of the index you want to create 05
 
@@ -85,13 +107,15 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     meshtree = os.path.join(data_folder,'MeSH/mtrees2023.bin')                 # MeSH Tree ontology TODO hardcoded
     root_cat = os.path.join(data_folder,'categories.txt')                 # Categories' root MeSH Tree nums
     textcube_config = os.path.join(config_dir,'textcube_config.json')   # ['CategoryName1',...]
-    mesh2pmid = mesh2pmid_outputfile # from step 2
+    mesh2pmid = mesh2pmid_index_dir # from step 3
 
     # Output data directories 06
     textcube_pmid2category = os.path.join(data_folder,'textcube_pmid2category.json') # Map PMID to category
     textcube_category2pmid = os.path.join(data_folder,'textcube_category2pmid.json') # Map category to PMID
+    textcube_bitmaps = os.path.join(data_folder,'textcube_bitmaps.npz')              # Category -> PMID bitmap
     textcube_stat = os.path.join(data_folder,'textcube_stat.txt')                    # Num. documents per category
     MeSHterms_percat = os.path.join(data_folder,'meshterms_per_cat.json')            # MeSH *Terms* per category
+    meshtree_cache = os.path.join(data_folder,'meshtree_index.json')                 # Sorted MeSH tree numbers (reused)
     logfile_path = os.path.join(log_dir,'textcube_log.txt')                       # Logs file's messages
 
 
@@ -106,11 +130,17 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     case_varied_entity_dict_path = os.path.join(input_dir,'id2syns.json') # entity dict
     core_id2syns=os.path.join(input_dir,'core_id2syns.json')
     core_proteins_file=os.path.join(root_dir,'output/core_proteins.txt')
+    canonical_entity_dict_path = os.path.join(input_dir,'id2syns_canonical.json') # entity dict, synonyms not case-varied
+    export_case_varied_synonyms = True  # Export every case-varied synonym (False: canonical synonyms, when case folding)
 
     # Input 08
     entity_dict_path = entity_dict_path_no_cs
     #entity_dict_path = 'input/id2syns.json'
+    case_fold_synonyms = False  # Match each canonical synonym in all its cases (case-fold mask) instead of each case-varied synonym
+    if case_fold_synonyms:
+        entity_dict_path = canonical_entity_dict_path
     textcube_pmid2category = os.path.join(data_folder,'textcube_pmid2category.json')
+    textcube_bitmaps = os.path.join(data_folder,'textcube_bitmaps.npz') # Read instead of textcube_pmid2category
     if date_range != None:
         start_year = int(date_range[0].split("-")[0])
         end_year = int(date_range[1].split("-")[0])
@@ -120,12 +150,15 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
         # TODO
     # start_year = 2012    # <-- Change as you see fit for your publications of interest
     # end_year = 2022      # <-- Same as above comment
+    count_synonyms_locally = False  # Count in the parsed documents in one pass (needs pyahocorasick, not ElasticSearch)
+    synonyms_per_query = 50   # Synonyms per ElasticSearch query (named queries), if not counting locally
 
     # Intermediary file (produced as    c
     syn_pmid_count = os.path.join(data_folder,'syn_pmid_count.txt')
 
     # Output 08
-    pmid_syn_count_out = os.path.join(data_folder,'pmid_synonym_counts_2012-2022.json')   # PMID Syn|Count...Syn|Cnt
+    pmid_syn_count_out = os.path.join(data_folder,'pmid_synonym_counts_2012-2022')   # PMID Syn|Count...Syn|Cnt (count store, memory-mapped)
+    pmid_syn_count_json = None   # e.g., os.path.join(data_folder,'pmid_synonym_counts_2012-2022.json') to also export the older JSON
     synfound_pmid2cat = os.path.join(data_folder,'synfound_pmid2category_2012-2022.txt')  # PMID--->CategoryNumber
     logfile = os.path.join(log_dir,'synonymcount_log_2012-2022.txt')                   # #hits:Synonym
 
@@ -151,24 +184,24 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     remove_syns_infile = os.path.join(data_folder,'remove_these_synonyms.txt')
     all_id2syns_path = os.path.join(input_dir,'id2syns.json')
     core_id2syns_path = os.path.join(input_dir,'core_id2syns.json')
-    pmid_syn_count_in = os.path.join(data_folder,'pmid_synonym_counts_2012-2022.json')
+    pmid_syn_count_in = os.path.join(data_folder,'pmid_synonym_counts_2012-2022') # Count store (or the older JSON file)
 
     # Output 10
-    all_entitycount_outfile = os.path.join(data_folder,'all_entitycount_2012-2022.txt')
-    core_entitycount_outfile = os.path.join(data_folder,'core_entitycount_2012-2022.txt')
+    all_entitycount_outfile = os.path.join(data_folder,'all_entitycount_2012-2022.npz')   # PMID x Entity counts (sparse matrix)
+    core_entitycount_outfile = os.path.join(data_folder,'core_entitycount_2012-2022.npz') # (.txt writes PMID Entity|Count ...)
 
 
 
     # Input file paths 11
-    all_entitycount_path = os.path.join(data_folder,'all_entitycount_2012-2022.txt')              # PMID Entity|Count ...
-    core_entitycount_path = os.path.join(data_folder,'core_entitycount_2012-2022.txt')              # PMID Entity|Count ...
-    pmid2category_path = os.path.join(data_folder,'textcube_pmid2category.json')# PMIDs of interest to category
+    all_entitycount_path = os.path.join(data_folder,'all_entitycount_2012-2022.npz')              # PMID x Entity counts
+    core_entitycount_path = os.path.join(data_folder,'core_entitycount_2012-2022.npz')              # PMID x Entity counts
+    pmid2category_path = os.path.join(data_folder,'textcube_bitmaps.npz')# PMIDs of interest to category (or textcube_pmid2category.json)
     category_names_file = os.path.join(config_dir,'textcube_config.json')  # Category names
 
 
     # Output file paths 11
-    all_outfile_pmid2entity2count = os.path.join(data_folder,'all_metadata_pmid2entity2count_2012-2022-2.json') # {PMID:{Entity:Count,...},...}
-    core_outfile_pmid2entity2count = os.path.join(data_folder,'core_metadata_pmid2entity2count_2012-2022-2.json') # {PMID:{Entity:Count,...},...}
+    all_outfile_pmid2entity2count = os.path.join(data_folder,'all_metadata_pmid2entity2count_2012-2022-2.npz') # PMID x Entity counts (.json: {PMID:{Entity:Count,...},...})
+    core_outfile_pmid2entity2count = os.path.join(data_folder,'core_metadata_pmid2entity2count_2012-2022-2.npz') # PMID x Entity counts (.json: {PMID:{Entity:Count,...},...})
     all_cat2pmids_path = os.path.join(data_folder,'all_metadata_category2pmids_2012-2022-2.json')  # {CatName:[PMID,...], ...}
     core_cat2pmids_path = os.path.join(data_folder,'core_metadata_category2pmids_2012-2022-2.json')  # {CatName:[PMID,...], ...}
     all_logfile_path = os.path.join(log_dir,'all_metadata_update_log_2012-2022.txt')         # Similar to pmid2pcount
@@ -177,8 +210,8 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     # Input data directories 12
     all_cat2pmids_path =  os.path.join(data_folder,'all_metadata_category2pmids_2012-2022-2.json') # {CatName:[PMID,...], ...}
     core_cat2pmids_path = os.path.join(data_folder,'core_metadata_category2pmids_2012-2022-2.json')  # {CatName:[PMID,...], ...}
-    all_pmid2entity2count_path = os.path.join(data_folder,'all_metadata_pmid2entity2count_2012-2022-2.json') # {PMID:{Entity:Count,...},...}
-    core_pmid2entity2count_path = os.path.join(data_folder,'core_metadata_pmid2entity2count_2012-2022-2.json') # {PMID:{Entity:Count,...},...}
+    all_pmid2entity2count_path = os.path.join(data_folder,'all_metadata_pmid2entity2count_2012-2022-2.npz') # PMID x Entity counts
+    core_pmid2entity2count_path = os.path.join(data_folder,'core_metadata_pmid2entity2count_2012-2022-2.npz') # PMID x Entity counts
     category_names_path = os.path.join(config_dir,'textcube_config.json')    # ['CategoryName1',...]
     # config_dir
     # Output data path 12
@@ -186,10 +219,19 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     core_logFilePath = os.path.join(log_dir,'core_caseolap_score_log.txt') # Logs #PMIDs for each category
     all_caseolap_name = 'all_caseolap'  # Name of dataframe/spreadsheet for the caseolap scores
     core_caseolap_name = 'core_caseolap'
+    all_caseolap_cube = os.path.join(data_folder,'all_caseolap_year_cube.npz')   # Entity TF/DF per (category, year)
+    core_caseolap_cube = os.path.join(data_folder,'core_caseolap_year_cube.npz') # Entity TF/DF per (category, year)
+    caseolap_window_width = 5      # Years per window of the sliding window scores (None: skip)
+    caseolap_window_start = 1990   # First window's start year
+    caseolap_bootstrap_replicates = 0   # Bootstrap replicates for the score confidence intervals (0: skip)
+    caseolap_bootstrap_workers = cpu_count()
+    temporal_score_width = 1       # Years per window of the per-year score tensors (None: skip)
+    all_temporal_scores = os.path.join(analysis_output_folder,'all_proteins/all_temporal_scores')   # Entity x category x year scores
+    core_temporal_scores = os.path.join(analysis_output_folder,'core_proteins/core_temporal_scores') # Entity x category x year scores
 
     # Input path 13
     id2syns_in = os.path.join(input_dir,'id2syns.json')                # The case-varied entity dict
-    pmid_syn_count_in = os.path.join(data_folder,'pmid_synonym_counts_2012-2022.json')  # Counts of each synonym
+    pmid_syn_count_in = os.path.join(data_folder,'pmid_synonym_counts_2012-2022')  # Counts of each synonym (count store or JSON)
     remove_syns_in = os.path.join(data_folder,'remove_these_synonyms.txt')    # Syns that were not used
 
     all_caseolap_scores_in = os.path.join(analysis_output_folder,'all_proteins/all_caseolap.csv')  # The CaseOLAP scores
@@ -224,37 +266,55 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
             os.makedirs(dir)
     print("01_run_download")
     text_mining_01_run_download(data_folder, logFilePath, download_config_file_path, ftp_config_file_path,
-                               baseline_dir,update_files_dir)
+                               baseline_dir,update_files_dir, extract=not stream_parsing,
+                               md5_report_path=md5_report_path)
 
     print("02_run_parsing")
     text_mining_02_run_parsing(baseline_dir, update_files_dir,
                               parsing_config_file, pubmed_path, filestat_path,
-                              logfile_path)
+                              logfile_path, streaming=stream_parsing,
+                              workers=parsing_workers, shard_dir=pubmed_shard_dir,
+                              manifest_path=parse_manifest_path, store_path=pmid_store_path,
+                              parquet_dir=pubmed_parquet_dir if columnar_output else None)
 
     print("03_run_mesh2pmid")
-    text_mining_03_run_mesh2pmid(pubmed_path,
-                                mesh2pmid_outputfile, mesh2pmid_statfile, logFilePath)
+    text_mining_03_run_mesh2pmid(parsed_pubmed_path,
+                                mesh2pmid_index_dir, mesh2pmid_statfile, logFilePath,
+                                mesh2pmid_outputfile=mesh2pmid_outputfile if export_mesh2pmid_json else None)
     print("04_run_index_init")
-    text_mining_04_run_index_init(index_name, type_name, index_init_config_file,
-                                 number_shards=1, number_replicas=0, case_sensitive=True)
+    build_index_name = text_mining_04_run_index_init(index_name, type_name, index_init_config_file,
+                                 number_shards=1, number_replicas=0, case_sensitive=True,
+                                 versioned=versioned_index)
     print("05_run_index_populate")
-    text_mining_05_run_index_populate(pubmed_path, index_populate_config_file,
-                                  logfile_path, index_name, type_name)
+    text_mining_05_run_index_populate(parsed_pubmed_path, index_populate_config_file,
+                                  logfile_path, index_name, type_name,
+                                  threads=index_threads, chunk_size=index_chunk_size,
+                                  max_chunk_bytes=index_chunk_bytes,
+                                  dead_letter_file=index_dead_letter_path,
+                                  build_index_name=build_index_name, fast_mode=index_fast_mode,
+                                  max_num_segments=index_max_num_segments)
     print("06_run_textcube")
     text_mining_06_run_textcube(textcube_category2pmid, meshtree, mesh2pmid, root_cat,
                                textcube_config, textcube_pmid2category,
                                textcube_stat, MeSHterms_percat,
-                               logfile_path)
+                               logfile_path, meshtree_cache=meshtree_cache,
+                               textcube_bitmaps=textcube_bitmaps)
     print("07_run_vary_synonyms_cases")
     text_mining_07_run_vary_synonyms_cases(entity_dict_path_no_cs, species,
                                           case_varied_entites_outpath,
                                           case_varied_entity_dict_path,
                                           core_proteins_file,
-                                          core_id2syns)
+                                          core_id2syns,
+                                          canonical_entity_dict_path=canonical_entity_dict_path,
+                                          export_case_varied=export_case_varied_synonyms)
     print("08_run_count_synonyms")
-    text_mining_08_run_count_synonyms(entity_dict_path, textcube_pmid2category,
+    text_mining_08_run_count_synonyms(entity_dict_path, textcube_bitmaps,
                                   start_year, end_year, syn_pmid_count, pmid_syn_count_out,
-                                  synfound_pmid2cat, logfile, index_name, key)
+                                  synfound_pmid2cat, logfile, index_name, key,
+                                  parsed_corpus=parsed_pubmed_path if count_synonyms_locally else None,
+                                  synonyms_per_query=synonyms_per_query,
+                                  pmid_syn_count_json=pmid_syn_count_json,
+                                  case_fold=case_fold_synonyms)
     print("09_run_screen_synonyms")
     text_mining_09_run_screen_synonyms(data_folder, id2syns, eng_path, short_path, rem_path)
 
@@ -269,7 +329,17 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
     print("12_run_caseolap_score")
     text_mining_12_run_caseolap_score(all_cat2pmids_path, core_cat2pmids_path, all_pmid2entity2count_path,
                                       core_pmid2entity2count_path, category_names_path, all_logFilePath,
-                                      core_logFilePath, all_caseolap_name, core_caseolap_name, analysis_output_folder)
+                                      core_logFilePath, all_caseolap_name, core_caseolap_name, analysis_output_folder,
+                                      parsed_corpus=parsed_pubmed_path, all_cube_path=all_caseolap_cube,
+                                      core_cube_path=core_caseolap_cube,
+                                      bootstrap_replicates=caseolap_bootstrap_replicates,
+                                      bootstrap_workers=caseolap_bootstrap_workers)
+    if caseolap_window_width is not None:
+        text_mining_12_run_window_scores(all_caseolap_cube, core_caseolap_cube, analysis_output_folder,
+                                         caseolap_window_width, window_start=caseolap_window_start)
+    if temporal_score_width is not None:
+        text_mining_12_run_temporal_scores(all_caseolap_cube, core_caseolap_cube, all_temporal_scores,
+                                           core_temporal_scores, width=temporal_score_width)
 
     print("13_run_inspect_entity_scores")
     text_mining_13_run_inspect_entity_scores(id2syns_in, pmid_syn_count_in, remove_syns_in, all_caseolap_scores_in,
@@ -290,10 +360,17 @@ def run_text_mining(root_dir, data_folder, mapping_folder, analysis_output_folde
 
 
 def text_mining_01_run_download(data_dir, logFilePath, download_config_file_path, ftp_config_file_path,
-                               baseline_dir,update_files_dir):
+                               baseline_dir,update_files_dir, extract=True, max_transfers=4,
+                               md5_report_path=None):
     '''
     The purpose of this file is to download the zipped files containing
     the PubMed publications (i.e. documents). These will be mined later.
+    Up to max_transfers files are downloaded at a time; re-running resumes
+    partial files and skips complete ones.
+    Extraction can be skipped (extract=False) when step 02 streams the
+    zipped files directly.
+    The downloads are verified in-process; files failing the md5 check are
+    downloaded once more, and the results are saved to md5_report_path.
     '''
     # Start the download, verification, and extraction process
 
@@ -309,25 +386,48 @@ def text_mining_01_run_download(data_dir, logFilePath, download_config_file_path
         print('Directory not found:', data_dir) 
     
     # Start download 
-    download_pubmed(data_dir, download_config, ftp_config, logfile)
+    download_pubmed(data_dir, download_config, ftp_config, logfile, max_transfers=max_transfers)
     
     # Verify download: 'baseline files' & 'update files'
-    check_all_md5_in_dir(baseline_dir, logfile, linux = True, mac = False)
-    check_all_md5_in_dir(update_files_dir, logfile, linux = True, mac = False)
+    md5_reports = dict()
+    for ndir, ndir_path in (('baseline', baseline_dir), ('update', update_files_dir)):
+        report = check_all_md5_in_dir(ndir_path, logfile, workers=max_transfers)
+        
+        # Download the failed files again, then check them again
+        if report['failed'] and download_config[ndir]:
+            redownload_failed(report, ftp_config[ndir], logfile, max_transfers=max_transfers)
+            report = check_all_md5_in_dir(ndir_path, logfile, workers=max_transfers)
+        md5_reports[ndir] = report
+    
+    if md5_report_path is not None:
+        with open(md5_report_path, 'w') as fout:
+            json.dump(md5_reports, fout, indent=2)
 
     # Extract downloaded files: 'baseline files' & 'update files'
-    extract_all_gz_in_dir(baseline_dir, logfile)
-    extract_all_gz_in_dir(update_files_dir, logfile)
+    if extract:
+        extract_all_gz_in_dir(baseline_dir, logfile)
+        extract_all_gz_in_dir(update_files_dir, logfile)
     
     logfile.close()
 
 
 def text_mining_02_run_parsing(baseline_dir, update_files_dir,
                               parsing_config_file, pubmed_path, filestat_path,
-                              logfile_path):
+                              logfile_path, streaming=False, workers=1, shard_dir=None,
+                              manifest_path=None, store_path=None, parquet_dir=None):
     '''
     The purpose of this file is to parse the downloaded PubMed documents,
     saving their information into a dictionary.
+    With streaming=True, the zipped files are read directly and parsed one
+    article at a time, so memory stays flat regardless of file size.
+    The bulk files are parsed by a pool of worker processes into per-file
+    shards (in shard_dir) which are applied in file order to a PMID store
+    (store_path): update files' revisions and deleted citations are applied
+    so pubmed.json has each PMID exactly once. Only the bulk files not yet
+    in the store are applied. With a manifest_path, only new or changed 
+    bulk files are parsed again (also resumes a crashed run).
+    With a parquet_dir, the documents are also written as Parquet (one file
+    per bulk file), which steps 03 and 05 can read column by column.
     '''
     # Start time
     t1 = time.time()
@@ -339,9 +439,18 @@ def text_mining_02_run_parsing(baseline_dir, update_files_dir,
     parsing_config = json.load(open(parsing_config_file, 'r'))
     print(parsing_config)
 
+    # Shards and PMID store next to the output by default
+    if shard_dir is None:
+        shard_dir = os.path.join(os.path.dirname(pubmed_path), 'pubmed_shards')
+    if store_path is None:
+        store_path = os.path.join(os.path.dirname(pubmed_path), 'pubmed_pmid_store.sqlite')
+
     # Parse the files (baseline and updatefiles)
-    parse_dir(baseline_dir, pubmed, filestat, 'baseline', parsing_config, logfile)
-    parse_dir(update_files_dir, pubmed, filestat, 'updatefiles', parsing_config, logfile)
+    source_dirs = [(baseline_dir, 'baseline'), (update_files_dir, 'updatefiles')]
+    parse_dirs_parallel(source_dirs, shard_dir, pubmed, filestat, parsing_config,
+                        logfile, workers=workers, streaming=streaming,
+                        manifest_path=manifest_path, store_path=store_path,
+                        parquet_dir=parquet_dir)
 
     # Close the files
     pubmed.close()
@@ -355,9 +464,13 @@ def text_mining_02_run_parsing(baseline_dir, update_files_dir,
 
 
 def text_mining_03_run_mesh2pmid(pubmed_path,
-                                mesh2pmid_outputfile, mesh2pmid_statfile, logFilePath):
+                                mesh2pmid_index_dir, mesh2pmid_statfile, logFilePath,
+                                mesh2pmid_outputfile=None):
     '''
     The purpose of this file is to map MeSH Terms (metadata) to PMIDs
+    The mapping is saved as a compact index (sorted uint32 PMIDs per MeSH
+    term) which step 06 memory-maps. With a mesh2pmid_outputfile, it is
+    also exported as JSON lines.
     '''
     # Open log file
     logfile = open(logFilePath, "w")
@@ -366,22 +479,30 @@ def text_mining_03_run_mesh2pmid(pubmed_path,
     mesh2PMID = MeSH2PMID()
 
     # Map MeSH to PMID
-    mesh2PMID.mesh2pmid_mapping(pubmed_path, mesh2pmid_outputfile, logfile)
+    mesh2PMID.mesh2pmid_mapping(pubmed_path, mesh2pmid_index_dir, logfile)
 
     # Map MeSH to #PMIDs
     mesh2PMID.mesh2pmid_mapping_stat(mesh2pmid_statfile, logfile)
 
+    # Export the older JSON mapping
+    if mesh2pmid_outputfile is not None:
+        mesh2PMID.export_mesh2pmid_json(mesh2pmid_outputfile, logfile)
+
     # Close log file
     logfile.close()
 
 
 def text_mining_04_run_index_init(index_name, type_name, index_init_config_file,
-                                 number_shards=1, number_replicas=0, case_sensitive=True):
+                                 number_shards=1, number_replicas=0, case_sensitive=True,
+                                 versioned=False):
     '''
     The purpose of this file is to initialize the ElasticSearch index
     which is where the indexed PubMed text data will be.
     This version allows the option to preserve case-sensitivity in the
     indexed text.
+    With versioned=True, a new index (index_name_<timestamp>) is created
+    and the current one is kept for searches until step 05 swaps the
+    alias index_name to the new index. Returns the name of the created index.
     '''
     # Load the indexing config file
     index_init_config = json.load(open(index_init_config_file, 'r'))
@@ -390,10 +511,14 @@ def text_mining_04_run_index_init(index_name, type_name, index_init_config_file,
     # es = Elasticsearch('https://localhost:9200')
     es = Elasticsearch()
 
-    # Delete the old index if it exists
-    if es.indices.exists(index=index_name):
-        res = es.indices.delete(index=index_name)
-        print('Deleted index:', index_name, '\nResponse:', res, '\n')
+    # Delete the old index (or the indices behind the alias of a versioned build)
+    # if it exists. A versioned build keeps it until the alias swap
+    if versioned:
+        index_name = versioned_index_name(index_name)
+    else:
+        deleted = delete_index(es, index_name)
+        if len(deleted) > 0:
+            print('Deleted index:', index_name, '(', ', '.join(deleted), ')\n')
 
     # Request Body Parameters
     mappings = {type_name: {'properties': index_init_config}}
@@ -406,19 +531,54 @@ def text_mining_04_run_index_init(index_name, type_name, index_init_config_file,
     # Create an index
     res = es.indices.create(index=index_name, settings=settings, mappings=mappings)
     print('Created index:', index_name, '\nResponse:', res)
+    return index_name
 
 
 def text_mining_05_run_index_populate(pubmed_path,index_populate_config_file,
-                                     logfile_path,index_name, type_name):
+                                     logfile_path,index_name, type_name,
+                                     threads=4, chunk_size=500, max_chunk_bytes=10*1024*1024,
+                                     dead_letter_file=None, es_hosts=None,
+                                     build_index_name=None, fast_mode=True, max_num_segments=1):
     '''
     The purpose of this file is to populate the ElasticSearch index.
     Make sure ElasticSearch is running.
+    Documents are sent by several threads in bulk requests of at most
+    chunk_size documents / max_chunk_bytes bytes. Documents which failed
+    are written to the dead_letter_file.
+    With fast_mode, refreshes and replicas are off during the load, then
+    restored, and the index is force-merged into max_num_segments segments.
+    With a build_index_name (versioned index of step 04) different from
+    index_name, that index is loaded and the alias index_name is then
+    switched to it.
     '''
     # Open the log file
     logfile = open(logfile_path, 'w')
     index_populate_config = json.load(open(index_populate_config_file))
-    # Populate the index
-    populate_index(pubmed_path, logfile, index_name, type_name, index_populate_config)
+    es = Elasticsearch(es_hosts)
+    load_index_name = index_name if build_index_name is None else build_index_name
+
+    # Bulk-load settings
+    if fast_mode:
+        previous_settings = start_bulk_load(es, load_index_name, logfile)
+
+    # Populate the index (if it fails, put the settings back without merging)
+    try:
+        populate_index(pubmed_path, logfile, load_index_name, type_name, index_populate_config,
+                       threads=threads, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                       dead_letter_file=dead_letter_file, es_hosts=es_hosts)
+    except Exception:
+        if fast_mode:
+            finish_bulk_load(es, load_index_name, previous_settings, logfile, max_num_segments=None)
+        raise
+
+    # Restore the settings, force-merge
+    if fast_mode:
+        finish_bulk_load(es, load_index_name, previous_settings, logfile,
+                         max_num_segments=max_num_segments)
+
+    # Searches on index_name now go to the new index
+    if load_index_name != index_name:
+        swap_alias(es, index_name, load_index_name, logfile)
 
     # Close the log file
     logfile.close()
@@ -427,11 +587,13 @@ def text_mining_05_run_index_populate(pubmed_path,index_populate_config_file,
 def text_mining_06_run_textcube(textcube_category2pmid, meshtree, mesh2pmid, root_cat,
                                textcube_config, textcube_pmid2category,
                                textcube_stat, MeSHterms_percat,
-                               logfile_path):
+                               logfile_path, meshtree_cache=None, textcube_bitmaps=None):
     '''
     The purpose of this file is to create mappings for the PMIDs to their categories.
     Categories (e.g., diseases) are identified via MeSH term metadata.
     The TextCube is mappings between PMID to category
+    The categories' PMIDs are kept as bitmaps, also saved to textcube_bitmaps
+    for steps 08 and 11.
     '''
     logfile = open(logfile_path, 'w')
 
@@ -443,7 +605,8 @@ def text_mining_06_run_textcube(textcube_category2pmid, meshtree, mesh2pmid, roo
     TC = TextCube(category_names)
 
     # Get categories' descendant MeSH terms
-    TC.descendant_mesh(root_cat, meshtree, MeSHterms_percat, logfile)
+    TC.descendant_mesh(root_cat, meshtree, MeSHterms_percat, logfile,
+                       meshtree_cache=meshtree_cache)
 
     # Get categories' PMIDs
     TC.category2pmids_mapping(mesh2pmid, textcube_category2pmid, logfile)
@@ -454,6 +617,10 @@ def text_mining_06_run_textcube(textcube_category2pmid, meshtree, mesh2pmid, roo
     # Display the number of documents per category
     TC.category_statistics(textcube_stat, logfile)
 
+    # Save the categories' PMID bitmaps
+    if textcube_bitmaps is not None:
+        TC.save_bitmaps(textcube_bitmaps, logfile)
+
     logfile.close()
 
 
@@ -461,18 +628,31 @@ def text_mining_07_run_vary_synonyms_cases(entity_dict_path, species,
                                           case_varied_entites_outpath,
                                           case_varied_entity_dict_path,
                                           core_proteins,
-                                          core_id2syns_outfile):
+                                          core_id2syns_outfile,
+                                          canonical_entity_dict_path=None,
+                                          export_case_varied=True):
     '''
     The purpose of this file is to create case-sensitive variations
     of the synonyms. The synonyms will then be queried.
+    With canonical_entity_dict_path, the synonyms are also saved without
+    case-varying them, for step 08 to match them with their case-fold 
+    masks. export_case_varied=False skips making the case-varied synonyms
+    (the entity dicts then have the canonical synonyms).
     '''
     # Instantiates the class, loads entity dictionary mapping ID to synonyms
     VSC = VarySynonymsCases(entity_dict_path, case_varied_entites_outpath)
     # Adds some more synonyms
     VSC.add_species_syns(species)
 
+    # Saves the synonyms as they are (canonical), matched case-folded
+    if canonical_entity_dict_path is not None:
+        VSC.export_canonical_syns(canonical_entity_dict_path)
+
     # Makes case-sensitive variations of the synonyms
-    VSC.gets_final_syns()
+    if export_case_varied:
+        VSC.gets_final_syns()
+    else:
+        VSC.gets_canonical_syns()
 
     # Make a dictionary of the ID to synonym data
     make_id2syns_dict(case_sensitive_entities_file=case_varied_entites_outpath,
@@ -483,15 +663,18 @@ def text_mining_07_run_vary_synonyms_cases(entity_dict_path, species,
 
 def text_mining_08_run_count_synonyms(entity_dict_path, textcube_pmid2category,
                                      start_year, end_year, syn_pmid_count, pmid_syn_count_out,
-                                     synfound_pmid2cat, logfile, index_name, key):
+                                     synfound_pmid2cat, logfile, index_name, key,
+                                     parsed_corpus=None, synonyms_per_query=1,
+                                     pmid_syn_count_json=None, case_fold=False):
     # Instantiate the object
-    CS = CountSynonyms(entity_dict_path, textcube_pmid2category)
-    # Search for the synonyms in the indexed text
-    CS.synonym_search(key, logfile, syn_pmid_count, index_name, start_year, end_year)
+    CS = CountSynonyms(entity_dict_path, textcube_pmid2category, case_fold=case_fold)
+    # Search for the synonyms in the indexed text (or the parsed text, if given)
+    CS.synonym_search(key, logfile, syn_pmid_count, index_name, start_year, end_year,
+                      parsed_corpus=parsed_corpus, synonyms_per_query=synonyms_per_query)
 
     # Finalize the output files
     CS.finish_synonym_search(logfile, syn_pmid_count, \
-                             pmid_syn_count_out, synfound_pmid2cat)
+                             pmid_syn_count_out, synfound_pmid2cat, pmid_syn_count_json)
 
 
 def text_mining_09_run_screen_synonyms(data_dir, id2syns, eng_path, short_path, rem_path):
@@ -596,19 +779,36 @@ def text_mining_11_run_metadata_update(all_entitycount_path, core_entitycount_pa
 
 def text_mining_12_run_caseolap_score(all_cat2pmids_path, core_cat2pmids_path, all_pmid2entity2count_path,
                                       core_pmid2entity2count_path, category_names_path, all_logFilePath,
-                                      core_logFilePath, all_caseolap_name, core_caseolap_name, result_dir):
+                                      core_logFilePath, all_caseolap_name, core_caseolap_name, result_dir,
+                                      parsed_corpus=None, all_cube_path=None, core_cube_path=None,
+                                      bootstrap_replicates=0, bootstrap_workers=1):
 
     '''
     The purpose of this file is to produce CaseOLAP scores for the entities
     based on their hits in each document (pmid2pcount_path) and the documents'
     category (category2pmids_path).
+    With the parsed corpus and cube paths, the entity counts per (category,
+    year) are also saved, from which the scores of other year windows and 
+    category subsets are recomputed (text_mining_12_run_window_scores). 
+    The cube only covers the years counted in step 08.
+    With bootstrap_replicates, the scores' confidence intervals are also 
+    estimated by resampling the documents of each category.
     '''
+    all_pmid2entity2count = EntityCountMatrix.load(all_pmid2entity2count_path)
+    core_pmid2entity2count = EntityCountMatrix.load(core_pmid2entity2count_path)
+
+    # Publication years, read once for the PMIDs of both (core PMIDs are in all)
+    if all_cube_path is not None or core_cube_path is not None:
+        pmids = np.union1d(all_pmid2entity2count.pmids, core_pmid2entity2count.pmids)
+        years = read_pmid_years(parsed_corpus, pmids)
+        all_pmid_years = years[np.searchsorted(pmids, all_pmid2entity2count.pmids)]
+        core_pmid_years = years[np.searchsorted(pmids, core_pmid2entity2count.pmids)]
 
     #### All proteins ####
     print('======All Proteins======')
     logfile = open(all_logFilePath, 'w')
     category2pmids = json.load(open(all_cat2pmids_path, 'r'))
-    pmid2entity2count = json.load(open(all_pmid2entity2count_path, 'r'))
+    pmid2entity2count = all_pmid2entity2count
 
     ''' Initial Calculations'''
     # Initialize object with input data
@@ -623,35 +823,23 @@ def text_mining_12_run_caseolap_score(all_cat2pmids_path, core_cat2pmids_path, a
     # Save all entities
     C.get_all_entities('all', dump=True, verbose=True)
 
-    ''' Popularity Score (note: relies on some previous sections above)'''
-    # Get the entity counts for each category
-    C.get_entity_counts_per_category()
-
-    # Maps category to its entities to their counts (includes zero count entities)
-    C.category2entity2tf_finder()
-
-    # Calculate the popularity scores for all entities
-    C.calculate_all_popularity_scores(all_or_core='all', dump=True)
-
-    ''' Distinctiveness Score (note: relies on some previous sections above)'''
-    # Map entities to the count of their PMIDs
-    C.category2entity2num_pmids_finder()
+    ''' Scores: Popularity, Distinctiveness, CaseOLAP (combined) '''
+    # Calculate all scores at once (vectorized)
+    C.calculate_all_scores(all_or_core='all', dump=True)
 
-    # Calculate normalized term frequencies
-    C.calculate_category2entity2ntf()
+    # Bootstrap confidence intervals
+    if bootstrap_replicates > 0:
+        C.bootstrap_scores(all_or_core='all', num_replicates=bootstrap_replicates,
+                           workers=bootstrap_workers, dump=True)
 
-    # Calculate normalized document frequencies
-    C.calculate_category2entity2ndf()
-
-    # Calculate ratio of normalized term frequency over normalized document frequency
-    C.calculate_entity2ntf_ndf_ratio()
-
-    # Calculate distinctiveness score
-    C.calculate_all_distinctiveness_scores(all_or_core='all', dump=True)
-
-    '''Final Score'''
-    # Calculate CaseOLAP Score (combine popularity & distinctiveness)
-    C.calculate_caseolap_score(all_or_core='all', dump=True)
+    ''' Counts per category and year '''
+    if all_cube_path is not None:
+        pmid_years = all_pmid_years
+        cube = CaseolapCube.build(pmid2entity2count, category2pmids, pmid_years, C.category_names)
+        cube.save(all_cube_path)
+        C.print_progress('Year cube: ' + str(len(cube.categories)) + ' categories x ' + \
+                         str(len(cube.years)) + ' years, ' + str(int((pmid_years < 0).sum())) + \
+                         ' PMIDs without a year')
 
     # Close logfile
     logfile.close()
@@ -660,7 +848,7 @@ def text_mining_12_run_caseolap_score(all_cat2pmids_path, core_cat2pmids_path, a
     print('\n======Core Proteins======')
     logfile = open(core_logFilePath, 'w')
     category2pmids = json.load(open(core_cat2pmids_path, 'r'))
-    pmid2entity2count = json.load(open(core_pmid2entity2count_path, 'r'))
+    pmid2entity2count = core_pmid2entity2count
 
     ''' Initial Calculations'''
     # Initialize object with input data
@@ -675,38 +863,63 @@ def text_mining_12_run_caseolap_score(all_cat2pmids_path, core_cat2pmids_path, a
     # Save all entities
     C.get_all_entities('core', dump=True, verbose=True)
 
-    ''' Popularity Score (note: relies on some previous sections above)'''
-    # Get the entity counts for each category
-    C.get_entity_counts_per_category()
+    ''' Scores: Popularity, Distinctiveness, CaseOLAP (combined) '''
+    # Calculate all scores at once (vectorized)
+    C.calculate_all_scores(all_or_core='core', dump=True)
 
-    # Maps category to its entities to their counts (includes zero count entities)
-    C.category2entity2tf_finder()
+    # Bootstrap confidence intervals
+    if bootstrap_replicates > 0:
+        C.bootstrap_scores(all_or_core='core', num_replicates=bootstrap_replicates,
+                           workers=bootstrap_workers, dump=True)
 
-    # Calculate the popularity scores for all entities
-    C.calculate_all_popularity_scores(all_or_core='core', dump=True)
+    ''' Counts per category and year '''
+    if core_cube_path is not None:
+        pmid_years = core_pmid_years
+        cube = CaseolapCube.build(pmid2entity2count, category2pmids, pmid_years, C.category_names)
+        cube.save(core_cube_path)
+        C.print_progress('Year cube: ' + str(len(cube.categories)) + ' categories x ' + \
+                         str(len(cube.years)) + ' years, ' + str(int((pmid_years < 0).sum())) + \
+                         ' PMIDs without a year')
 
-    ''' Distinctiveness Score (note: relies on some previous sections above)'''
-    # Map entities to the count of their PMIDs
-    C.category2entity2num_pmids_finder()
+    # Close logfile
+    logfile.close()
 
-    # Calculate normalized term frequencies
-    C.calculate_category2entity2ntf()
 
-    # Calculate normalized document frequencies
-    C.calculate_category2entity2ndf()
 
-    # Calculate ratio of normalized term frequency over normalized document frequency
-    C.calculate_entity2ntf_ndf_ratio()
 
-    # Calculate distinctiveness score
-    C.calculate_all_distinctiveness_scores(all_or_core='core', dump=True)
+def text_mining_12_run_window_scores(all_cube_path, core_cube_path, result_dir, width,
+                                     step=1, window_start=None, window_end=None):
+    '''
+    Recompute the CaseOLAP scores of every year window (e.g., every 5-year
+    window since 1990) from the per-(category, year) counts saved by step 12,
+    without going back to the documents.
+    '''
+    for all_or_core, cube_path in (('all', all_cube_path), ('core', core_cube_path)):
+        cube = CaseolapCube.load(cube_path)
+        window_scores = cube.sliding_window_scores(width, step, window_start, window_end)
+        out_file = os.path.join(result_dir, all_or_core + '_proteins/' + all_or_core + '_window_scores.csv')
+        window_scores.to_csv(out_file, index=False)
+        print(all_or_core + ': ' + str(window_scores[['start_year']].drop_duplicates().shape[0]) + \
+              ' windows with scores')
 
-    '''Final Score'''
-    # Calculate CaseOLAP Score (combine popularity & distinctiveness)
-    C.calculate_caseolap_score(all_or_core='core', dump=True)
 
-    # Close logfile
-    logfile.close()
+
+
+def text_mining_12_run_temporal_scores(all_cube_path, core_cube_path, all_store_dir, core_store_dir,
+                                       width=1, start_year=None, end_year=None):
+    '''
+    Score every year in one vectorized pass from the per-(category, year) 
+    counts saved by step 12, saving entity x category x year tensors of the
+    popularity, distinctiveness and CaseOLAP scores (TemporalScores). Each
+    year is scored on the window of 'width' years ending that year.
+    '''
+    for all_or_core, cube_path, store_dir in (('all', all_cube_path, all_store_dir),
+                                              ('core', core_cube_path, core_store_dir)):
+        cube = CaseolapCube.load(cube_path)
+        save_temporal_scores(cube, store_dir, width, start_year, end_year)
+        scores = TemporalScores(store_dir)
+        print(all_or_core + ': ' + ' x '.join(str(size) for size in scores.scores['caseolap'].shape) + \
+              ' (entities x categories x years) scores')
 
 
 